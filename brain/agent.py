@@ -1,22 +1,42 @@
-import requests
+import os
 import json
+import math
 import base64
 import time
+from io import BytesIO
+from PIL import Image
 from openai import OpenAI
+from http_client import vllm_api, openai_http_client, get_frame, run_batch, VLLM_API_URL
+from history import AgentHistory, TokenCounter, CONTEXT_TOKENS, MESSAGE_OVERHEAD_TOKENS
 
 # Configuration
-AGENT_API_URL = "http://localhost:8000"
-VLLM_API_URL = "http://localhost:8001/v1"
 MODEL_NAME = "Qwen/Qwen2-VL-7B-Instruct"
+# Constrain generation to ACTION_SCHEMA with vLLM guided decoding; disable for servers without it
+GUIDED_DECODING = os.getenv("VLLM_GUIDED_DECODING", "true").lower() == "true"
+RESPONSE_MAX_TOKENS = 256
+# Current step's text (goal, screenshot size, notes) and the image's vision start/end markers
+STEP_PROMPT_RESERVE_TOKENS = 128
 
-# Initialize OpenAI Client (pointing to local vLLM)
+# Qwen2-VL turns every 28x28 pixel patch into one token, so a full 1920x1080 frame costs ~2.6k of the
+# 4096-token context. Frames are resized to this budget before they are sent.
+IMAGE_TOKEN_BUDGET = int(os.getenv("VLM_IMAGE_TOKENS", "1024"))
+IMAGE_PATCH_SIZE = 28
+# Below this scale the 12px mark labels stop being legible, so the budget gives way instead
+MIN_IMAGE_SCALE = float(os.getenv("VLM_MIN_IMAGE_SCALE", "0.5"))
+
+token_counter = TokenCounter(MODEL_NAME)
+
+# Initialize OpenAI Client (pointing to local vLLM) on the shared pooled transport
 client = OpenAI(
     api_key="EMPTY", # vLLM doesn't require an API key by default
     base_url=VLLM_API_URL,
+    http_client=openai_http_client(),
+    timeout=vllm_api.timeout,
+    max_retries=vllm_api.retries,
 )
 
 SYSTEM_PROMPT = """You are an autonomous web browser agent. 
-You are given a screenshot of the current browser state, the screen resolution is 1920x1080.
+You are given a screenshot of the current browser state; its size in pixels is given with each step.
 Interactive elements in the screenshot are highlighted with red numbered tags (e.g. 1, 2, 3).
 Your task is to reach the user's goal by navigating, clicking, or typing.
 
@@ -41,105 +61,293 @@ Available actions and JSON formats:
 Take it step by step. Output ONLY valid JSON.
 """
 
-def get_screenshot():
+# Every reply must match one of these shapes (same formats as the system prompt).
+# Enum instead of const for the action field: it's supported by every guided decoding backend.
+ACTION_SCHEMA = {
+    "anyOf": [
+        {
+            "type": "object",
+            "properties": {"action": {"type": "string", "enum": ["navigate"]}, "url": {"type": "string"}},
+            "required": ["action", "url"],
+            "additionalProperties": False
+        },
+        {
+            "type": "object",
+            "properties": {"action": {"type": "string", "enum": ["click"]}, "mark_id": {"type": "string"}},
+            "required": ["action", "mark_id"],
+            "additionalProperties": False
+        },
+        {
+            "type": "object",
+            "properties": {"action": {"type": "string", "enum": ["click"]}, "x": {"type": "integer"}, "y": {"type": "integer"}},
+            "required": ["action", "x", "y"],
+            "additionalProperties": False
+        },
+        {
+            "type": "object",
+            "properties": {"action": {"type": "string", "enum": ["type"]}, "text": {"type": "string"}},
+            "required": ["action", "text"],
+            "additionalProperties": False
+        },
+        {
+            "type": "object",
+            "properties": {"action": {"type": "string", "enum": ["done"]}, "result": {"type": "string"}},
+            "required": ["action", "result"],
+            "additionalProperties": False
+        }
+    ]
+}
+
+REPAIR_PROMPT = """Your previous reply was not a valid action ({error}).
+Reply again with exactly one JSON object in one of the formats from the instructions, and nothing else."""
+
+# Lossless from the Agent API (CDP capture, no re-encode): budget_frame crops and resizes it and does the
+# only lossy JPEG encode, so the VLM never sees JPEG artifacts compressed twice
+VLM_FRAME_OPTIONS = {"format": "png", "fast": "true"}
+
+def get_screenshot(**options):
     # Attempt to grab a screenshot from our Agent API
     print("📸 Taking screenshot...")
     try:
-        response = requests.get(f"{AGENT_API_URL}/v1/perception/screenshot")
-        response.raise_for_status()
-        data = response.json()
-        return data.get("image_base64"), data.get("marks_mapping", {})
+        image_bytes, meta = get_frame(marks=True, **options)
+        return image_bytes, meta.get("marks_mapping", {}), meta.get("page_version")
     except Exception as e:
         print(f"❌ Failed to get screenshot: {e}")
-        return None, {}
+        return None, {}, None
+
+def marks_bounds(marks_mapping: dict, width: int, height: int, padding: int = 40):
+    # Smallest screen rectangle (left, top, width, height) holding every mark, padded
+    if not marks_mapping:
+        return None
+    left = max(0, min(m["left"] for m in marks_mapping.values()) - padding)
+    top = max(0, min(m["top"] for m in marks_mapping.values()) - padding)
+    right = min(width, max(m["left"] + m["width"] for m in marks_mapping.values()) + padding)
+    bottom = min(height, max(m["top"] + m["height"] for m in marks_mapping.values()) + padding)
+    return left, top, right - left, bottom - top
+
+def budget_frame(image_bytes: bytes, marks_mapping: dict = None, budget: int = IMAGE_TOKEN_BUDGET, roi=None):
+    # Crops to the region of interest (a (left, top, width, height) screen rectangle, or "marks" for the
+    # area holding all marks) and resizes to whole 28px patches within the token budget.
+    # Returns (jpeg_bytes, view); view maps screenshot pixels back to screen space (see to_screen).
+    img = Image.open(BytesIO(image_bytes)).convert("RGB")
+    if roi == "marks":
+        roi = marks_bounds(marks_mapping, img.width, img.height)
+    left, top = 0, 0
+    if roi:
+        # Clipped to the frame on every side, so a rectangle past an edge keeps its other edges
+        left, top = max(0, int(roi[0])), max(0, int(roi[1]))
+        right, bottom = min(img.width, int(roi[0]) + int(roi[2])), min(img.height, int(roi[1]) + int(roi[3]))
+        if right - left >= IMAGE_PATCH_SIZE and bottom - top >= IMAGE_PATCH_SIZE:
+            img = img.crop((left, top, right, bottom))
+        else:
+            left, top = 0, 0
+            
+    scale = math.sqrt(budget * IMAGE_PATCH_SIZE**2 / (img.width * img.height))
+    scale = max(min(scale, 1.0), MIN_IMAGE_SCALE)
+    # Whole patches, rounded down so the budget holds
+    width = max(1, math.floor(img.width * scale / IMAGE_PATCH_SIZE)) * IMAGE_PATCH_SIZE
+    height = max(1, math.floor(img.height * scale / IMAGE_PATCH_SIZE)) * IMAGE_PATCH_SIZE
+    view = {
+        "left": left,
+        "top": top,
+        "scale_x": width / img.width,
+        "scale_y": height / img.height,
+        "width": width,
+        "height": height,
+        "tokens": (width // IMAGE_PATCH_SIZE) * (height // IMAGE_PATCH_SIZE)
+    }
+    if (width, height) != img.size:
+        img = img.resize((width, height), Image.LANCZOS)
+    buffered = BytesIO()
+    img.save(buffered, format="JPEG", quality=85)
+    return buffered.getvalue(), view
 
-def execute_action(action_data, marks_mapping):
-    # Sends the parsed JSON action to the FastAPI agent backend
+def to_screen(view: dict, x, y):
+    # Screenshot pixel coordinates (what the VLM sees) -> screen CSS pixels
+    if not view:
+        return x, y
+    return round(view["left"] + x / view["scale_x"]), round(view["top"] + y / view["scale_y"])
+
+def execute_action(action_data, marks_mapping, page_version=None, view=None):
+    # Runs the parsed JSON action, waits for the page to settle and captures the next frame,
+    # all in one Agent API batch. Returns (is_done, next_frame); next_frame is None if no frame came back.
     action_type = action_data.get("action")
     print(f"🛠️ Executing action: {action_type}")
+    actions = []
     
-    try:
-        if action_type == "navigate":
-            url = action_data.get("url")
-            print(f"   -> Nagivating to: {url}")
-            requests.post(f"{AGENT_API_URL}/v1/action/browser/navigate", json={"url": url})
-        
-        elif action_type == "click":
-            # Check if mark_id is provided
-            if "mark_id" in action_data:
-                mark_id = str(action_data["mark_id"])
-                if mark_id in marks_mapping:
-                    x = marks_mapping[mark_id]["x"]
-                    y = marks_mapping[mark_id]["y"]
-                    print(f"   -> Clicking Mark ID [{mark_id}] at: ({x}, {y})")
-                else:
-                    print(f"❌ Mark ID [{mark_id}] not found in mapping.")
-                    return False
+    if action_type == "navigate":
+        url = action_data.get("url")
+        print(f"   -> Nagivating to: {url}")
+        actions.append({"action": "navigate", "url": url})
+    
+    elif action_type == "click":
+        # Check if mark_id is provided
+        x, y = None, None
+        if "mark_id" in action_data:
+            mark_id = str(action_data["mark_id"])
+            if mark_id in marks_mapping:
+                x = marks_mapping[mark_id]["x"]
+                y = marks_mapping[mark_id]["y"]
+                print(f"   -> Clicking Mark ID [{mark_id}] at: ({x}, {y})")
             else:
-                x, y = action_data.get("x"), action_data.get("y")
-                print(f"   -> Clicking at: ({x}, {y})")
-                
-            requests.post(f"{AGENT_API_URL}/v1/action/mouse/click", json={"x": x, "y": y})
-            
-        elif action_type == "type":
-            text = action_data.get("text")
-            print(f"   -> Typing: '{text}'")
-            requests.post(f"{AGENT_API_URL}/v1/action/keyboard/type", json={"text": text})
-            
-        elif action_type == "done":
-            result = action_data.get("result")
-            print(f"✅ Goal Achieved: {result}")
-            return True
-            
+                print(f"❌ Mark ID [{mark_id}] not found in mapping.")
         else:
-            print(f"⚠️ Unknown action type: {action_type}")
-            
+            x, y = action_data.get("x"), action_data.get("y")
+            if x is not None and y is not None:
+                # Raw coordinates are in the budgeted screenshot's pixels; mark coordinates already are screen pixels
+                x, y = to_screen(view, x, y)
+            print(f"   -> Clicking at: ({x}, {y})")
+        if x is not None and y is not None:
+            actions.append({"action": "click", "x": x, "y": y})
+        
+    elif action_type == "type":
+        text = action_data.get("text")
+        print(f"   -> Typing: '{text}'")
+        actions.append({"action": "type", "text": text})
+        
+    elif action_type == "done":
+        result = action_data.get("result")
+        print(f"✅ Goal Achieved: {result}")
+        return True, None
+        
+    else:
+        print(f"⚠️ Unknown action type: {action_type}")
+        
+    # Settle instead of a fixed sleep, then grab the next frame unless the page version didn't move
+    actions.append({"action": "wait"})
+    actions.append({"action": "screenshot", "options": VLM_FRAME_OPTIONS, "since_version": page_version})
+    try:
+        meta, images = run_batch(actions, stop_on_error=False)
     except Exception as e:
         print(f"❌ Action execution failed: {e}")
+        return False, None
         
-    return False
+    for entry in meta["results"]:
+        if entry["status"] == "error":
+            print(f"❌ {entry['action']} failed: {entry['error']}")
+        elif entry["action"] == "wait":
+            print(f"⏳ Page settled after {entry['result']['elapsed_ms']:.0f}ms ({entry['result']['condition']})")
+            
+    shot = meta["results"][-1]
+    if shot["status"] != "ok":
+        return False, None
+    if shot["result"].get("unchanged"):
+        return False, {"unchanged": True}
+    return False, {
+        "unchanged": False,
+        "image": images[shot["result"]["image_index"]],
+        "marks_mapping": shot["result"].get("marks_mapping", {}),
+        "page_version": shot["result"].get("page_version")
+    }
+
+def read_json_object(stream) -> str:
+    # Accumulates streamed deltas and closes the stream as soon as the first top-level JSON object ends,
+    # so no tokens are spent (or waited on) after the closing brace
+    text = ""
+    depth, in_string, escaped = 0, False, False
+    for chunk in stream:
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta.content or ""
+        for i, ch in enumerate(delta):
+            if in_string:
+                if escaped:
+                    escaped = False
+                elif ch == "\\":
+                    escaped = True
+                elif ch == '"':
+                    in_string = False
+            elif ch == '"' and depth > 0:
+                in_string = True
+            elif ch == "{":
+                depth += 1
+            elif ch == "}" and depth > 0:
+                depth -= 1
+                if depth == 0:
+                    stream.close()
+                    return text + delta[:i + 1]
+        text += delta
+    return text
+
+def request_action(messages) -> str:
+    # Streamed completion, schema-constrained when guided decoding is on
+    start = time.perf_counter()
+    stream = client.chat.completions.create(
+        model=MODEL_NAME,
+        messages=messages,
+        max_tokens=RESPONSE_MAX_TOKENS,
+        temperature=0.1,
+        stream=True,
+        extra_body={"guided_json": ACTION_SCHEMA} if GUIDED_DECODING else None
+    )
+    response_text = read_json_object(stream)
+    vllm_api.record("POST", "/chat/completions", 200, (time.perf_counter() - start) * 1000)
+    return response_text
 
-def decide_next_action(goal, b64_image, history):
+def parse_action(response_text: str) -> dict:
+    # Raises ValueError (JSONDecodeError included) unless the reply is one action matching ACTION_SCHEMA.
+    # Anything before the object (e.g. a code fence when guided decoding is off) is skipped.
+    start = response_text.find("{")
+    if start < 0:
+        raise ValueError("no JSON object in reply")
+    data = json.loads(response_text[start:])
+    if isinstance(data, dict):
+        for shape in ACTION_SCHEMA["anyOf"]:
+            if data.get("action") in shape["properties"]["action"]["enum"] and all(key in data for key in shape["required"]):
+                return data
+    raise ValueError(f"not a known action format: {json.dumps(data)}")
+
+def decide_next_action(goal, image_bytes, history, media_type="image/png", unchanged=False, image_size=None):
     print("🧠 Asking VLM for the next move...", flush=True)
     
-    # Format message history
+    # The system prompt is always the first message, byte for byte, so vLLM's prefix cache can reuse its KV
     messages = [
         {"role": "system", "content": SYSTEM_PROMPT},
     ]
     
-    # Append past history so it knows what it already did
+    # Append past history so it knows what it already did. It alternates user/assistant and ends with the
+    # last step's result, which opens the current turn instead of being a user message of its own.
+    preface = ""
     if history:
+        if history[-1]["role"] == "user":
+            preface = history[-1]["content"] + "\n"
+            history = history[:-1]
         messages.extend(history)
         
-    # Build the current turn query
+    # Build the current turn query. The data URL is the only place the frame is base64-encoded.
+    b64_image = base64.b64encode(image_bytes).decode("utf-8")
+    prompt = preface + f"Goal: {goal}\nWhat is your next action based on this screenshot?"
+    if image_size:
+        prompt += f"\nThe screenshot is {image_size[0]}x{image_size[1]} pixels; give raw x/y in screenshot pixels."
+    if unchanged:
+        prompt += "\nNote: the page did not change after your last action."
     content = [
-        {"type": "text", "text": f"Goal: {goal}\nWhat is your next action based on this screenshot?"},
+        {"type": "text", "text": prompt},
         {
             "type": "image_url", 
-            "image_url": {"url": f"data:image/png;base64,{b64_image}"}
+            "image_url": {"url": f"data:{media_type};base64,{b64_image}"}
         }
     ]
     messages.append({"role": "user", "content": content})
     
     try:
-        completion = client.chat.completions.create(
-            model=MODEL_NAME,
-            messages=messages,
-            max_tokens=256,
-            temperature=0.1
-        )
-        response_text = completion.choices[0].message.content.strip()
-        
-        # Remove any Markdown code block backticks if the model ignores the core prompt
-        if response_text.startswith("```json"):
-            response_text = response_text[7:-3]
-        elif response_text.startswith("```"):
-            response_text = response_text[3:-3]
-            
-        return json.loads(response_text), messages
-    except json.JSONDecodeError as e:
-        print(f"❌ VLM returned invalid JSON: {response_text}", flush=True)
-        return None, messages
+        response_text = request_action(messages)
+        try:
+            return parse_action(response_text), messages
+        except ValueError as e:
+            error = str(e)
+        # One retry with the bad reply and the parse error in context; the caller's messages stay as they were
+        print(f"⚠️ VLM returned an invalid action ({error}), retrying with a repair prompt...", flush=True)
+        repair_messages = messages + [
+            {"role": "assistant", "content": response_text},
+            {"role": "user", "content": REPAIR_PROMPT.format(error=error)}
+        ]
+        response_text = request_action(repair_messages)
+        try:
+            return parse_action(response_text), messages
+        except ValueError as e:
+            print(f"❌ VLM returned invalid JSON again ({e}): {response_text}", flush=True)
+            return None, messages
     except BaseException as e:
         import traceback
         with open("crash.log", "w") as f:
@@ -147,47 +355,60 @@ def decide_next_action(goal, b64_image, history):
         print(f"❌ VLM request FATAL ERROR: {e}", flush=True)
         return None, messages
 
-def run_agent_loop(goal, max_steps=10):
+def run_agent_loop(goal, max_steps=10, image_budget=IMAGE_TOKEN_BUDGET, roi=None):
+    # roi: optional (left, top, width, height) screen rectangle, or "marks", to crop frames to before budgeting
     print(f"🚀 Starting Agent Loop. Goal: '{goal}'")
-    history = []
+    history = AgentHistory(token_counter)
+    system_tokens = token_counter.count(SYSTEM_PROMPT) + MESSAGE_OVERHEAD_TOKENS
+    image_bytes, marks_mapping, page_version = None, {}, None
+    vlm_image, view = None, None
+    next_frame = None
     
     for step in range(1, max_steps + 1):
         print(f"\n--- Step {step}/{max_steps} ---")
         
-        # 1. Grab Screenshot
-        b64_image, marks_mapping = get_screenshot()
-        if not b64_image:
+        # 1. Use the frame captured right after the previous action, or grab a fresh one
+        unchanged = image_bytes is not None and next_frame is not None and next_frame["unchanged"]
+        if unchanged:
+            print("♻️ Page unchanged since last frame, reusing it.")
+        elif next_frame is not None:
+            image_bytes, marks_mapping, page_version = next_frame["image"], next_frame["marks_mapping"], next_frame["page_version"]
+        else:
+            image_bytes, marks_mapping, page_version = get_screenshot(**VLM_FRAME_OPTIONS)
+        if not image_bytes:
             print("Aborting loop due to missing screenshot.")
             break
+        if not unchanged or vlm_image is None:
+            vlm_image, view = budget_frame(image_bytes, marks_mapping, image_budget, roi)
+        print(f"🖼️ Image: {view['width']}x{view['height']} -> {view['tokens']} image tokens (budget {image_budget})")
             
-        # 2. Decide Next Action Using Vision LLM
-        action_data, messages = decide_next_action(goal, b64_image, history)
+        # 2. Decide Next Action Using Vision LLM, with past steps trimmed to what's left of the context
+        history_budget = CONTEXT_TOKENS - RESPONSE_MAX_TOKENS - system_tokens - STEP_PROMPT_RESERVE_TOKENS - view["tokens"]
+        past_messages = history.messages(history_budget)
+        print(f"🧾 History: {len(history.steps)} steps in {len(past_messages)} messages, {history.last_tokens}/{history_budget} tokens")
+        action_data, messages = decide_next_action(
+            goal, vlm_image, past_messages, media_type="image/jpeg", unchanged=unchanged, image_size=(view["width"], view["height"])
+        )
         if not action_data:
             print("Aborting loop due to VLM failure.")
             break
             
         print(f"🤖 VLM Response: {json.dumps(action_data, indent=2)}")
         
-        # 3. Add to History
-        # We append the original query (user) and the model's response (assistant)
-        # to the history so it can reason over multiple steps
-        # We omit the raw base64 string from history to save context tokens, 
-        # replacing it with a placeholder note.
-        clean_user_message = {
-            "role": "user", 
-            "content": f"Goal: {goal}\n[Screenshot submitted previously]"
-        }
-        history.append(clean_user_message)
-        history.append({"role": "assistant", "content": json.dumps(action_data)})
+        # 3. Add to History (screenshots are never replayed, only the action and what it did)
+        history.record(step, action_data)
         
-        # 4. Execute Action
-        is_done = execute_action(action_data, marks_mapping)
+        # 4. Execute Action (plus settle wait and next screenshot, in one round-trip)
+        is_done, next_frame = execute_action(action_data, marks_mapping, page_version, view)
         if is_done:
             break
+        if next_frame is None:
+            history.record_outcome("failed or no screenshot")
+        elif next_frame["unchanged"]:
+            history.record_outcome("page did not change")
+        else:
+            history.record_outcome("page changed")
             
-        # Sleep briefly to let the DOM settle before the next screenshot
-        time.sleep(2)
-        
     print("\n🛑 Agent loop finished.")
 
 if __name__ == "__main__":
@@ -1,11 +1,12 @@
 import os
 import subprocess
 from fastapi import FastAPI, HTTPException
-from fastapi.responses import StreamingResponse
+from fastapi.responses import StreamingResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 import asyncio
-from executor import run_blueprint
+from executor import run_blueprint, plan_cache
+from http_client import agent_api, ALL_CLIENTS, latency_report, run_batch, get_fingerprints
 from contextlib import asynccontextmanager
 
 # Read Vast.ai connection details
@@ -92,7 +93,9 @@ async def lifespan(app: FastAPI):
     
     yield
     
-    # Shutdown: Clean up tunnels
+    # Shutdown: Close pooled connections, then clean up tunnels
+    for client in ALL_CLIENTS:
+        await client.aclose()
     print("🛑 Shutting down Orchestrator... closing tunnels...")
     for proc in tunnels:
         proc.terminate()
@@ -116,6 +119,14 @@ async def get_ssh_logs():
         "logs": ssh_logs[-100:]
     }
 
+@app.get("/v1/debug/latency")
+async def get_latency_stats():
+    return latency_report()
+
+@app.get("/v1/debug/plans")
+async def get_plan_cache_stats():
+    return plan_cache.stats()
+
 @app.middleware("http")
 async def track_activity(request: Request, call_next):
     global LAST_ACTIVITY_TIME
@@ -229,6 +240,11 @@ app.mount("/vnc", StaticFiles(directory="novnc", html=True), name="vnc")
 class ExecuteRequest(BaseModel):
     blueprint_id: str
     start_url: str
+    # Run in an existing Agent API browser session, or in a throwaway one (isolated) so runs can go in parallel
+    session_id: str | None = None
+    isolated: bool = False
+    # stealth | balanced | fast input for the isolated session
+    input_profile: str | None = None
 
 @app.get("/v1/debug/ports")
 async def get_remote_ports():
@@ -248,12 +264,25 @@ async def get_remote_ports():
         return {"error": str(e)}
 
 @app.get("/v1/perception/screenshot")
-async def get_screenshot(marks: bool = False):
-    import requests
-    PROXY_URL = os.getenv("AGENT_API_URL", "http://localhost:8000")
+async def get_screenshot(request: Request, marks: bool = False):
     try:
-        # Proxy the request to the Vast.ai container over the SSH tunnel
-        resp = requests.get(f"{PROXY_URL}/v1/perception/screenshot?marks={str(marks).lower()}", timeout=30)
+        # Proxy the request to the Vast.ai container over the SSH tunnel.
+        # Capture options (transport, format, quality, scale, grayscale, fast, ...) are forwarded as-is.
+        params = {**request.query_params, "marks": str(marks).lower()}
+        resp = await agent_api.aget("/v1/perception/screenshot", params=params)
+        resp.raise_for_status()
+        if resp.headers.get("content-type", "").startswith("multipart/"):
+            # Binary frames are passed through untouched; no JSON parsing of the image
+            return Response(content=resp.content, media_type=resp.headers["content-type"])
+        return resp.json()
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Proxy error: {str(e)}")
+
+@app.get("/v1/perception/version")
+async def get_page_version(hash: bool = False):
+    # Cheap change probe so the dashboard can skip refetching an unchanged frame
+    try:
+        resp = await agent_api.aget("/v1/perception/version", params={"hash": str(hash).lower()})
         resp.raise_for_status()
         return resp.json()
     except Exception as e:
@@ -264,15 +293,28 @@ class NavigateRequest(BaseModel):
 
 @app.post("/v1/action/browser/navigate")
 async def browser_navigate(req: NavigateRequest):
-    import requests
-    PROXY_URL = "http://localhost:8000"
     try:
-        resp = requests.post(f"{PROXY_URL}/v1/action/browser/navigate", json={"url": req.url}, timeout=30)
+        resp = await agent_api.apost("/v1/action/browser/navigate", json={"url": req.url})
         resp.raise_for_status()
         return resp.json()
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Proxy navigate error: {str(e)}")
 
+class AnchorSearchRequest(BaseModel):
+    embedding: list[float]
+    blueprint_id: str | None = None
+    threshold: float = 0.8
+    limit: int = 5
+
+@app.post("/v1/anchors/search")
+def search_anchor_library(req: AnchorSearchRequest):
+    from executor import search_anchors
+    try:
+        matches = search_anchors(req.embedding, req.blueprint_id, req.threshold, req.limit)
+        return {"status": "success", "matches": matches}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Anchor search error: {str(e)}")
+
 class TeachRequest(BaseModel):
     blueprint_id: str
     action: str # "click" or "type"
@@ -281,16 +323,19 @@ class TeachRequest(BaseModel):
     y: float
     text: str = ""
 
+# Plain def: FastAPI runs it in the threadpool, so its blocking HTTP/DB calls don't stall the event loop
 @app.post("/v1/teach/action")
-async def teach_action(req: TeachRequest):
+def teach_action(req: TeachRequest):
     import traceback
     try:
         # This endpoint replaces the CLI teacher.py
         # 1. Ask Vast.ai browser for current DOM state
-        from executor import get_screenshot_and_marks, crop_image_around_mark, get_embedding, supabase
+        from executor import capture_screen_state, get_mark_embeddings, store_anchor, supabase, invalidate_plan
         
-        img_b64, marks = get_screenshot_and_marks()
-        if not img_b64 or not marks:
+        # The frame stays in the sandbox; we only need its marks and id
+        state = capture_screen_state()
+        marks = state["marks_mapping"] if state else None
+        if not marks:
             raise HTTPException(status_code=500, detail="Failed to get screen context")
             
         best_mark_id = None
@@ -325,59 +370,56 @@ async def teach_action(req: TeachRequest):
         target_mark = marks[best_mark_id]
         print(f"✅ Web Teacher matched click ({req.x}, {req.y}) to Mark {best_mark_id}")
         
-        # 2. Crop & Embed Visual Anchor
-        crop_b64 = crop_image_around_mark(img_b64, target_mark)
-        vector = get_embedding(crop_b64)
+        # 2. Crop & Embed Visual Anchor (server-side, from the same frame)
+        _, vectors = get_mark_embeddings(state["screenshot_id"], {best_mark_id: target_mark})
+        vector = vectors.get(str(best_mark_id)) if vectors else None
         if not vector:
             raise HTTPException(status_code=500, detail="Failed to embed Visual Anchor")
             
-        # 3. Save Memory to Supabase
-        width_pct = target_mark.get('width', 10) / 1920
-        height_pct = target_mark.get('height', 10) / 1080
-        supabase.table("visual_anchors").insert({
-            "blueprint_id": req.blueprint_id,
-            "semantic_label": req.label,
-            "embedding": vector,
-            "bounding_box_relative": {
-                "width_pct": width_pct,
-                "height_pct": height_pct
-            }
-        }).execute()
+        # DOM identity of the same element, so the executor can usually skip visual matching
+        try:
+            fingerprint = get_fingerprints([best_mark_id]).get(str(best_mark_id))
+        except Exception as e:
+            print(f"⚠️ Failed to fingerprint Mark {best_mark_id}, anchor will be visual-only: {e}")
+            fingerprint = None
+            
+        # 3. Save Memory to Supabase, reusing the anchor only if this same element was already taught under this label
+        anchor_label = req.label
+        reused, similar_anchor = store_anchor(req.blueprint_id, anchor_label, vector, target_mark, fingerprint)
         
-        # 4. Update the Blueprint DAG
-        res = supabase.table("blueprints").select("state_graph_json").eq("id", req.blueprint_id).execute()
+        # 4. Execute the click in the browser so the stream advances; the step is only recorded if it happened
+        t_x = target_mark.get('x', 0)
+        t_y = target_mark.get('y', 0)
         
-        graph = res.data[0].get("state_graph_json") if res.data else None
-        if not graph or not isinstance(graph, dict):
-            graph = {"steps": []}
-        if "steps" not in graph:
-            graph["steps"] = []
+        # Click (and type) in one batch round-trip
+        actions = [{"action": "click", "x": t_x, "y": t_y}]
+        if req.action == "type":
+            actions.append({"action": "type", "text": req.text})
+        meta, _ = run_batch(actions)
+        failed = next((r for r in meta["results"] if r["status"] != "ok"), None)
+        if failed:
+            raise HTTPException(status_code=502, detail=f"{failed['action']} failed in the browser: {failed.get('error') or failed['status']}")
             
-        step_num = len(graph["steps"]) + 1
+        # 5. Update the Blueprint DAG
         new_step = {
-            "step": step_num,
             "action": req.action,
-            "semantic_target": req.label
+            "semantic_target": anchor_label
         }
         if req.action == "type":
             new_step["text"] = req.text
             
-        graph["steps"].append(new_step)
-        supabase.table("blueprints").update({"state_graph_json": graph}).eq("id", req.blueprint_id).execute()
+        # Appended and versioned in one UPDATE (append_blueprint_step in schema.sql), so concurrent teach calls
+        # can't drop each other's steps or share a version; the new version makes executors recompile
+        res = supabase.rpc("append_blueprint_step", {"target_blueprint_id": req.blueprint_id, "new_step": new_step}).execute()
+        if not res.data:
+            raise HTTPException(status_code=404, detail="Blueprint not found")
+        new_step = res.data[0]["step"]
+        invalidate_plan(req.blueprint_id)
         
-        # 5. Execute the click in the browser so the stream advances
-        import requests
-        PROXY_URL = "http://localhost:8000"
-        t_x = target_mark.get('x', 0)
-        t_y = target_mark.get('y', 0)
-        
-        if req.action == "click":
-            requests.post(f"{PROXY_URL}/v1/action/mouse/click", json={"x": t_x, "y": t_y}, timeout=30)
-        elif req.action == "type":
-            requests.post(f"{PROXY_URL}/v1/action/mouse/click", json={"x": t_x, "y": t_y}, timeout=30)
-            requests.post(f"{PROXY_URL}/v1/action/keyboard/type", json={"text": req.text}, timeout=30)
-            
-        return {"status": "success", "mark_id": best_mark_id, "step_added": new_step}
+        # similar_anchor: the closest look-alike the new element was compared against, if any
+        return {"status": "success", "mark_id": best_mark_id, "step_added": new_step, "anchor_reused": reused, "similar_anchor": similar_anchor}
+    except HTTPException:
+        raise
     except Exception as e:
         print("💥 FATAL ERROR IN TEACH_ACTION:")
         err_str = traceback.format_exc()
@@ -387,12 +429,9 @@ async def teach_action(req: TeachRequest):
 @app.post("/v1/execute")
 async def execute_task(req: ExecuteRequest):
     async def event_stream():
-        # run_blueprint is currently a synchronous generator. 
-        # For a truly async stream we loop through it.
         try:
-            for log_line in run_blueprint(req.blueprint_id, req.start_url):
+            async for log_line in run_blueprint(req.blueprint_id, req.start_url, req.session_id, req.isolated, req.input_profile):
                 yield f"data: {log_line}\n\n"
-                await asyncio.sleep(0.01) # Small yield to event loop
         except Exception as e:
             yield f"data: [ERROR] Fatal exception: {str(e)}\n\n"
             
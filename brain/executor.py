@@ -1,16 +1,16 @@
 import os
-import requests
+import asyncio
 import base64
-import math
 from io import BytesIO
 from PIL import Image
 from dotenv import load_dotenv
 from supabase import create_client, Client
+from matching import parse_vector, rank_candidates, rank_by_geometry, same_dom_element, same_position
+from plans import PlanCache, PlanError, compile_plan, thaw
+from http_client import agent_api, embedding_api, arun_batch, session_path, acreate_session, aclose_session
 
 load_dotenv()
 
-AGENT_API_URL = "http://localhost:8000"
-EMBEDDING_API_URL = "http://localhost:8002"
 SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_KEY = os.getenv("SUPABASE_KEY")
 
@@ -20,39 +20,55 @@ if not SUPABASE_URL or not SUPABASE_KEY:
 
 supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
 
-def cosine_similarity(v1, v2):
-    if isinstance(v1, str):
-        import json
-        v1 = json.loads(v1)
-    if isinstance(v2, str):
-        import json
-        v2 = json.loads(v2)
-    
-    dot_product = sum(float(a) * float(b) for a, b in zip(v1, v2))
-    norm_v1 = math.sqrt(sum(float(a) * float(a) for a in v1))
-    norm_v2 = math.sqrt(sum(float(b) * float(b) for b in v2))
-    if norm_v1 == 0 or norm_v2 == 0:
-        return 0.0
-    return dot_product / (norm_v1 * norm_v2)
-
-def get_screenshot_and_marks():
+# Visual matching embeds only the geometrically most plausible marks: batches of MATCH_BATCH_SIZE, up to
+# MATCH_TOP_K, stopping as soon as one scores EARLY_EXIT_SCORE with EARLY_EXIT_MARGIN over the runner-up
+VISUAL_MATCH_THRESHOLD = 0.70
+MATCH_TOP_K = int(os.getenv("MATCH_TOP_K", "12"))
+MATCH_BATCH_SIZE = int(os.getenv("MATCH_BATCH_SIZE", "4"))
+EARLY_EXIT_SCORE = float(os.getenv("MATCH_EARLY_EXIT_SCORE", "0.90"))
+EARLY_EXIT_MARGIN = float(os.getenv("MATCH_EARLY_EXIT_MARGIN", "0.05"))
+# Cosine similarity from which a newly taught element is checked against an existing anchor for reuse,
+# and how many such look-alikes are checked for being the same element
+ANCHOR_DEDUPE_THRESHOLD = float(os.getenv("ANCHOR_DEDUPE_THRESHOLD", "0.97"))
+ANCHOR_DEDUPE_CANDIDATES = int(os.getenv("ANCHOR_DEDUPE_CANDIDATES", "5"))
+
+# Compiled blueprints (steps with resolved anchors), see aget_plan
+plan_cache = PlanCache()
+
+def capture_screen_state():
+    # Marks of a fresh frame that stays cached in the sandbox (screenshot_id), without transferring the image
     print("📸 Capturing browser state for analysis...")
-    res = requests.get(f"{AGENT_API_URL}/v1/perception/screenshot?marks=true")
+    res = agent_api.get("/v1/perception/screenshot", params={"marks": "true", "image": "false"})
     if res.status_code != 200:
         print(f"❌ Failed to get screenshot: {res.text}")
+        return None
+    return res.json()
+
+def get_mark_embeddings(screenshot_id: str = None, marks_mapping: dict = None):
+    # Cropping and embedding happen inside the sandbox; only marks and vectors cross the tunnel
+    payload = {"screenshot_id": screenshot_id, "marks_mapping": marks_mapping}
+    res = agent_api.post("/v1/perception/embeddings", json=payload, idempotent=True)
+    if res.status_code != 200:
+        print(f"❌ Failed to embed screen elements: {res.text}")
         return None, None
     data = res.json()
-    return data["image_base64"], data["marks_mapping"]
+    return data["marks_mapping"], data["embeddings"]
 
-def get_embedding(image_base64: str):
-    res = requests.post(f"{EMBEDDING_API_URL}/v1/embed/image", json={"image_base64": image_base64})
+def get_embeddings(images_base64: list):
+    # One batched CLIP forward pass for all crops instead of one request per crop
+    res = embedding_api.post("/v1/embed/images", json={"images_base64": images_base64}, idempotent=True)
     if res.status_code != 200:
-        print(f"❌ Failed to generate embedding: {res.text}")
+        print(f"❌ Failed to generate embeddings: {res.text}")
         return None
-    return res.json()["embedding"]
+    return res.json()["embeddings"]
+
+def get_embedding(image_base64: str):
+    embeddings = get_embeddings([image_base64])
+    return embeddings[0] if embeddings else None
 
-def crop_image_around_mark(image_base64: str, mark_info: dict, crop_size=100):
-    img_data = base64.b64decode(image_base64)
+def crop_image_around_mark(image, mark_info: dict, crop_size=100):
+    # Accepts raw image bytes (binary transport) or a base64 string (JSON transport)
+    img_data = base64.b64decode(image) if isinstance(image, str) else image
     img = Image.open(BytesIO(img_data))
     
     x = mark_info["x"]
@@ -69,85 +85,297 @@ def crop_image_around_mark(image_base64: str, mark_info: dict, crop_size=100):
     cropped.save(buffered, format="PNG")
     return base64.b64encode(buffered.getvalue()).decode("utf-8")
 
-def execute_action(action: str, payload: dict):
-    print(f"🛠️ Executing {action}...")
-    res = requests.post(f"{AGENT_API_URL}/v1/action/{action}", json=payload)
+async def aexecute_step(action: dict, session_id: str = None):
+    # The action and a quiescence wait in one Agent API round-trip, so the next perception sees a settled page.
+    # Returns (ok, settle_result).
+    print(f"🛠️ Executing {action['action']}...")
+    try:
+        meta, _ = await arun_batch([action, {"action": "wait"}], session_id)
+    except Exception as e:
+        print(f"❌ Action failed: {e}")
+        return False, None
+    performed, settle = meta["results"]
+    if performed["status"] != "ok":
+        print(f"❌ Action failed: {performed.get('error')}")
+        return False, None
+    return True, settle.get("result")
+
+def describe_settle(settle: dict) -> str:
+    if not settle:
+        return "[SYSTEM] ⚠️ Settle wait did not complete"
+    return f"[SYSTEM] ⏳ Page settled after {settle['elapsed_ms']:.0f}ms ({settle['condition']})"
+
+async def aclick_fingerprint(fingerprint: dict, session_id: str = None):
+    # In-page DOM match, click and settle wait in one batch. Returns (click_entry, settle_result);
+    # click_entry["status"] is "error" when the fingerprint didn't resolve to exactly one element.
+    try:
+        meta, _ = await arun_batch([{"action": "click", "fingerprint": fingerprint}, {"action": "wait"}], session_id)
+    except Exception as e:
+        return {"status": "error", "error": str(e)}, None
+    performed, settle = meta["results"]
+    return performed, settle.get("result")
+
+async def aget_mark_embeddings(screenshot_id: str = None, marks_mapping: dict = None, session_id: str = None):
+    payload = {"screenshot_id": screenshot_id, "marks_mapping": marks_mapping}
+    res = await agent_api.apost(session_path("/v1/perception/embeddings", session_id), json=payload, idempotent=True)
     if res.status_code != 200:
-        print(f"❌ Action failed: {res.text}")
-    return res.status_code == 200
+        print(f"❌ Failed to embed screen elements: {res.text}")
+        return None, None
+    data = res.json()
+    return data["marks_mapping"], data["embeddings"]
 
-def run_blueprint(blueprint_id: str, start_url: str):
-    yield f"[SYSTEM] 📥 Loading Blueprint {blueprint_id} from Memory..."
-    res = supabase.table("blueprints").select("state_graph_json").eq("id", blueprint_id).execute()
+async def acapture_marks(session_id: str = None):
+    # Marks of a fresh frame that stays cached in the sandbox (screenshot_id), without transferring the image
+    res = await agent_api.aget(session_path("/v1/perception/screenshot", session_id), params={"marks": "true", "image": "false"})
+    if res.status_code != 200:
+        print(f"❌ Failed to get screenshot: {res.text}")
+        return None, None
+    data = res.json()
+    return data["screenshot_id"], data["marks_mapping"]
+
+async def amatch_anchor(vector, box, session_id: str = None, threshold: float = VISUAL_MATCH_THRESHOLD):
+    # Ranks the screen's marks by geometry against the taught box, then embeds the best candidates in
+    # priority order until one is a confident match. Only if none of the top-K clears the visual threshold
+    # are the remaining marks embedded. Returns (marks, match, embedded_count); marks is None if the screen
+    # couldn't be captured, match is None if embedding the candidates failed.
+    screenshot_id, marks = await acapture_marks(session_id)
+    if not marks:
+        return None, None, 0
+    order = rank_by_geometry(box, marks)
+    vectors = {}
+    match = None
+    stages = [order[i:min(i + MATCH_BATCH_SIZE, MATCH_TOP_K)] for i in range(0, min(len(order), MATCH_TOP_K), MATCH_BATCH_SIZE)]
+    stages.append(order[MATCH_TOP_K:])
+    for index, batch in enumerate(stages):
+        if not batch:
+            continue
+        if index == len(stages) - 1 and match and match.best_score >= threshold:
+            break
+        _, embedded = await aget_mark_embeddings(screenshot_id, {mark_id: marks[mark_id] for mark_id in batch}, session_id)
+        if not embedded:
+            return marks, None, len(vectors)
+        vectors.update(embedded)
+        match = await asyncio.to_thread(rank_candidates, vector, vectors, 3)
+        if match.best_score >= EARLY_EXIT_SCORE and match.margin >= EARLY_EXIT_MARGIN:
+            break
+    return marks, match, len(vectors)
+
+def load_blueprint_steps(blueprint_id: str):
+    # (steps, version), or (None, None) if the blueprint doesn't exist
+    res = supabase.table("blueprints").select("state_graph_json, version").eq("id", blueprint_id).execute()
     if not res.data:
-        yield "[ERROR] ❌ Blueprint not found"
+        return None, None
+    return (res.data[0].get("state_graph_json") or {}).get("steps", []), res.data[0].get("version") or 1
+
+def load_blueprint_version(blueprint_id: str):
+    res = supabase.table("blueprints").select("version").eq("id", blueprint_id).execute()
+    if not res.data:
+        return None
+    return res.data[0].get("version") or 1
+
+def load_anchor_index(blueprint_id: str) -> dict:
+    # One query for every anchor of the blueprint; pgvector strings are parsed once here.
+    # label -> {"vector", "fingerprint", "box"}; fingerprint is None for anchors taught before DOM fingerprints.
+    res = supabase.table("visual_anchors").select("semantic_label, embedding, bounding_box_relative, dom_fingerprint").eq("blueprint_id", blueprint_id).execute()
+    index = {}
+    for row in res.data or []:
+        label = row["semantic_label"]
+        if label not in index and row.get("embedding") is not None:
+            index[label] = {
+                "vector": parse_vector(row["embedding"]),
+                "fingerprint": row.get("dom_fingerprint"),
+                "box": row.get("bounding_box_relative")
+            }
+    return index
+
+def search_anchors(embedding, blueprint_id: str = None, threshold: float = 0.9, limit: int = 5):
+    # Nearest-neighbour search in Postgres through the HNSW index (see match_visual_anchors in schema.sql)
+    res = supabase.rpc("match_visual_anchors", {
+        "query_embedding": [float(v) for v in embedding],
+        "match_threshold": threshold,
+        "match_count": limit,
+        "filter_blueprint_id": blueprint_id
+    }).execute()
+    return res.data or []
+
+def find_duplicate_anchor(vector, blueprint_id: str, fingerprint: dict, mark: dict, viewport: tuple = (1920, 1080)):
+    # Anchors are per blueprint, so only the blueprint's own anchors are candidates (an exact search, see
+    # match_visual_anchors). Returns the first look-alike at or above ANCHOR_DEDUPE_THRESHOLD confirmed to be
+    # the same element and how: "dom" or "position"; otherwise the closest look-alike (or None) and None.
+    # When both sides have a fingerprint the DOM decides; position only confirms anchors or elements without one.
+    candidates = search_anchors(vector, blueprint_id, ANCHOR_DEDUPE_THRESHOLD, limit=ANCHOR_DEDUPE_CANDIDATES)
+    for candidate in candidates:
+        if fingerprint and candidate.get("dom_fingerprint"):
+            if same_dom_element(fingerprint, candidate["dom_fingerprint"]):
+                return candidate, "dom"
+        elif same_position(candidate.get("bounding_box_relative"), mark, viewport):
+            return candidate, "position"
+    return (candidates[0] if candidates else None), None
+
+def store_anchor(blueprint_id: str, label: str, vector, mark: dict, fingerprint: dict = None, viewport: tuple = (1920, 1080)):
+    # Saves a taught element as a Visual Anchor, reusing an existing one only if the same element was already
+    # taught under this label (a look-alike never changes the user's label). A failed dedupe lookup only costs
+    # a duplicate row. Returns (reused, similar_anchor); similar_anchor describes the closest look-alike, if any.
+    try:
+        candidate, matched_by = find_duplicate_anchor(vector, blueprint_id, fingerprint, mark, viewport)
+    except Exception as e:
+        print(f"⚠️ Anchor library search failed, storing a new anchor: {e}")
+        candidate, matched_by = None, None
+    similar_anchor = None
+    if candidate:
+        similar_anchor = {"label": candidate["semantic_label"], "similarity": candidate["similarity"], "same_element": matched_by}
+        
+    if matched_by and candidate["semantic_label"] == label:
+        print(f"♻️ Reusing Visual Anchor '{label}' (similarity {candidate['similarity']:.3f}, same {matched_by})")
+        # Only fills in a missing fingerprint; a stored one is never overwritten
+        if fingerprint and not candidate.get("dom_fingerprint"):
+            try:
+                supabase.table("visual_anchors").update({"dom_fingerprint": fingerprint}).eq("id", candidate["id"]).is_("dom_fingerprint", "null").execute()
+            except Exception as e:
+                print(f"⚠️ Failed to store the DOM fingerprint: {e}")
+        return True, similar_anchor
+        
+    if candidate:
+        print(f"🔎 Looks like Visual Anchor '{candidate['semantic_label']}' (similarity {candidate['similarity']:.3f}), storing '{label}' separately")
+    supabase.table("visual_anchors").insert({
+        "blueprint_id": blueprint_id,
+        "semantic_label": label,
+        "embedding": [float(v) for v in vector],
+        "bounding_box_relative": {
+            "width_pct": mark.get("width", 10) / viewport[0],
+            "height_pct": mark.get("height", 10) / viewport[1],
+            # Taught center, for the executor's geometric candidate ranking
+            "x_pct": mark.get("x", 0) / viewport[0],
+            "y_pct": mark.get("y", 0) / viewport[1]
+        },
+        "dom_fingerprint": fingerprint
+    }).execute()
+    print(f"✅ Saved Visual Anchor '{label}' to DB.")
+    return False, similar_anchor
+
+async def aget_plan(blueprint_id: str):
+    # Compiled plan for the blueprint's current version: no DB reads while the cached version is within
+    # PLAN_VERSION_TTL, a one-column version read after that, and a full load and compile only when the
+    # blueprint changed. Returns (plan, source) with source "cache", "revalidated" or "compiled"; raises PlanError.
+    plan = plan_cache.fresh(blueprint_id)
+    if plan is not None:
+        return plan, "cache"
+    # The Supabase client is synchronous, so DB reads run in worker threads off the event loop
+    generation = plan_cache.generation(blueprint_id)
+    version = await asyncio.to_thread(load_blueprint_version, blueprint_id)
+    if version is None:
+        raise PlanError("Blueprint not found")
+    plan = plan_cache.get(blueprint_id, version)
+    if plan is not None:
+        return plan, "revalidated"
+        
+    steps, version = await asyncio.to_thread(load_blueprint_steps, blueprint_id)
+    if steps is None:
+        raise PlanError("Blueprint not found")
+    anchor_index = await asyncio.to_thread(load_anchor_index, blueprint_id) if steps else {}
+    plan = compile_plan(blueprint_id, version, steps, anchor_index, VISUAL_MATCH_THRESHOLD)
+    plan_cache.put(plan, generation)
+    return plan, "compiled"
+
+def invalidate_plan(blueprint_id: str):
+    # Called whenever a blueprint or its anchors are modified in this process
+    plan_cache.invalidate(blueprint_id)
+
+async def run_blueprint(blueprint_id: str, start_url: str, session_id: str = None, isolated: bool = False, input_profile: str = None):
+    # isolated=True runs in a fresh browser session of its own, so several blueprints can share one container.
+    # input_profile picks that session's input speed (the shared session keeps its own).
+    if not isolated:
+        async for log_line in run_blueprint_in_session(blueprint_id, start_url, session_id):
+            yield log_line
         return
         
-    state_graph = res.data[0].get("state_graph_json", {}).get("steps", [])
-    if not state_graph:
-        yield "[ERROR] ❌ Blueprint is empty"
+    session_id = (await acreate_session(session_id, input_profile))["session_id"]
+    yield f"[SYSTEM] 🧪 Running in isolated browser session {session_id}"
+    try:
+        async for log_line in run_blueprint_in_session(blueprint_id, start_url, session_id):
+            yield log_line
+    finally:
+        await aclose_session(session_id)
+
+async def run_blueprint_in_session(blueprint_id: str, start_url: str, session_id: str = None):
+    yield f"[SYSTEM] 📥 Loading Blueprint {blueprint_id} from Memory..."
+    try:
+        plan, source = await aget_plan(blueprint_id)
+    except PlanError as e:
+        yield f"[ERROR] ❌ {e}"
         return
+    yield f"[MEMORY] 🧠 Plan v{plan.version} ({source}): {len(plan.steps)} steps, {plan.anchor_count} visual anchors"
         
-    yield f"[SYSTEM] 🚀 Starting Execution Pipeline ({len(state_graph)} steps)"
-    execute_action("browser/navigate", {"url": start_url})
+    yield f"[SYSTEM] 🚀 Starting Execution Pipeline ({len(plan.steps)} steps)"
+    ok, settle = await aexecute_step({"action": "navigate", "url": start_url}, session_id)
+    if not ok:
+        yield f"[ERROR] ❌ Failed to open {start_url}"
+        return
+    yield describe_settle(settle)
     
-    for step in state_graph:
-        yield f"\n[SYSTEM] --- STEP {step['step']}: {step['action'].upper()} ---"
+    for step in plan.steps:
+        yield f"\n[SYSTEM] --- STEP {step.step}: {step.action.upper()} ---"
         
-        if step['action'] == 'type':
-            execute_action("keyboard/type", {"text": step['text']})
+        if step.action == 'type':
+            ok, settle = await aexecute_step({"action": "type", "text": step.text}, session_id)
+            if not ok:
+                yield "[ERROR] ❌ Typing failed. Execution halted."
+                break
+            yield describe_settle(settle)
             continue
             
-        elif step['action'] == 'click':
-            target_label = step['semantic_target']
-            yield f"[AGENT] 🔍 Searching for visual anchor: '{target_label}'"
+        elif step.action == 'click':
+            yield f"[AGENT] 🔍 Searching for visual anchor: '{step.target_label}'"
             
-            # Fetch anchor vector from Supabase
-            anchor_res = supabase.table("visual_anchors").select("embedding").eq("blueprint_id", blueprint_id).eq("semantic_label", target_label).limit(1).execute()
-            if not anchor_res.data:
-                yield f"[ERROR] ❌ Memory Error: Visual Anchor for '{target_label}' is missing from DB."
-                break
+            # DOM first: one batch that finds the taught element by its fingerprint and clicks it
+            if step.fingerprint:
+                performed, settle = await aclick_fingerprint(thaw(step.fingerprint), session_id)
+                if performed["status"] == "ok":
+                    match = performed["result"]["match"]
+                    yield f"[AGENT] 🧬 DOM match: Mark ID {match['mark_id']} (score {match['score']:.2f}, margin {match['margin']:.2f}, {match['considered']} candidates)"
+                    yield describe_settle(settle)
+                    continue
+                yield f"[AGENT] 🧬 DOM fingerprint not resolved ({performed.get('error')}), falling back to visual match"
                 
-            original_vector = anchor_res.data[0]['embedding']
-            
-            # Get current screen state
-            img_b64, marks = get_screenshot_and_marks()
-            if not img_b64 or not marks:
+            # Current screen state; geometry picks which marks are worth embedding (server-side, next to the browser)
+            marks, match, embedded = await amatch_anchor(step.vector, step.box, session_id, step.threshold)
+            if not marks:
                 yield "[ERROR] ❌ Failed to get screen context"
                 break
+            if not match:
+                yield f"[ERROR] ❌ Failed to embed candidate elements ({embedded} of {len(marks)} embedded)"
+                break
                 
-            yield f"[AGENT] 👁️ Analyzing {len(marks)} interactive elements on screen..."
+            yield f"[AGENT] 👁️ Embedded {embedded} of {len(marks)} interactive elements on screen (geometry-ranked)"
             
-            best_mark_id = None
-            best_sim = -1.0
-            
-            for mark_id, mark_info in marks.items():
-                crop_b64 = crop_image_around_mark(img_b64, mark_info)
-                curr_vector = get_embedding(crop_b64)
-                if curr_vector:
-                    sim = cosine_similarity(original_vector, curr_vector)
-                    if sim > best_sim:
-                        best_sim = sim
-                        best_mark_id = mark_id
+            best_mark_id, best_sim = match.best_id, match.best_score
                         
-            yield f"[MEMORY] 📊 Best match: Mark ID {best_mark_id} with similarity {best_sim:.2f}"
+            yield f"[MEMORY] 📊 Best match: Mark ID {best_mark_id} with similarity {best_sim:.2f} (margin {match.margin:.2f})"
             
-            if best_sim >= 0.70: # Relaxed visual threshold mapping
+            if best_sim >= step.threshold: # Relaxed visual threshold mapping
                 yield f"[AGENT] 🎯 Target Acquired! Clicking {best_mark_id}"
-                execute_action("mouse/click", {"x": marks[best_mark_id]['x'], "y": marks[best_mark_id]['y']})
+                ok, settle = await aexecute_step({"action": "click", "x": marks[best_mark_id]['x'], "y": marks[best_mark_id]['y']}, session_id)
+                if not ok:
+                    yield "[ERROR] ❌ Click failed. Execution halted."
+                    break
+                yield describe_settle(settle)
             else:
-                yield f"[ERROR] ❌ Visual drift detected. No element matched above threshold (0.70). Execution halted."
+                yield f"[ERROR] ❌ Visual drift detected. No element matched above threshold ({step.threshold:.2f}). Execution halted."
                 break
                 
     yield "\n[SYSTEM] ✅ Blueprint Execution Completed"
 
+async def print_blueprint_run(blueprint_id: str, start_url: str):
+    async for log_line in run_blueprint(blueprint_id, start_url):
+        print(log_line)
+
 def main():
     print("🤖 Welcome to the IsoMind Autonomous Executor")
     blueprint_id = input("Enter Blueprint UUID to execute: ").strip()
     start_url = input("Enter starting URL: ").strip()
     
     if blueprint_id and start_url:
-        run_blueprint(blueprint_id, start_url)
+        asyncio.run(print_blueprint_run(blueprint_id, start_url))
 
 if __name__ == "__main__":
     main()
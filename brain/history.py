@@ -0,0 +1,143 @@
+import os
+import json
+import time
+from collections import OrderedDict
+from http_client import vllm_server
+
+# Must match vLLM's --max-model-len
+CONTEXT_TOKENS = int(os.getenv("VLLM_MAX_MODEL_LEN", "4096"))
+# Most recent steps kept as full user/assistant turns; older ones are folded into one summary message,
+# HISTORY_FOLD_BLOCK steps at a time
+HISTORY_WINDOW = int(os.getenv("AGENT_HISTORY_WINDOW", "4"))
+HISTORY_FOLD_BLOCK = int(os.getenv("AGENT_HISTORY_FOLD_BLOCK", "4"))
+# Chat template tokens around each message (<|im_start|>role\n ... <|im_end|>\n)
+MESSAGE_OVERHEAD_TOKENS = 5
+
+class TokenCounter:
+    # Exact counts from vLLM's /tokenize (the served model's own tokenizer), cached per text.
+    # Falls back to a character estimate while the endpoint is unreachable and re-checks it after a minute.
+    def __init__(self, model: str, cache_size: int = 512):
+        self.model = model
+        self.cache_size = cache_size
+        self.cache: OrderedDict = OrderedDict()
+        self.retry_at = 0.0
+
+    def count(self, text: str) -> int:
+        if text in self.cache:
+            self.cache.move_to_end(text)
+            return self.cache[text]
+        tokens = None
+        if time.monotonic() >= self.retry_at:
+            try:
+                res = vllm_server.post("/tokenize", json={"model": self.model, "prompt": text, "add_special_tokens": False})
+                if res.status_code == 200:
+                    tokens = res.json()["count"]
+            except Exception:
+                pass
+            if tokens is None:
+                self.retry_at = time.monotonic() + 60
+        if tokens is None:
+            # Roughly 3.5 characters per token for English text and JSON
+            return len(text) * 2 // 7 + 1
+        self.cache[text] = tokens
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return tokens
+
+    def count_messages(self, messages: list) -> int:
+        # Text parts only; image tokens are budgeted separately by the caller
+        total = 0
+        for message in messages:
+            content = message["content"]
+            if isinstance(content, list):
+                content = "".join(part.get("text", "") for part in content)
+            total += self.count(content) + MESSAGE_OVERHEAD_TOKENS
+        return total
+
+def describe_action(action: dict) -> str:
+    kind = action.get("action")
+    if kind == "navigate":
+        return f"navigate to {action.get('url')}"
+    if kind == "click":
+        if "mark_id" in action:
+            return f"click mark {action['mark_id']}"
+        return f"click at ({action.get('x')}, {action.get('y')})"
+    if kind == "type":
+        return f"type {json.dumps(action.get('text'))}"
+    return json.dumps(action)
+
+class AgentHistory:
+    # Bounded conversation memory for the agent loop. The last `window` steps go out as full turns,
+    # everything older as one line each in a summary message, and the whole thing is trimmed to a token
+    # budget, so the prompt stays the same size however long the task runs.
+    # Steps are folded (and, over budget, dropped from the summary) `block` at a time, so everything after
+    # the unchanged system prompt stays byte-identical for several steps and vLLM's prefix cache keeps hitting.
+    # Messages strictly alternate user/assistant; the list ends with a user message (the last step's result)
+    # that the caller merges into the current turn.
+    def __init__(self, counter: TokenCounter, window: int = HISTORY_WINDOW, block: int = HISTORY_FOLD_BLOCK):
+        self.counter = counter
+        self.window = window
+        self.block = max(1, block)
+        self.steps = []
+        self.last_tokens = 0
+
+    def record(self, step: int, action: dict):
+        self.steps.append({"step": step, "action": action, "outcome": None})
+
+    def record_outcome(self, outcome: str):
+        if self.steps:
+            self.steps[-1]["outcome"] = outcome
+
+    def summary_line(self, entry: dict) -> str:
+        return f"{entry['step']}. {describe_action(entry['action'])} -> {entry['outcome'] or 'unknown'}"
+
+    def summary_message(self, steps: list, omitted: int = 0):
+        if not steps and not omitted:
+            return None
+        lines = ["Earlier steps:"]
+        if omitted:
+            lines.append(f"({omitted} earlier steps omitted)")
+        lines.extend(self.summary_line(entry) for entry in steps)
+        return {"role": "user", "content": "\n".join(lines)}
+
+    def turn_messages(self, entry: dict) -> list:
+        return [
+            {"role": "user", "content": f"Step {entry['step']}: [Screenshot submitted previously]"},
+            {"role": "assistant", "content": json.dumps(entry["action"])},
+            {"role": "user", "content": f"Result of step {entry['step']}: {entry['outcome'] or 'unknown'}"}
+        ]
+
+    def build(self, recent: list, summarized: list, omitted: int) -> list:
+        messages = []
+        summary = self.summary_message(summarized, omitted)
+        if summary:
+            messages.append(summary)
+        for entry in recent:
+            for message in self.turn_messages(entry):
+                # A step's result opens the next step's user turn (and the summary the first one)
+                if messages and messages[-1]["role"] == message["role"] == "user":
+                    messages[-1] = {"role": "user", "content": messages[-1]["content"] + "\n" + message["content"]}
+                else:
+                    messages.append(message)
+        return messages
+
+    def messages(self, budget: int) -> list:
+        # Drop the oldest summary lines first, then fold the oldest full turns into the summary.
+        # Lines and turns are counted separately (and cached), so only new steps hit /tokenize.
+        line_tokens = [self.counter.count(self.summary_line(entry)) + 1 for entry in self.steps]
+        turn_tokens = [self.counter.count_messages(self.turn_messages(entry)) for entry in self.steps]
+        header_tokens = self.counter.count("Earlier steps:\n(0 earlier steps omitted)") + MESSAGE_OVERHEAD_TOKENS
+        split = max(0, len(self.steps) - self.window) // self.block * self.block
+        omitted = 0
+        while True:
+            total = sum(line_tokens[omitted:split]) + sum(turn_tokens[split:])
+            if split:
+                total += header_tokens
+            if total <= budget or omitted >= len(self.steps):
+                break
+            if omitted < split:
+                omitted = min(split, omitted + self.block)
+            else:
+                split = min(len(self.steps), split + self.block)
+        self.last_tokens = total
+        return self.build(self.steps[split:], self.steps[omitted:split], omitted)
@@ -0,0 +1,303 @@
+import os
+import json
+import gzip
+import time
+import random
+import asyncio
+from collections import deque
+import requests
+import httpx
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# All sandbox services are reached through the SSH tunnel on localhost
+AGENT_API_URL = os.getenv("AGENT_API_URL", "http://localhost:8000")
+EMBEDDING_API_URL = os.getenv("EMBEDDING_API_URL", "http://localhost:8002")
+VLLM_API_URL = os.getenv("VLLM_API_URL", "http://localhost:8001/v1")
+
+# Gateway-style failures worth retrying for idempotent calls
+RETRYABLE_STATUS = {502, 503, 504}
+
+class _RetryableStatus(Exception):
+    def __init__(self, status_code: int):
+        super().__init__(f"HTTP {status_code}")
+        self.status_code = status_code
+
+def _is_connect_error(exc: Exception) -> bool:
+    # True when the request provably never reached the server, so even a POST is safe to resend
+    if isinstance(exc, (httpx.ConnectError, httpx.ConnectTimeout, requests.exceptions.ConnectTimeout)):
+        return True
+    if isinstance(exc, requests.exceptions.ConnectionError) and exc.args:
+        reason = getattr(exc.args[0], "reason", None)
+        return isinstance(reason, NewConnectionError)
+    return False
+
+def _is_retryable_error(exc: Exception, idempotent: bool) -> bool:
+    if _is_connect_error(exc):
+        return True
+    if not idempotent:
+        return False
+    return isinstance(exc, (requests.exceptions.ConnectionError, requests.exceptions.Timeout, httpx.TransportError))
+
+class ServiceClient:
+    # Keep-alive HTTP client for one sandbox service, in sync (requests) and async (httpx) flavours.
+    # Every call gets the service timeout, bounded retries with jittered backoff, and latency capture.
+    def __init__(self, name: str, base_url: str, timeout: float, retries: int = 2, backoff: float = 0.25, pool_size: int = 20):
+        self.name = name
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.pool_size = pool_size
+        self.latencies = deque(maxlen=500)
+        self._session = None
+        self._async_client = None
+        self._async_loop = None
+        self._async_closer = None
+
+    @property
+    def session(self) -> requests.Session:
+        if self._session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            self._session = session
+        return self._session
+
+    @property
+    def async_client(self) -> httpx.AsyncClient:
+        # httpx clients are bound to the event loop they were first used on, so a new loop gets a new client.
+        # Each one is closed on its own loop: when it is replaced, or when the loop shuts down (asyncio.run and
+        # uvicorn cancel pending tasks before closing the loop), so a loop change never strands its pool.
+        loop = asyncio.get_running_loop()
+        if self._async_client is None or self._async_loop is not loop:
+            if self._async_closer is not None and not self._async_loop.is_closed():
+                self._async_loop.call_soon_threadsafe(self._async_closer.cancel)
+            self._async_client = httpx.AsyncClient(
+                timeout=self.timeout,
+                limits=httpx.Limits(max_connections=self.pool_size * 2, max_keepalive_connections=self.pool_size)
+            )
+            self._async_loop = loop
+            self._async_closer = loop.create_task(self._close_with_loop(self._async_client))
+        return self._async_client
+
+    async def _close_with_loop(self, client: httpx.AsyncClient):
+        try:
+            await asyncio.Future()
+        finally:
+            await client.aclose()
+
+    def url(self, path: str) -> str:
+        return f"{self.base_url}{path}"
+
+    def _sleep_for(self, attempt: int) -> float:
+        return self.backoff * (2 ** attempt) * random.uniform(0.5, 1.5)
+
+    def record(self, method: str, path: str, status, elapsed_ms: float, attempts: int = 1):
+        self.latencies.append({
+            "method": method,
+            "path": path,
+            "status": status,
+            "elapsed_ms": round(elapsed_ms, 1),
+            "attempts": attempts
+        })
+
+    def request(self, method: str, path: str, timeout: float = None, retries: int = None, idempotent: bool = None, **kwargs) -> requests.Response:
+        retries = self.retries if retries is None else retries
+        idempotent = method.upper() == "GET" if idempotent is None else idempotent
+        start = time.perf_counter()
+        attempt = 0
+        while True:
+            try:
+                res = self.session.request(method, self.url(path), timeout=timeout or self.timeout, **kwargs)
+                if idempotent and res.status_code in RETRYABLE_STATUS and attempt < retries:
+                    raise _RetryableStatus(res.status_code)
+                self.record(method, path, res.status_code, (time.perf_counter() - start) * 1000, attempt + 1)
+                return res
+            except Exception as e:
+                if attempt >= retries or not (isinstance(e, _RetryableStatus) or _is_retryable_error(e, idempotent)):
+                    self.record(method, path, getattr(e, "status_code", None), (time.perf_counter() - start) * 1000, attempt + 1)
+                    raise
+                time.sleep(self._sleep_for(attempt))
+                attempt += 1
+
+    async def arequest(self, method: str, path: str, timeout: float = None, retries: int = None, idempotent: bool = None, **kwargs) -> httpx.Response:
+        retries = self.retries if retries is None else retries
+        idempotent = method.upper() == "GET" if idempotent is None else idempotent
+        start = time.perf_counter()
+        attempt = 0
+        while True:
+            try:
+                res = await self.async_client.request(method, self.url(path), timeout=timeout or self.timeout, **kwargs)
+                if idempotent and res.status_code in RETRYABLE_STATUS and attempt < retries:
+                    raise _RetryableStatus(res.status_code)
+                self.record(method, path, res.status_code, (time.perf_counter() - start) * 1000, attempt + 1)
+                return res
+            except Exception as e:
+                if attempt >= retries or not (isinstance(e, _RetryableStatus) or _is_retryable_error(e, idempotent)):
+                    self.record(method, path, getattr(e, "status_code", None), (time.perf_counter() - start) * 1000, attempt + 1)
+                    raise
+                await asyncio.sleep(self._sleep_for(attempt))
+                attempt += 1
+
+    def get(self, path: str, **kwargs) -> requests.Response:
+        return self.request("GET", path, **kwargs)
+
+    def post(self, path: str, **kwargs) -> requests.Response:
+        return self.request("POST", path, **kwargs)
+
+    async def aget(self, path: str, **kwargs) -> httpx.Response:
+        return await self.arequest("GET", path, **kwargs)
+
+    async def apost(self, path: str, **kwargs) -> httpx.Response:
+        return await self.arequest("POST", path, **kwargs)
+
+    def stats(self) -> dict:
+        samples = sorted(entry["elapsed_ms"] for entry in self.latencies)
+        if not samples:
+            return {"calls": 0}
+        return {
+            "calls": len(samples),
+            "p50_ms": samples[len(samples) // 2],
+            "p95_ms": samples[min(len(samples) - 1, int(len(samples) * 0.95))],
+            "max_ms": samples[-1],
+            "retried_calls": sum(1 for entry in self.latencies if entry["attempts"] > 1),
+            "last": self.latencies[-1]
+        }
+
+    async def aclose(self):
+        if self._async_client is not None:
+            self._async_closer.cancel()
+            await self._async_client.aclose()
+            self._async_client = None
+            self._async_closer = None
+        if self._session is not None:
+            self._session.close()
+            self._session = None
+
+agent_api = ServiceClient("agent_api", AGENT_API_URL, timeout=float(os.getenv("AGENT_API_TIMEOUT", "30")))
+embedding_api = ServiceClient("embedding_api", EMBEDDING_API_URL, timeout=float(os.getenv("EMBEDDING_API_TIMEOUT", "60")))
+vllm_api = ServiceClient("vllm", VLLM_API_URL, timeout=float(os.getenv("VLLM_API_TIMEOUT", "120")), retries=1)
+# vLLM's tokenizer endpoint (/tokenize) lives at the server root, outside the OpenAI-compatible /v1 prefix
+VLLM_SERVER_URL = os.getenv("VLLM_SERVER_URL", VLLM_API_URL.rstrip("/").removesuffix("/v1"))
+vllm_server = ServiceClient("vllm_server", VLLM_SERVER_URL, timeout=float(os.getenv("VLLM_TOKENIZE_TIMEOUT", "5")), retries=0)
+
+ALL_CLIENTS = [agent_api, embedding_api, vllm_api, vllm_server]
+
+def session_path(path: str, session_id: str = None) -> str:
+    # Agent API routes for a non-default browser session: /v1/... -> /v1/sessions/{session_id}/...
+    if not session_id:
+        return path
+    return f"/v1/sessions/{session_id}{path[len('/v1'):]}"
+
+async def acreate_session(session_id: str = None, input_profile: str = None) -> dict:
+    # New isolated browser context on the Agent API; 429 when the container is at its session cap.
+    # input_profile (stealth | balanced | fast) sets how humanized the session's clicks and typing are.
+    res = await agent_api.apost("/v1/sessions", json={"session_id": session_id, "input_profile": input_profile})
+    res.raise_for_status()
+    return res.json()
+
+async def aclose_session(session_id: str):
+    res = await agent_api.arequest("DELETE", f"/v1/sessions/{session_id}", idempotent=True)
+    if res.status_code not in (200, 404):
+        res.raise_for_status()
+
+def decode_multipart(content: bytes, content_type: str):
+    # Parses the Agent API's multipart/mixed responses (JSON metadata part + raw image parts)
+    # using each part's Content-Length, so image bytes are sliced out once and never base64-encoded.
+    if "boundary=" not in content_type:
+        raise ValueError(f"Not a multipart response: {content_type}")
+    boundary = content_type.split("boundary=", 1)[1].split(";", 1)[0].strip().strip('"').encode("ascii")
+    view = memoryview(content)
+    parts = []
+    pos = content.index(b"--" + boundary)
+    while True:
+        pos += len(boundary) + 2
+        if content[pos:pos + 2] == b"--":
+            break
+        header_end = content.index(b"\r\n\r\n", pos)
+        headers = {}
+        for line in content[pos:header_end].decode("ascii").strip().split("\r\n"):
+            name, value = line.split(":", 1)
+            headers[name.strip().lower()] = value.strip()
+        body_start = header_end + 4
+        body_end = body_start + int(headers["content-length"])
+        parts.append((headers, view[body_start:body_end]))
+        pos = content.index(b"--" + boundary, body_end)
+        
+    meta_headers, meta_body = parts[0]
+    meta_bytes = bytes(meta_body)
+    if meta_headers.get("content-encoding") == "gzip":
+        meta_bytes = gzip.decompress(meta_bytes)
+    meta = json.loads(meta_bytes)
+    if len(parts) > 1:
+        meta["media_type"] = parts[1][0].get("content-type")
+    return meta, [bytes(body) for _, body in parts[1:]]
+
+def decode_frame(content: bytes, content_type: str):
+    meta, images = decode_multipart(content, content_type)
+    return images[0], meta
+
+def _frame_params(marks: bool, params: dict) -> dict:
+    return {"marks": str(marks).lower(), "transport": "binary", "compress": "true", **params}
+
+def get_frame(marks: bool = True, session_id: str = None, **params):
+    # Screenshot as raw image bytes plus metadata (screenshot_id, marks_mapping, media_type)
+    res = agent_api.get(session_path("/v1/perception/screenshot", session_id), params=_frame_params(marks, params))
+    res.raise_for_status()
+    return decode_frame(res.content, res.headers["content-type"])
+
+async def aget_frame(marks: bool = True, session_id: str = None, **params):
+    res = await agent_api.aget(session_path("/v1/perception/screenshot", session_id), params=_frame_params(marks, params))
+    res.raise_for_status()
+    return decode_frame(res.content, res.headers["content-type"])
+
+def get_page_version(hash: bool = False, session_id: str = None) -> dict:
+    # {"version": token, "frame_hash": ...}; equal tokens mean the page hasn't changed
+    res = agent_api.get(session_path("/v1/perception/version", session_id), params={"hash": str(hash).lower()})
+    res.raise_for_status()
+    return res.json()
+
+def _batch_timeout(actions: list) -> float:
+    # Server-side waits count against the request timeout
+    waits = sum((action.get("wait") or {}).get("timeout_ms", 5000) for action in actions if action["action"] == "wait")
+    return agent_api.timeout + waits / 1000
+
+def _batch_payload(actions: list, stop_on_error: bool) -> dict:
+    return {"actions": actions, "stop_on_error": stop_on_error, "transport": "binary", "compress": True}
+
+def _decode_batch(res):
+    res.raise_for_status()
+    if res.headers.get("content-type", "").startswith("multipart/"):
+        return decode_multipart(res.content, res.headers["content-type"])
+    return res.json(), []
+
+def run_batch(actions: list, session_id: str = None, stop_on_error: bool = True):
+    # Ordered actions (navigate, click, type, key, scroll, wait, evaluate, screenshot) in one round-trip.
+    # Returns (meta, images): meta["results"] has one entry per action; screenshot results point into images via image_index.
+    res = agent_api.post(session_path("/v1/action/batch", session_id), json=_batch_payload(actions, stop_on_error), timeout=_batch_timeout(actions))
+    return _decode_batch(res)
+
+async def arun_batch(actions: list, session_id: str = None, stop_on_error: bool = True):
+    res = await agent_api.apost(session_path("/v1/action/batch", session_id), json=_batch_payload(actions, stop_on_error), timeout=_batch_timeout(actions))
+    return _decode_batch(res)
+
+def get_fingerprints(mark_ids: list, session_id: str = None) -> dict:
+    # mark_id -> DOM fingerprint (tag, role, name, text, attrs, path) of the live element
+    res = agent_api.post(session_path("/v1/perception/fingerprint", session_id), json={"mark_ids": [str(m) for m in mark_ids]}, idempotent=True)
+    res.raise_for_status()
+    return res.json()["fingerprints"]
+
+def openai_http_client() -> httpx.Client:
+    # Pooled transport for the OpenAI SDK pointed at vLLM; the SDK handles its own retries
+    return httpx.Client(
+        timeout=vllm_api.timeout,
+        limits=httpx.Limits(max_connections=vllm_api.pool_size, max_keepalive_connections=vllm_api.pool_size)
+    )
+
+def latency_report() -> dict:
+    return {client.name: client.stats() for client in ALL_CLIENTS}
@@ -0,0 +1,94 @@
+import json
+import math
+from dataclasses import dataclass, field
+import numpy as np
+
+@dataclass
+class MatchResult:
+    # Candidates ordered best-first as (mark_id, cosine similarity)
+    ranked: list = field(default_factory=list)
+    # Gap between the best and second-best score (1.0 when there is a single candidate)
+    margin: float = 0.0
+
+    @property
+    def best_id(self):
+        return self.ranked[0][0] if self.ranked else None
+
+    @property
+    def best_score(self) -> float:
+        return self.ranked[0][1] if self.ranked else -1.0
+
+def parse_vector(vector) -> np.ndarray:
+    # pgvector columns come back from Supabase as '[0.1,0.2,...]' strings
+    if isinstance(vector, str):
+        vector = json.loads(vector)
+    return np.asarray(vector, dtype=np.float32)
+
+def normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+def rank_candidates(anchor, candidates: dict, top_k: int = 5) -> MatchResult:
+    # candidates: mark_id -> embedding. Scores every candidate in one matrix-vector product.
+    if not candidates:
+        return MatchResult()
+
+    ids = list(candidates.keys())
+    matrix = normalize_rows(np.stack([parse_vector(v) for v in candidates.values()]))
+    query = normalize_rows(parse_vector(anchor))
+    scores = matrix @ query
+
+    # Always rank at least two so the margin is meaningful even for top_k=1
+    k = min(max(top_k, 2), len(ids))
+    top = np.argpartition(-scores, k - 1)[:k]
+    top = top[np.argsort(-scores[top])]
+
+    ranked = [(ids[i], float(scores[i])) for i in top]
+    margin = ranked[0][1] - ranked[1][1] if len(ranked) > 1 else 1.0
+    return MatchResult(ranked=ranked[:top_k], margin=margin)
+
+# Weights of the geometric prefilter; position only counts for anchors taught with x_pct/y_pct
+GEOMETRY_WEIGHTS = {"size": 0.4, "aspect": 0.3, "position": 0.3}
+
+def _ratio(a: float, b: float) -> float:
+    return min(a, b) / max(a, b) if a > 0 and b > 0 else 0.0
+
+def geometry_score(box: dict, mark: dict, viewport: tuple = (1920, 1080)) -> float:
+    # 0-1 plausibility of `mark` being the taught element, from its size, aspect ratio and distance
+    # to the taught position (box is an anchor's bounding_box_relative, viewport fractions)
+    width, height = mark["width"] / viewport[0], mark["height"] / viewport[1]
+    scores = {
+        "size": _ratio(width * height, box["width_pct"] * box["height_pct"]),
+        "aspect": _ratio(width / height if height else 0.0, box["width_pct"] / box["height_pct"] if box["height_pct"] else 0.0)
+    }
+    if box.get("x_pct") is not None and box.get("y_pct") is not None:
+        distance = math.hypot(mark["x"] / viewport[0] - box["x_pct"], mark["y"] / viewport[1] - box["y_pct"])
+        # Half a screen away or more scores zero
+        scores["position"] = max(0.0, 1.0 - distance / 0.5)
+    total = sum(GEOMETRY_WEIGHTS[name] for name in scores)
+    return sum(GEOMETRY_WEIGHTS[name] * score for name, score in scores.items()) / total
+
+def rank_by_geometry(box: dict, marks: dict, viewport: tuple = (1920, 1080)) -> list:
+    # Mark ids best-first by geometry_score; original order when the anchor has no stored box
+    if not box or not box.get("width_pct") or not box.get("height_pct"):
+        return list(marks.keys())
+    return sorted(marks, key=lambda mark_id: geometry_score(box, marks[mark_id], viewport), reverse=True)
+
+# A newly taught element that merely looks like an existing anchor (e.g. one of several identical
+# "Add to cart" buttons) is only merged with it when it is the same DOM element or at the same place
+DEDUPE_POSITION_TOLERANCE = 0.02
+DOM_IDENTITY_KEYS = ("tag", "role", "name", "path", "attrs")
+
+def same_dom_element(fingerprint: dict, other: dict) -> bool:
+    if not fingerprint or not other:
+        return False
+    return all(fingerprint.get(key) == other.get(key) for key in DOM_IDENTITY_KEYS)
+
+def same_position(box: dict, mark: dict, viewport: tuple = (1920, 1080), tolerance: float = DEDUPE_POSITION_TOLERANCE) -> bool:
+    # Taught center within `tolerance` (viewport fractions) of the mark's, at a similar size
+    if not box or box.get("x_pct") is None or box.get("y_pct") is None:
+        return False
+    distance = math.hypot(mark["x"] / viewport[0] - box["x_pct"], mark["y"] / viewport[1] - box["y_pct"])
+    area = (mark["width"] / viewport[0]) * (mark["height"] / viewport[1])
+    return distance <= tolerance and _ratio(area, box.get("width_pct", 0) * box.get("height_pct", 0)) >= 0.8
@@ -0,0 +1,156 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from types import MappingProxyType
+
+# Compiled plans kept in-process, and how long a cached blueprint version is trusted before it is re-checked
+# against the database (covers edits made outside this process, e.g. by the CLI teacher)
+PLAN_CACHE_SIZE = int(os.getenv("PLAN_CACHE_SIZE", "64"))
+PLAN_VERSION_TTL = float(os.getenv("PLAN_VERSION_TTL", "30"))
+
+class PlanError(ValueError):
+    pass
+
+def freeze(value):
+    # Read-only view of JSON data: dicts become mapping proxies, lists tuples
+    if isinstance(value, dict):
+        return MappingProxyType({key: freeze(item) for key, item in value.items()})
+    if isinstance(value, list):
+        return tuple(freeze(item) for item in value)
+    return value
+
+def thaw(value):
+    # Plain JSON-serializable copy of frozen data, e.g. for request payloads
+    if isinstance(value, MappingProxyType):
+        return {key: thaw(item) for key, item in value.items()}
+    if isinstance(value, tuple):
+        return [thaw(item) for item in value]
+    return value
+
+@dataclass(frozen=True)
+class CompiledStep:
+    step: int
+    action: str
+    text: str = None
+    target_label: str = None
+    # Anchor data for click steps: read-only CLIP vector, DOM fingerprint and taught box (frozen JSON)
+    vector: object = None
+    fingerprint: object = None
+    box: object = None
+    threshold: float = 0.70
+
+@dataclass(frozen=True)
+class CompiledPlan:
+    blueprint_id: str
+    version: int
+    steps: tuple
+    anchor_count: int
+    compiled_at: float
+
+def compile_plan(blueprint_id: str, version: int, steps: list, anchor_index: dict, threshold: float) -> CompiledPlan:
+    # Validates the step graph against the anchors once; raises PlanError with the same messages the
+    # executor used to emit step by step
+    if not steps:
+        raise PlanError("Blueprint is empty")
+    for position, step in enumerate(steps, 1):
+        action = step.get("action") if isinstance(step, dict) else None
+        if action not in ("click", "type"):
+            number = step.get("step", position) if isinstance(step, dict) else position
+            raise PlanError(f"Unknown action '{action}' in step {number}" if action else f"Step {number} has no action")
+    missing_labels = sorted(set(
+        str(step.get("semantic_target")) for step in steps if step["action"] == "click" and step.get("semantic_target") not in anchor_index
+    ))
+    if missing_labels:
+        raise PlanError(f"Memory Error: Visual Anchors missing from DB: {', '.join(missing_labels)}")
+
+    compiled = []
+    for position, step in enumerate(steps, 1):
+        number = step.get("step", position)
+        if step["action"] == "type":
+            compiled.append(CompiledStep(step=number, action="type", text=step.get("text") or ""))
+        else:
+            anchor = anchor_index[step["semantic_target"]]
+            vector = anchor["vector"]
+            vector.flags.writeable = False
+            compiled.append(CompiledStep(
+                step=number,
+                action="click",
+                target_label=step["semantic_target"],
+                vector=vector,
+                fingerprint=freeze(anchor["fingerprint"]),
+                box=freeze(anchor["box"]),
+                threshold=threshold
+            ))
+    return CompiledPlan(
+        blueprint_id=blueprint_id,
+        version=version,
+        steps=tuple(compiled),
+        anchor_count=len(anchor_index),
+        compiled_at=time.time()
+    )
+
+class PlanCache:
+    # LRU of compiled plans keyed by (blueprint_id, version), plus the latest version seen per blueprint
+    # and when it was last confirmed. Shared by the event loop and teach_action's worker threads.
+    # Each invalidation bumps the blueprint's generation, so a plan compiled from reads that started
+    # before the invalidation is never cached.
+    def __init__(self, size: int = PLAN_CACHE_SIZE, version_ttl: float = PLAN_VERSION_TTL):
+        self.size = size
+        self.version_ttl = version_ttl
+        self.plans: OrderedDict = OrderedDict()
+        self.latest: dict = {}
+        self.generations: dict = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def fresh(self, blueprint_id: str):
+        # The cached plan for the latest known version, if that version was confirmed within the TTL
+        with self.lock:
+            latest = self.latest.get(blueprint_id)
+            if latest is None or time.monotonic() - latest[1] > self.version_ttl or (blueprint_id, latest[0]) not in self.plans:
+                return None
+            return self._get((blueprint_id, latest[0]))
+
+    def get(self, blueprint_id: str, version: int):
+        with self.lock:
+            self.latest[blueprint_id] = (version, time.monotonic())
+            return self._get((blueprint_id, version))
+
+    def _get(self, key):
+        plan = self.plans.get(key)
+        if plan is None:
+            self.misses += 1
+            return None
+        self.plans.move_to_end(key)
+        self.hits += 1
+        return plan
+
+    def generation(self, blueprint_id: str) -> int:
+        with self.lock:
+            return self.generations.get(blueprint_id, 0)
+
+    def put(self, plan: CompiledPlan, generation: int):
+        with self.lock:
+            if self.generations.get(plan.blueprint_id, 0) != generation:
+                return
+            self.plans[(plan.blueprint_id, plan.version)] = plan
+            self.plans.move_to_end((plan.blueprint_id, plan.version))
+            self.latest[plan.blueprint_id] = (plan.version, time.monotonic())
+            while len(self.plans) > self.size:
+                (blueprint_id, _), _ = self.plans.popitem(last=False)
+                if not any(key[0] == blueprint_id for key in self.plans):
+                    self.latest.pop(blueprint_id, None)
+
+    def invalidate(self, blueprint_id: str):
+        with self.lock:
+            for key in [key for key in self.plans if key[0] == blueprint_id]:
+                del self.plans[key]
+            self.latest.pop(blueprint_id, None)
+            self.generations[blueprint_id] = self.generations.get(blueprint_id, 0) + 1
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"plans": len(self.plans), "size": self.size, "hits": self.hits, "misses": self.misses}
@@ -1,17 +1,15 @@
 import os
-import requests
 import base64
 import json
 from io import BytesIO
 from PIL import Image
 from dotenv import load_dotenv
 from supabase import create_client, Client
+from http_client import embedding_api, get_frame, run_batch, get_fingerprints
+from executor import store_anchor
 
 load_dotenv()
 
-AGENT_API_URL = os.getenv("AGENT_API_URL", "http://localhost:8000")
-EMBEDDING_API_URL = os.getenv("EMBEDDING_API_URL", "http://localhost:8002")
-VLLM_API_URL = os.getenv("VLLM_API_URL", "http://localhost:8001/v1")
 SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_KEY = os.getenv("SUPABASE_KEY")
 
@@ -25,31 +23,26 @@ supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
 def get_screenshot_and_marks():
     print("📸 Capturing browser state...")
     try:
-        res = requests.get(f"{AGENT_API_URL}/v1/perception/screenshot?marks=true")
-        if res.status_code != 200:
-            print(f"❌ Failed to get screenshot: {res.text}")
-            return None, None
-        data = res.json()
-        return data["image_base64"], data["marks_mapping"]
+        image_bytes, meta = get_frame(marks=True)
+        return image_bytes, meta["marks_mapping"]
     except Exception as e:
         print(f"❌ Connection error to Agent API: {e}")
         return None, None
 
-def get_embedding(image_base64: str):
-    print("🧠 Generating CLIP embedding vector...")
+def get_embeddings(images_base64: list):
+    print(f"🧠 Generating {len(images_base64)} CLIP embedding vector(s)...")
     try:
-        res = requests.post(f"{EMBEDDING_API_URL}/v1/embed/image", json={"image_base64": image_base64})
+        res = embedding_api.post("/v1/embed/images", json={"images_base64": images_base64}, idempotent=True)
         if res.status_code != 200:
-            print(f"❌ Failed to generate embedding: {res.text}")
+            print(f"❌ Failed to generate embeddings: {res.text}")
             return None
-        return res.json()["embedding"]
+        return res.json()["embeddings"]
     except Exception as e:
         print(f"❌ Connection error to Embedding API: {e}")
         return None
 
-def crop_image_around_mark(image_base64: str, mark_info: dict, crop_size=100):
-    img_data = base64.b64decode(image_base64)
-    img = Image.open(BytesIO(img_data))
+def crop_image_around_mark(image_bytes: bytes, mark_info: dict, crop_size=100):
+    img = Image.open(BytesIO(image_bytes))
     
     x = mark_info["x"]
     y = mark_info["y"]
@@ -66,13 +59,22 @@ def crop_image_around_mark(image_base64: str, mark_info: dict, crop_size=100):
     cropped.save(buffered, format="PNG")
     return base64.b64encode(buffered.getvalue()).decode("utf-8")
 
+def get_fingerprint(mark_id: str):
+    try:
+        return get_fingerprints([mark_id]).get(str(mark_id))
+    except Exception as e:
+        print(f"⚠️ Failed to fingerprint Mark {mark_id}, anchor will be visual-only: {e}")
+        return None
+
 def execute_action(action: str, payload: dict):
+    # The action plus a settle wait in one batch, so the next screenshot shows the result
     print(f"🛠️ Executing {action}...")
     try:
-        res = requests.post(f"{AGENT_API_URL}/v1/action/{action}", json=payload)
-        if res.status_code != 200:
-            print(f"❌ Action failed: {res.text}")
-        return res.status_code == 200
+        meta, _ = run_batch([{"action": action, **payload}, {"action": "wait"}])
+        performed = meta["results"][0]
+        if performed["status"] != "ok":
+            print(f"❌ Action failed: {performed.get('error')}")
+        return performed["status"] == "ok"
     except Exception as e:
         print(f"❌ Request failed: {e}")
         return False
@@ -103,19 +105,19 @@ def main():
         
     start_url = input("Enter starting URL: ").strip()
     if start_url:
-        execute_action("browser/navigate", {"url": start_url})
+        execute_action("navigate", {"url": start_url})
     
     step_num = 1
     state_graph = []
     
     while True:
         print(f"\n--- Blueprint Step {step_num} ---")
-        img_b64, marks = get_screenshot_and_marks()
-        if not img_b64:
+        img_bytes, marks = get_screenshot_and_marks()
+        if not img_bytes:
             break
             
         with open("teacher_view.png", "wb") as f:
-            f.write(base64.b64decode(img_b64))
+            f.write(img_bytes)
         print("🖼️ Saved current view to teacher_view.png. Please open it to see Mark IDs.")
         
         action = input("Enter action ('click', 'type', or 'done'): ").strip().lower()
@@ -135,27 +137,19 @@ def main():
             semantic_label = input(f"Enter semantic label for Mark ID {mark_id} (e.g. 'Search Bar'): ").strip()
             
             # Crop, Embed, Store
-            crop_b64 = crop_image_around_mark(img_b64, mark)
+            crop_b64 = crop_image_around_mark(img_bytes, mark)
             with open("last_crop.png", "wb") as f:
                 f.write(base64.b64decode(crop_b64))
                 
-            vector = get_embedding(crop_b64)
-            if not vector:
+            vectors = get_embeddings([crop_b64])
+            if not vectors:
                 continue
+            vector = vectors[0]
+            fingerprint = get_fingerprint(mark_id)
                 
-            rel_box = {
-                "width_pct": mark["width"] / 1920,
-                "height_pct": mark["height"] / 1080
-            }
-            
+            # Reuse an existing anchor only if this same element was already taught under this label
             try:
-                supabase.table("visual_anchors").insert({
-                    "blueprint_id": blueprint_id,
-                    "semantic_label": semantic_label,
-                    "embedding": vector,
-                    "bounding_box_relative": rel_box
-                }).execute()
-                print(f"✅ Saved Visual Anchor '{semantic_label}' to DB.")
+                store_anchor(blueprint_id, semantic_label, vector, mark, fingerprint)
             except Exception as e:
                 print(f"❌ Supabase store error: {e}")
                 
@@ -165,7 +159,7 @@ def main():
                 "semantic_target": semantic_label
             })
             
-            execute_action("mouse/click", {"x": mark["x"], "y": mark["y"]})
+            execute_action("click", {"x": mark["x"], "y": mark["y"]})
             
         elif action == "type":
             text_to_type = input("Enter text to type: ")
@@ -174,7 +168,7 @@ def main():
                 "action": "type",
                 "text": text_to_type
             })
-            execute_action("keyboard/type", {"text": text_to_type})
+            execute_action("type", {"text": text_to_type})
             
         else:
             print("❌ Unknown action.")
@@ -184,7 +178,8 @@ def main():
         
     print("\n💾 Saving final Blueprint state graph...")
     try:
-        supabase.table("blueprints").update({"state_graph_json": {"steps": state_graph}}).eq("id", blueprint_id).execute()
+        # Saved and versioned in one UPDATE (save_blueprint_graph in schema.sql)
+        supabase.rpc("save_blueprint_graph", {"target_blueprint_id": blueprint_id, "graph": {"steps": state_graph}}).execute()
         print("✅ Blueprint saved completely!")
     except Exception as e:
         print(f"❌ Supabase update error: {e}")
@@ -1,6 +1,5 @@
 import requests
 import json
-import time
 
 API_URL = "http://localhost:8000"
 
@@ -11,7 +10,8 @@ def test_stealth_flags():
     print("\nNavigating to about:blank to verify base stealth...")
     res = requests.post(f"{API_URL}/v1/action/browser/navigate", json={"url": "about:blank"})
     assert res.status_code == 200
-    time.sleep(1)
+    res = requests.post(f"{API_URL}/v1/perception/wait", json={"timeout_ms": 3000})
+    assert res.status_code == 200
 
     # 2. Assert navigator.webdriver is False (Critical detection vector)
     print("Testing navigator.webdriver (Should be undefined or false)...")
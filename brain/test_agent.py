@@ -0,0 +1,113 @@
+from io import BytesIO
+from types import SimpleNamespace
+from PIL import Image
+from agent import read_json_object, parse_action, budget_frame, to_screen
+
+class FakeStream:
+    # Iterates OpenAI-style stream chunks and records how far the reader consumed it
+    def __init__(self, deltas: list):
+        self.chunks = [SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=d))]) for d in deltas]
+        self.consumed = 0
+        self.closed = False
+
+    def __iter__(self):
+        for chunk in self.chunks:
+            if self.closed:
+                return
+            self.consumed += 1
+            yield chunk
+
+    def close(self):
+        self.closed = True
+
+def expect_invalid(text: str):
+    try:
+        parse_action(text)
+    except ValueError:
+        return
+    raise AssertionError(f"parse_action accepted {text!r}")
+
+def test_complete_object_closes_stream():
+    stream = FakeStream(['{"action": "cl', 'ick", "mark_id": "7"}', ' Some trailing chatter', ' that is never read'])
+    text = read_json_object(stream)
+    assert text == '{"action": "click", "mark_id": "7"}'
+    assert stream.closed and stream.consumed == 2
+    assert parse_action(text) == {"action": "click", "mark_id": "7"}
+
+def test_braces_inside_strings():
+    stream = FakeStream(['{"action": "type", "text": "a } b { \\"c\\" }"}', "{}"])
+    assert parse_action(read_json_object(stream)) == {"action": "type", "text": 'a } b { "c" }'}
+    assert stream.closed
+
+def test_text_before_object():
+    stream = FakeStream(["Sure! Here is the action:\n```json\n", '{"action": "done", "result": "ok"}', "\n```"])
+    text = read_json_object(stream)
+    assert stream.closed
+    assert parse_action(text) == {"action": "done", "result": "ok"}
+
+def test_truncated_stream():
+    # max_tokens hit mid-object: the partial text is returned and rejected by parse_action
+    stream = FakeStream(['{"action": "navigate", ', '"url": "https://exa'])
+    text = read_json_object(stream)
+    assert text == '{"action": "navigate", "url": "https://exa' and not stream.closed
+    expect_invalid(text)
+
+def test_empty_and_role_only_chunks():
+    stream = FakeStream([None, "", '{"action": "click", "x": 10, "y": 20}'])
+    stream.chunks.insert(0, SimpleNamespace(choices=[]))
+    assert parse_action(read_json_object(stream)) == {"action": "click", "x": 10, "y": 20}
+
+def test_invalid_actions():
+    expect_invalid("I can't see the page")
+    expect_invalid('{"action": "scroll", "delta_y": 300}')
+    expect_invalid('{"action": "click"}')
+    expect_invalid('{"action": "type"}')
+    expect_invalid('["click", 1]')
+    expect_invalid('{"action": "click", "mark_id": "3"')
+
+def frame(width: int, height: int) -> bytes:
+    buffered = BytesIO()
+    Image.new("RGB", (width, height), (40, 90, 160)).save(buffered, format="PNG")
+    return buffered.getvalue()
+
+def test_budget_frame_tokens():
+    # (frame size, budget) -> resized size; whole 28px patches, never over budget, never upscaled
+    expected = {
+        ((1920, 1080), 1024): (1176, 672),
+        ((1280, 720), 1024): (1176, 672),
+        ((1920, 1080), 2048): (1680, 924),
+        ((800, 600), 1024): (784, 588)
+    }
+    for ((width, height), budget), size in expected.items():
+        jpeg, view = budget_frame(frame(width, height), budget=budget)
+        assert (view["width"], view["height"]) == size
+        assert view["tokens"] == (size[0] // 28) * (size[1] // 28) <= budget
+        assert Image.open(BytesIO(jpeg)).size == size
+    # Below MIN_IMAGE_SCALE the labels would be unreadable, so the budget gives way
+    _, view = budget_frame(frame(1920, 1080), budget=256)
+    assert (view["width"], view["height"]) == (952, 532)
+
+def test_budget_frame_roi_past_edge():
+    # Clipped to the bottom-right corner: 120x80 of screen, left at full resolution
+    _, view = budget_frame(frame(1920, 1080), roi=(1800, 1000, 400, 300))
+    assert (view["left"], view["top"], view["width"], view["height"], view["tokens"]) == (1800, 1000, 112, 56, 8)
+    assert to_screen(view, 56, 28) == (1860, 1040)
+    # Past the top-left corner the rectangle keeps its right and bottom edges
+    _, view = budget_frame(frame(1920, 1080), roi=(-100, -50, 400, 300))
+    assert (view["left"], view["top"]) == (0, 0)
+    assert to_screen(view, view["width"], view["height"]) == (300, 250)
+    # Less than a patch left on screen: the whole frame is sent instead
+    _, view = budget_frame(frame(1920, 1080), roi=(1915, 1075, 100, 100))
+    assert (view["left"], view["top"], view["width"], view["height"]) == (0, 0, 1176, 672)
+    assert to_screen(view, 1176, 672) == (1920, 1080)
+
+if __name__ == "__main__":
+    test_complete_object_closes_stream()
+    test_braces_inside_strings()
+    test_text_before_object()
+    test_truncated_stream()
+    test_empty_and_role_only_chunks()
+    test_invalid_actions()
+    test_budget_frame_tokens()
+    test_budget_frame_roi_past_edge()
+    print("✅ Action parsing and frame budget checks passed")
@@ -33,6 +33,197 @@ def test_screenshot_without_marks():
     assert "marks_mapping" in data
     assert len(data["marks_mapping"]) == 0  # Should be empty when marks=false
 
+def test_screenshot_binary_transport():
+    res = requests.get(f"{API_URL}/v1/perception/screenshot?marks=true&transport=binary&compress=true")
+    assert res.status_code == 200
+    assert res.headers["content-type"].startswith("multipart/mixed")
+    
+    from http_client import decode_frame
+    image_bytes, meta = decode_frame(res.content, res.headers["content-type"])
+    assert image_bytes[:8] == b"\x89PNG\r\n\x1a\n"
+    assert isinstance(meta["marks_mapping"], dict)
+    assert meta["screenshot_id"]
+
+def test_screenshot_jpeg_downscaled():
+    res = requests.get(f"{API_URL}/v1/perception/screenshot?marks=false&format=jpeg&quality=60&scale=0.5&fast=true")
+    assert res.status_code == 200
+    data = res.json()
+    assert data["media_type"] == "image/jpeg"
+    assert data["scale"] == 0.5
+    
+    from PIL import Image
+    import io
+    img = Image.open(io.BytesIO(base64.b64decode(data["image_base64"])))
+    assert img.format == "JPEG"
+    assert img.width == 960
+
+def test_screenshot_invalid_format():
+    res = requests.get(f"{API_URL}/v1/perception/screenshot?format=gif")
+    assert res.status_code == 400
+
+def test_mark_regions():
+    res = requests.get(f"{API_URL}/v1/perception/screenshot?marks=true&image=false")
+    data = res.json()
+    mark_ids = list(data["marks_mapping"].keys())[:3]
+    
+    res = requests.post(f"{API_URL}/v1/perception/regions", json={
+        "mark_ids": mark_ids,
+        "screenshot_id": data["screenshot_id"],
+        "rects": [{"x": 0, "y": 0, "width": 50, "height": 20}],
+        "margin": 4
+    })
+    assert res.status_code == 200
+    regions = res.json()["regions"]
+    assert len(regions) == len(mark_ids) + 1
+    assert regions[-1]["id"] == "rect_0"
+    for region, mark_id in zip(regions, mark_ids):
+        mark = data["marks_mapping"][mark_id]
+        assert region["rect"]["width"] <= mark["width"] + 8
+        assert base64.b64decode(region["image_base64"])[:4] == b"\x89PNG"
+
+def test_regions_requires_targets():
+    res = requests.post(f"{API_URL}/v1/perception/regions", json={})
+    assert res.status_code == 400
+
+def test_screenshot_without_image():
+    res = requests.get(f"{API_URL}/v1/perception/screenshot?marks=true&image=false")
+    assert res.status_code == 200
+    data = res.json()
+    assert data["image_base64"] is None
+    assert data["screenshot_id"]
+
+def test_marks_stable_between_calls():
+    first = requests.get(f"{API_URL}/v1/perception/screenshot?marks=true&image=false").json()
+    second = requests.get(f"{API_URL}/v1/perception/screenshot?marks=true&image=false").json()
+    assert first["marks_epoch"] == second["marks_epoch"]
+    assert first["marks_mapping"] == second["marks_mapping"]
+    
+    # Nothing changed on the page, so the diff since the latest version is empty
+    res = requests.get(f"{API_URL}/v1/perception/marks", params={"since": second["marks_version"], "epoch": second["marks_epoch"]})
+    assert res.status_code == 200
+    data = res.json()
+    assert data["full"] is False
+    assert data["changed"] == {}
+    assert data["removed"] == []
+
+def test_fingerprint_locate():
+    requests.post(f"{API_URL}/v1/action/browser/navigate", json={"url": "https://example.com"})
+    marks = requests.get(f"{API_URL}/v1/perception/screenshot?marks=true&image=false").json()["marks_mapping"]
+    assert marks
+    mark_id = next(iter(marks))
+    
+    res = requests.post(f"{API_URL}/v1/perception/fingerprint", json={"mark_ids": [mark_id]})
+    assert res.status_code == 200
+    fingerprint = res.json()["fingerprints"][mark_id]
+    assert fingerprint["tag"]
+    
+    # The same element on the same page resolves back to its own mark
+    res = requests.post(f"{API_URL}/v1/perception/locate", json={"fingerprint": fingerprint})
+    assert res.status_code == 200
+    data = res.json()
+    assert data["resolved"] is True
+    assert data["mark_id"] == mark_id
+    
+    res = requests.post(f"{API_URL}/v1/perception/locate", json={"fingerprint": {"tag": "marquee"}})
+    assert res.json()["resolved"] is False
+
+def test_page_version_and_frame_cache():
+    first = requests.get(f"{API_URL}/v1/perception/screenshot?marks=true&image=false").json()
+    second = requests.get(f"{API_URL}/v1/perception/screenshot?marks=true&image=false").json()
+    # Unchanged page: the second call is served from the version-keyed cache
+    assert second["page_version"] == first["page_version"]
+    assert second["cached"] is True
+    assert second["screenshot_id"] == first["screenshot_id"]
+    
+    res = requests.get(f"{API_URL}/v1/perception/version?hash=true")
+    assert res.status_code == 200
+    data = res.json()
+    assert data["version"] == first["page_version"]
+    assert len(data["frame_hash"]) == 16
+
+def test_wait_for_settle():
+    res = requests.post(f"{API_URL}/v1/perception/wait", json={"timeout_ms": 3000})
+    assert res.status_code == 200
+    data = res.json()
+    assert data["elapsed_ms"] <= 3000 + 500
+    if data["settled"]:
+        assert data["condition"] in ("network_idle", "dom_quiet", "animations_done", "fonts_ready")
+    else:
+        assert data["condition"] == "timeout"
+        assert data["pending"]
+
+def test_session_lifecycle():
+    res = requests.post(f"{API_URL}/v1/sessions", json={"session_id": "pytest-session"})
+    assert res.status_code == 200
+    assert res.json()["session_id"] == "pytest-session"
+    assert res.json()["startup_ms"] >= 0
+    try:
+        # Duplicate ids are rejected
+        assert requests.post(f"{API_URL}/v1/sessions", json={"session_id": "pytest-session"}).status_code == 409
+        
+        data = requests.get(f"{API_URL}/v1/sessions").json()
+        assert data["pool"]["warm_handouts"] + data["pool"]["cold_handouts"] >= 2
+        listed = [s["session_id"] for s in data["sessions"]]
+        assert "default" in listed and "pytest-session" in listed
+        
+        # Session-scoped routes act on that session's own page
+        res = requests.get(f"{API_URL}/v1/sessions/pytest-session/perception/screenshot?marks=false&image=false")
+        assert res.status_code == 200
+    finally:
+        assert requests.delete(f"{API_URL}/v1/sessions/pytest-session").status_code == 200
+        
+    assert requests.get(f"{API_URL}/v1/sessions/pytest-session/perception/version").status_code == 404
+    assert requests.delete(f"{API_URL}/v1/sessions/default").status_code == 400
+
+def test_recycled_context_has_no_history():
+    # A context handed back to the pool must not expose the previous session's navigation history
+    requests.post(f"{API_URL}/v1/sessions", json={"session_id": "pytest-history"})
+    try:
+        for url in ("https://example.com", "https://example.org"):
+            assert requests.post(f"{API_URL}/v1/sessions/pytest-history/action/browser/navigate", json={"url": url}).status_code == 200
+    finally:
+        assert requests.delete(f"{API_URL}/v1/sessions/pytest-history").status_code == 200
+        
+    # The pool hands out the most recently recycled context first
+    requests.post(f"{API_URL}/v1/sessions", json={"session_id": "pytest-history"})
+    try:
+        res = requests.post(f"{API_URL}/v1/sessions/pytest-history/action/batch", json={"actions": [
+            {"action": "evaluate", "js_code": "() => [history.length, location.href]"}
+        ]})
+        assert res.status_code == 200
+        assert res.json()["results"][0]["result"]["result"] == [1, "about:blank"]
+    finally:
+        requests.delete(f"{API_URL}/v1/sessions/pytest-history")
+
+def test_action_batch():
+    res = requests.post(f"{API_URL}/v1/action/batch", json={"actions": [
+        {"action": "evaluate", "js_code": "() => 1 + 1"},
+        {"action": "scroll", "delta_y": 0},
+        {"action": "wait", "wait": {"timeout_ms": 2000}},
+        {"action": "screenshot", "marks": False, "options": {"format": "jpeg", "scale": 0.25}}
+    ]})
+    assert res.status_code == 200
+    data = res.json()
+    assert [r["status"] for r in data["results"]] == ["ok", "ok", "ok", "ok"]
+    assert data["results"][0]["result"]["result"] == 2
+    assert data["results"][3]["result"]["media_type"] == "image/jpeg"
+    assert base64.b64decode(data["results"][3]["result"]["image_base64"])
+    assert all("elapsed_ms" in r for r in data["results"])
+
+def test_action_batch_stop_on_error():
+    res = requests.post(f"{API_URL}/v1/action/batch", json={"actions": [
+        {"action": "click"},
+        {"action": "evaluate", "js_code": "() => 1"}
+    ]})
+    assert res.status_code == 200
+    data = res.json()
+    assert data["failed"] is True
+    assert [r["status"] for r in data["results"]] == ["error", "skipped"]
+
+def test_mark_embeddings_unknown_screenshot():
+    res = requests.post(f"{API_URL}/v1/perception/embeddings", json={"screenshot_id": "does-not-exist"})
+    assert res.status_code == 404
+
 def test_navigate_validation():
     # Test missing payload
     res = requests.post(f"{API_URL}/v1/action/browser/navigate")
@@ -65,9 +256,35 @@ def test_navigate_success():
 def test_click_success():
     res = requests.post(f"{API_URL}/v1/action/mouse/click", json={"x": 100, "y": 100})
     assert res.status_code == 200
-    assert res.json() == {"status": "simulated_human_click", "x": 100, "y": 100}
+    data = res.json()
+    assert data["status"] == "simulated_human_click"
+    assert (data["x"], data["y"]) == (100, 100)
+    assert data["input_ms"] > 0
 
 def test_type_success():
     res = requests.post(f"{API_URL}/v1/action/keyboard/type", json={"text": "hello test"})
     assert res.status_code == 200
-    assert res.json() == {"status": "simulated_human_type", "text": "hello test"}
+    data = res.json()
+    assert data["status"] == "simulated_human_type"
+    assert data["text"] == "hello test"
+    assert data["input_ms"] > 0
+
+def test_input_profiles():
+    # The fast profile skips humanized pauses and bulk-inserts text; the stealth profile types per key
+    text = "x" * 200
+    fast = requests.post(f"{API_URL}/v1/action/keyboard/type", json={"text": text, "profile": "fast"})
+    assert fast.status_code == 200
+    assert fast.json()["input_ms"] < 1000
+    
+    click = requests.post(f"{API_URL}/v1/action/mouse/click", json={"x": 300, "y": 300, "profile": "fast"})
+    assert click.status_code == 200
+    assert click.json()["input_ms"] < 300
+    
+    res = requests.post(f"{API_URL}/v1/action/keyboard/type", json={"text": "hi", "profile": "warp"})
+    assert res.status_code == 400
+    
+    res = requests.put(f"{API_URL}/v1/input/profile", json={"profile": "balanced"})
+    assert res.status_code == 200
+    assert res.json()["input_profile"] == "balanced"
+    res = requests.put(f"{API_URL}/v1/input/profile", json={"profile": "stealth"})
+    assert res.status_code == 200
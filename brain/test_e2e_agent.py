@@ -21,9 +21,8 @@ def main():
     print(f"=================================================")
     
     # Grab the final screenshot to prove where it ended up
-    b64_image, marks = get_screenshot()
-    if b64_image:
-        img_data = base64.b64decode(b64_image)
+    img_data, marks, _ = get_screenshot()
+    if img_data:
         path = os.path.join(ARTIFACT_DIR, "e2e_final_state.png")
         with open(path, "wb") as f:
             f.write(img_data)
@@ -37,6 +37,30 @@ def test_embedding_api():
     assert "embedding" in data
     print(f"✅ Visual crop embedded. Dimensions: {data['dimensions']}")
     
+    # 4. Batched Image Embedding (same crop plus a blue square in one forward pass)
+    print("\n4. Testing Batched Visual Embedding...")
+    blue_img = Image.new('RGB', (100, 100), color = 'blue')
+    buffered = io.BytesIO()
+    blue_img.save(buffered, format="JPEG")
+    blue_b64 = base64.b64encode(buffered.getvalue()).decode("utf-8")
+    
+    res = requests.post(f"{API_URL}/v1/embed/images", json={"images_base64": [img_b64, blue_b64]})
+    assert res.status_code == 200
+    data = res.json()
+    assert data["count"] == 2
+    assert len(data["embeddings"]) == 2
+    print(f"✅ Batch of {data['count']} crops embedded. Dimensions: {data['dimensions']}")
+    
+    # 5. Cache: re-embedding the same crops must be served from the cache
+    print("\n5. Testing Embedding Cache...")
+    before = requests.get(f"{API_URL}/v1/health").json()["cache"]
+    res = requests.post(f"{API_URL}/v1/embed/images", json={"images_base64": [img_b64, img_b64]})
+    assert res.status_code == 200
+    after = requests.get(f"{API_URL}/v1/health").json()["cache"]
+    assert after["hits"] >= before["hits"] + 1
+    assert after["misses"] == before["misses"]
+    print(f"✅ Cache serving repeats. Hit rate: {after['hit_rate']:.2f}")
+    
     print("\n✅ All Embedding API endpoints work correctly!")
 
 if __name__ == "__main__":
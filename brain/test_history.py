@@ -0,0 +1,65 @@
+from history import AgentHistory, TokenCounter
+
+class WordCounter(TokenCounter):
+    # One token per word, no vLLM needed
+    def __init__(self):
+        super().__init__("test")
+
+    def count(self, text: str) -> int:
+        return len(text.split())
+
+def make_history(steps: int, window: int = 4, block: int = 4) -> AgentHistory:
+    history = AgentHistory(WordCounter(), window=window, block=block)
+    for step in range(1, steps + 1):
+        history.record(step, {"action": "click", "mark_id": step})
+        history.record_outcome("page changed")
+    return history
+
+def assert_alternates(messages: list):
+    roles = [message["role"] for message in messages]
+    assert all(a != b for a, b in zip(roles, roles[1:])), roles
+    assert roles[0] == "user" and roles[-1] == "user"
+
+def test_turns_alternate():
+    messages = make_history(3).messages(10_000)
+    assert_alternates(messages)
+    assert len(messages) == 7
+    # Each result opens the next step's user turn; the last one is left for the current prompt
+    assert messages[2]["content"] == "Result of step 1: page changed\nStep 2: [Screenshot submitted previously]"
+    assert messages[-1]["content"] == "Result of step 3: page changed"
+
+def test_summary_folds_in_blocks():
+    history = make_history(9)
+    first = history.messages(10_000)
+    assert_alternates(first)
+    assert first[0]["content"].startswith("Earlier steps:\n1. click mark 1 -> page changed")
+    assert "4. click mark 4" in first[0]["content"] and "Step 5:" in first[0]["content"]
+    # The prefix stays identical until a whole block more can be folded
+    for step in (10, 11):
+        history.record(step, {"action": "type", "text": "x"})
+        history.record_outcome("page did not change")
+        assert history.messages(10_000)[:len(first) - 1] == first[:-1]
+    history.record(12, {"action": "type", "text": "x"})
+    folded = history.messages(10_000)
+    assert "8. click mark 8" in folded[0]["content"]
+    assert_alternates(folded)
+
+def test_budget_trimming():
+    history = make_history(20)
+    full = history.messages(10_000)
+    full_tokens = history.last_tokens
+    trimmed = history.messages(full_tokens // 2)
+    assert history.last_tokens <= full_tokens // 2
+    assert_alternates(trimmed)
+    assert "earlier steps omitted" in trimmed[0]["content"]
+    assert len(trimmed) < len(full)
+    # Even a budget nothing fits in leaves a well-formed history
+    tiny = history.messages(1)
+    assert_alternates(tiny)
+    assert len(tiny) == 1 and tiny[0]["content"].startswith("Earlier steps:\n(20 earlier steps omitted)")
+
+if __name__ == "__main__":
+    test_turns_alternate()
+    test_summary_folds_in_blocks()
+    test_budget_trimming()
+    print("✅ Agent history checks passed")
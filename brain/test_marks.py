@@ -1,6 +1,5 @@
 import requests
 import base64
-import time
 import os
 import json
 
@@ -12,8 +11,9 @@ def main():
     res = requests.post(f"{AGENT_API_URL}/v1/action/browser/navigate", json={"url": "https://wikipedia.org"})
     print("Navigate Response:", res.status_code, res.text)
     
-    print("Waiting 2 seconds...")
-    time.sleep(2)
+    print("Waiting for the page to settle...")
+    res = requests.post(f"{AGENT_API_URL}/v1/perception/wait", json={"timeout_ms": 5000})
+    print("Wait Response:", res.status_code, res.text)
 
     print("Taking screenshot with marks=true ...")
     res = requests.get(f"{AGENT_API_URL}/v1/perception/screenshot?marks=true")
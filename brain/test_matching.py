@@ -0,0 +1,90 @@
+import math
+from matching import rank_candidates, rank_by_geometry, same_dom_element, same_position
+
+# Executor's MATCH_EARLY_EXIT_MARGIN default: a best match closer than this to the runner-up is ambiguous
+EARLY_EXIT_MARGIN = 0.05
+
+def unit(similarity: float) -> list:
+    # 2-D vector whose cosine similarity to [1, 0] is `similarity`
+    return [similarity, math.sqrt(1 - similarity ** 2)]
+
+BUTTON = {"tag": "button", "role": "", "name": "Add to cart", "text": "Add to cart", "attrs": {}, "path": "div:1>button:1"}
+
+def test_same_dom_element():
+    assert same_dom_element(BUTTON, dict(BUTTON))
+    # Identical-looking button in the next product card
+    assert not same_dom_element(BUTTON, dict(BUTTON, path="div:2>button:1"))
+    # Anchors taught before DOM fingerprints never match by DOM
+    assert not same_dom_element(BUTTON, None)
+    assert not same_dom_element(None, BUTTON)
+
+def test_same_position():
+    box = {"width_pct": 200 / 1920, "height_pct": 40 / 1080, "x_pct": 0.5, "y_pct": 0.5}
+    assert same_position(box, {"x": 970, "y": 545, "width": 196, "height": 40})
+    assert not same_position(box, {"x": 960, "y": 700, "width": 200, "height": 40})
+    assert not same_position(box, {"x": 960, "y": 540, "width": 400, "height": 80})
+    # Anchors taught before positions were stored
+    assert not same_position({"width_pct": box["width_pct"], "height_pct": box["height_pct"]}, {"x": 960, "y": 540, "width": 200, "height": 40})
+
+def test_geometry_prefilter():
+    # Taught: a 200x40 button centered at (960, 540); the look-alike size near the taught spot ranks first
+    box = {"width_pct": 200 / 1920, "height_pct": 40 / 1080, "x_pct": 0.5, "y_pct": 0.5}
+    marks = {
+        "1": {"x": 100, "y": 100, "width": 40, "height": 40},
+        "2": {"x": 1700, "y": 900, "width": 200, "height": 40},
+        "3": {"x": 980, "y": 560, "width": 190, "height": 42},
+        "4": {"x": 960, "y": 540, "width": 600, "height": 300}
+    }
+    assert rank_by_geometry(box, marks)[:2] == ["3", "2"]
+    # Anchors taught before positions were stored still rank by size and aspect
+    assert rank_by_geometry({"width_pct": box["width_pct"], "height_pct": box["height_pct"]}, marks)[0] in ("2", "3")
+    # No stored box: original order
+    assert rank_by_geometry(None, marks) == ["1", "2", "3", "4"]
+
+def test_rank_clear_winner():
+    match = rank_candidates([1, 0], {"1": unit(0.6), "2": unit(0.98), "3": unit(0.7)}, top_k=1)
+    assert match.best_id == "2"
+    assert abs(match.best_score - 0.98) < 1e-5
+    # The runner-up is still ranked for the margin even with top_k=1
+    assert len(match.ranked) == 1
+    assert abs(match.margin - 0.28) < 1e-5
+    assert match.margin >= EARLY_EXIT_MARGIN
+    # pgvector strings parse like lists
+    assert rank_candidates("[1, 0]", {"1": "[0.6, 0.8]", "2": str(unit(0.98))}).best_id == "2"
+
+def test_rank_ambiguous():
+    # Two look-alikes just under the margin: the best one still wins but isn't trusted for an early exit
+    match = rank_candidates([1, 0], {"1": unit(0.95), "2": unit(0.91)})
+    assert match.best_id == "1"
+    assert [mark_id for mark_id, _ in match.ranked] == ["1", "2"]
+    assert abs(match.margin - 0.04) < 1e-5
+    assert match.margin < EARLY_EXIT_MARGIN
+
+def test_rank_no_candidates():
+    match = rank_candidates([1, 0], {})
+    assert match.ranked == []
+    assert match.best_id is None
+    assert match.best_score == -1.0
+    assert match.margin == 0.0
+    # A lone candidate has nothing to be confused with
+    assert rank_candidates([1, 0], {"1": unit(0.5)}).margin == 1.0
+
+def test_rank_zero_norm():
+    # Blank crops can embed to all zeros: they score 0 instead of NaN and never beat a real match
+    match = rank_candidates([1, 0], {"1": [0, 0], "2": unit(0.3)})
+    assert match.best_id == "2"
+    assert dict(match.ranked)["1"] == 0.0
+    assert not math.isnan(match.margin)
+    match = rank_candidates([0, 0], {"1": unit(0.3), "2": unit(0.9)})
+    assert all(score == 0.0 for _, score in match.ranked)
+    assert match.margin == 0.0
+
+if __name__ == "__main__":
+    test_rank_clear_winner()
+    test_rank_ambiguous()
+    test_rank_no_candidates()
+    test_rank_zero_norm()
+    test_geometry_prefilter()
+    test_same_dom_element()
+    test_same_position()
+    print("✅ Ranking, geometry and anchor dedupe checks passed")
@@ -0,0 +1,100 @@
+import time
+from types import MappingProxyType
+import numpy as np
+from plans import PlanCache, PlanError, compile_plan
+
+ANCHORS = {
+    "Search Bar": {
+        "vector": np.ones(4, dtype=np.float32),
+        "fingerprint": {"tag": "input", "attrs": {"name": "q"}},
+        "box": {"width_pct": 0.3, "height_pct": 0.04, "x_pct": 0.5, "y_pct": 0.1}
+    }
+}
+STEPS = [
+    {"step": 1, "action": "click", "semantic_target": "Search Bar"},
+    {"step": 2, "action": "type", "text": "shoes"}
+]
+
+def compile_error(steps, anchors=ANCHORS) -> str:
+    try:
+        compile_plan("bp", 1, steps, anchors, 0.7)
+    except PlanError as e:
+        return str(e)
+    raise AssertionError("compile_plan accepted an invalid blueprint")
+
+def test_compile_plan():
+    plan = compile_plan("bp", 3, STEPS, ANCHORS, 0.7)
+    assert plan.version == 3 and plan.anchor_count == 1
+    click, typing = plan.steps
+    assert (click.action, click.target_label, click.threshold) == ("click", "Search Bar", 0.7)
+    assert (typing.action, typing.text) == ("type", "shoes")
+    # Compiled plans are shared across runs, so nothing in them may be mutable
+    assert not click.vector.flags.writeable
+    try:
+        click.fingerprint["tag"] = "button"
+        raise AssertionError("fingerprint is mutable")
+    except TypeError:
+        pass
+    assert isinstance(click.fingerprint["attrs"], MappingProxyType) and isinstance(click.box, MappingProxyType)
+
+def test_compile_plan_errors():
+    assert compile_error([]) == "Blueprint is empty"
+    assert compile_error([{"step": 1, "semantic_target": "Search Bar"}]) == "Step 1 has no action"
+    assert compile_error([{"step": 4, "action": "scroll"}]) == "Unknown action 'scroll' in step 4"
+    assert "Login Button" in compile_error([{"step": 1, "action": "click", "semantic_target": "Login Button"}])
+
+def test_plan_cache_versions():
+    cache = PlanCache(size=2)
+    plan = compile_plan("bp", 1, STEPS, ANCHORS, 0.7)
+    cache.put(plan, cache.generation("bp"))
+    assert cache.fresh("bp") is plan
+    assert cache.get("bp", 1) is plan
+    # A newer version in the database makes the cached plan unreachable
+    assert cache.get("bp", 2) is None
+    assert cache.fresh("bp") is None
+
+def test_plan_cache_ttl():
+    cache = PlanCache(version_ttl=0.05)
+    plan = compile_plan("bp", 1, STEPS, ANCHORS, 0.7)
+    cache.put(plan, cache.generation("bp"))
+    assert cache.fresh("bp") is plan
+    time.sleep(0.1)
+    # Past the TTL the version has to be re-checked, after which the same plan is served again
+    assert cache.fresh("bp") is None
+    assert cache.get("bp", 1) is plan
+    assert cache.fresh("bp") is plan
+
+def test_plan_cache_invalidation():
+    cache = PlanCache()
+    plan = compile_plan("bp", 1, STEPS, ANCHORS, 0.7)
+    cache.put(plan, cache.generation("bp"))
+    cache.invalidate("bp")
+    assert cache.fresh("bp") is None and cache.get("bp", 1) is None
+    assert cache.stats()["plans"] == 0
+
+def test_plan_cache_rejects_stale_put():
+    cache = PlanCache()
+    # Compile started, then the blueprint was edited before the result was cached
+    generation = cache.generation("bp")
+    cache.invalidate("bp")
+    cache.put(compile_plan("bp", 1, STEPS, ANCHORS, 0.7), generation)
+    assert cache.get("bp", 1) is None
+    cache.put(compile_plan("bp", 2, STEPS, ANCHORS, 0.7), cache.generation("bp"))
+    assert cache.get("bp", 2) is not None
+
+def test_plan_cache_lru():
+    cache = PlanCache(size=2)
+    for blueprint_id in ("a", "b", "c"):
+        cache.put(compile_plan(blueprint_id, 1, STEPS, ANCHORS, 0.7), cache.generation(blueprint_id))
+    assert cache.get("a", 1) is None
+    assert cache.get("b", 1) is not None and cache.get("c", 1) is not None
+
+if __name__ == "__main__":
+    test_compile_plan()
+    test_compile_plan_errors()
+    test_plan_cache_versions()
+    test_plan_cache_ttl()
+    test_plan_cache_invalidation()
+    test_plan_cache_rejects_stale_put()
+    test_plan_cache_lru()
+    print("✅ Plan compiler and cache checks passed")
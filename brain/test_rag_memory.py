@@ -1,12 +1,12 @@
 import os
 import requests
 import base64
-import time
 from io import BytesIO
 from PIL import Image
 from dotenv import load_dotenv
 from supabase import create_client, Client
-from executor import cosine_similarity, get_embedding, crop_image_around_mark
+from executor import get_embeddings, get_embedding, crop_image_around_mark
+from matching import rank_candidates
 import uuid
 
 load_dotenv()
@@ -27,7 +27,7 @@ def test_visual_rag():
     # 2. Navigate to a known static page
     print("\n2. Navigating to example.com...")
     requests.post(f"{AGENT_API_URL}/v1/action/browser/navigate", json={"url": "https://example.com"})
-    time.sleep(1) # Let DOM settle
+    requests.post(f"{AGENT_API_URL}/v1/perception/wait", json={"timeout_ms": 3000}) # Let DOM settle
     
     # 3. Get Screenshot & Marks (The "Teacher" phase)
     print("\n3. Capturing marks for 'Teacher' phase...")
@@ -60,7 +60,7 @@ def test_visual_rag():
     # 5. The "Executor" phase - Reload page to change mark IDs (simulating drift)
     print("\n5. Reloading page (Simulating Executor Phase)...")
     requests.post(f"{AGENT_API_URL}/v1/action/browser/navigate", json={"url": "https://example.com"})
-    time.sleep(1)
+    requests.post(f"{AGENT_API_URL}/v1/perception/wait", json={"timeout_ms": 3000})
     
     # 6. Retrieve Memory & Match
     print("\n6. Fetching Memory and Scanning Screen...")
@@ -71,18 +71,13 @@ def test_visual_rag():
     new_img_b64 = res.json()["image_base64"]
     new_marks = res.json()["marks_mapping"]
     
-    best_id = None
-    best_sim = -1
-    
     print("\n7. Calculating Cosine Similarities against Memory:")
-    for mark_id, mark_info in new_marks.items():
-        new_crop = crop_image_around_mark(new_img_b64, mark_info)
-        new_vector = get_embedding(new_crop)
-        sim = cosine_similarity(memory_vector, new_vector)
+    mark_ids = list(new_marks.keys())
+    new_vectors = get_embeddings([crop_image_around_mark(new_img_b64, new_marks[m]) for m in mark_ids])
+    match = rank_candidates(memory_vector, dict(zip(mark_ids, new_vectors)), top_k=len(mark_ids))
+    for mark_id, sim in match.ranked:
         print(f" -> Mark {mark_id}: {sim:.4f}")
-        if sim > best_sim:
-            best_sim = sim
-            best_id = mark_id
+    best_id, best_sim = match.best_id, match.best_score
             
     assert best_sim > 0.95, f"Expected near-perfect match, got {best_sim}"
     print(f"\n✅ SUCCESS: Vector Engine successfully found target with score {best_sim:.4f}")
@@ -1,6 +1,5 @@
 import requests
 import base64
-import time
 import os
 
 AGENT_API_URL = "http://localhost:8000"
@@ -11,14 +10,15 @@ def main():
     res = requests.post(f"{AGENT_API_URL}/v1/action/browser/navigate", json={"url": "https://bot.sannysoft.com/"})
     print("Navigate Response:", res.status_code, res.text)
     
-    print("Waiting 5 seconds for bot detection to run...")
-    time.sleep(5)
+    print("Waiting for bot detection to run...")
+    res = requests.post(f"{AGENT_API_URL}/v1/perception/wait", json={"timeout_ms": 8000})
+    print("Wait Response:", res.status_code, res.text)
     
     # Test human mouse click
     print("Testing human mouse click simulation (Bezier curves)...")
     res = requests.post(f"{AGENT_API_URL}/v1/action/mouse/click", json={"x": 500, "y": 500})
     print("Click Response:", res.status_code, res.text)
-    time.sleep(1)
+    requests.post(f"{AGENT_API_URL}/v1/perception/wait", json={"timeout_ms": 3000})
 
     print("Taking screenshot...")
     res = requests.get(f"{AGENT_API_URL}/v1/perception/screenshot")
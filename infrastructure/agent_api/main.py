@@ -1,56 +1,344 @@
+import os
+import json
+import gzip
 import base64
 import random
 import math
 import asyncio
+import uuid
+import time
+import httpx
+from collections import OrderedDict, deque
 from contextlib import asynccontextmanager
-from fastapi import FastAPI, HTTPException
+from typing import Optional
+from urllib.parse import urlparse
+from io import BytesIO
+from PIL import Image
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, Request
+from fastapi.responses import Response
 from pydantic import BaseModel
-from playwright.async_api import async_playwright, Browser, Page
+from playwright.async_api import async_playwright, Browser, BrowserContext, Page
 from playwright_stealth import stealth_async
 
 # --- Global Playwright State ---
 playwright_instance = None
 browser: Browser = None
-page: Page = None
-current_mouse_x = 0
-current_mouse_y = 0
 
-async def move_mouse_humanly(target_page: Page, start_x: int, start_y: int, end_x: int, end_y: int):
-    global current_mouse_x, current_mouse_y
-    steps = random.randint(15, 30)
-    
+# Each session is an isolated BrowserContext. The default session backs the plain /v1/... routes;
+# others are addressed as /v1/sessions/{session_id}/...
+DEFAULT_SESSION_ID = "default"
+MAX_SESSIONS = int(os.getenv("MAX_SESSIONS", "8"))
+sessions: dict = {}
+sessions_lock = asyncio.Lock()
+
+# Ready-to-use stealth contexts handed out on session create, scrubbed and returned on destroy,
+# and refilled in the background so session start skips context setup and stealth patching
+CONTEXT_POOL_SIZE = int(os.getenv("CONTEXT_POOL_SIZE", "2"))
+context_pool: list = []
+pool_refill_event: asyncio.Event = None
+pool_refill_task: asyncio.Task = None
+pool_stats = {"created": 0, "warm_handouts": 0, "cold_handouts": 0, "recycled": 0, "discarded": 0}
+handout_latencies = deque(maxlen=200)
+
+# Embedding API runs on the same box, so crops are embedded over loopback instead of the SSH tunnel
+EMBEDDING_API_URL = os.getenv("EMBEDDING_API_URL", "http://localhost:8002")
+
+# Recent frames kept in memory (per session) so callers can refer back to them by screenshot_id
+SCREENSHOT_CACHE_SIZE = int(os.getenv("SCREENSHOT_CACHE_SIZE", "8"))
+embedding_client: httpx.AsyncClient = None
+
+# Frames are reused while the page version is unchanged; the TTL bounds staleness from changes
+# the DOM can't see (canvas, video, CSS animations)
+PERCEPTION_CACHE_TTL = float(os.getenv("PERCEPTION_CACHE_TTL", "10"))
+
+# Requests open longer than this (long polling, streaming) are treated as background traffic
+# and don't block network idle in the quiescence wait
+LONG_REQUEST_MS = int(os.getenv("LONG_REQUEST_MS", "10000"))
+
+VIEWPORT = {"width": 1920, "height": 1080}
+
+# Humanized input profiles. Ranges are (min, max); delays in seconds except key_delay_ms.
+# "stealth" is the original full simulation. "balanced" keeps the curved path and pauses but far fewer
+# points. "fast" is for trusted sites: a short unpaced path pipelined over CDP and bulk text insertion.
+INPUT_PROFILES = {
+    "stealth": {
+        "path_steps": (15, 30), "step_delay": (0.005, 0.015), "settle": (0.05, 0.15),
+        "pre_click": (0.1, 0.3), "press": (0.05, 0.15), "key_delay_ms": (50, 150), "insert_text": False
+    },
+    "balanced": {
+        "path_steps": (6, 10), "step_delay": (0.002, 0.006), "settle": (0.02, 0.05),
+        "pre_click": (0.03, 0.08), "press": (0.03, 0.06), "key_delay_ms": (15, 40), "insert_text": False
+    },
+    "fast": {
+        "path_steps": (3, 5), "step_delay": (0, 0), "settle": (0, 0),
+        "pre_click": (0, 0), "press": (0.01, 0.02), "key_delay_ms": (0, 0), "insert_text": True
+    }
+}
+DEFAULT_INPUT_PROFILE = os.getenv("INPUT_PROFILE", "stealth")
+
+# Custom stealth script that playwright-stealth might miss
+STEALTH_PLUGINS_JS = """
+    Object.defineProperty(navigator, 'plugins', {
+        get: () => [
+            {
+                0: {type: "application/pdf", suffixes: "pdf", description: "Portable Document Format", enabledPlugin: Plugin},
+                description: "Portable Document Format",
+                filename: "internal-pdf-viewer",
+                length: 1,
+                name: "Chrome PDF Plugin"
+            }
+        ],
+    });
+"""
+
+# Set-of-Marks engine, registered once per context as an init script. It is reached through a Symbol keyed
+# by a random per-process token, so page scripts can't find it by name.
+MARKS_ENGINE_KEY = uuid.uuid4().hex
+MARKS_ENGINE = f"window[Symbol.for('{MARKS_ENGINE_KEY}')]"
+with open(os.path.join(os.path.dirname(__file__), "marks.js")) as f:
+    MARKS_ENGINE_JS = f.read().replace("__ISOMIND_KEY__", MARKS_ENGINE_KEY)
+
+class Session:
+    # One isolated browser context with its own page, mouse position, frame caches and network tracking.
+    # `lock` serializes actions and perception on the page so concurrent callers can't interleave.
+    def __init__(self, session_id: str, context: BrowserContext, page: Page):
+        self.session_id = session_id
+        self.context = context
+        self.page = page
+        self.cdp_session = None
+        self.mouse_x = 0
+        self.mouse_y = 0
+        # Default humanized input profile for actions on this session; requests may override it
+        self.input_profile = DEFAULT_INPUT_PROFILE
+        self.lock = asyncio.Lock()
+        self.screenshot_cache: OrderedDict = OrderedDict()
+        self.perception_cache: OrderedDict = OrderedDict()
+        # Main-frame navigations and actions issued through this API; part of the page version
+        self.navigation_count = 0
+        self.action_count = 0
+        # In-flight network requests (request -> start time) for the quiescence wait
+        self.inflight_requests: dict = {}
+        self.last_network_at = time.monotonic()
+        # Origins this session's frames visited; their storage is cleared before the context is reused
+        self.origins = set()
+        self.created_at = time.time()
+        self.last_used = time.time()
+        
+        self.listeners = {
+            "framenavigated": self.on_frame_navigated,
+            "request": self.on_request_started,
+            "requestfinished": self.on_request_done,
+            "requestfailed": self.on_request_done
+        }
+        for event, handler in self.listeners.items():
+            page.on(event, handler)
+            
+    def on_frame_navigated(self, frame):
+        if frame == self.page.main_frame:
+            self.navigation_count += 1
+        url = urlparse(frame.url)
+        if url.scheme in ("http", "https"):
+            self.origins.add(f"{url.scheme}://{url.netloc}")
+            
+    def on_request_started(self, request):
+        now = time.monotonic()
+        if len(self.inflight_requests) > 1000:
+            # Drop long-lived requests that never reported back (e.g. torn down with their frame)
+            for stale in [r for r, started in self.inflight_requests.items() if now - started > LONG_REQUEST_MS / 1000]:
+                self.inflight_requests.pop(stale, None)
+        self.inflight_requests[request] = now
+        self.last_network_at = now
+        
+    def on_request_done(self, request):
+        self.inflight_requests.pop(request, None)
+        self.last_network_at = time.monotonic()
+        
+    def record_action(self):
+        # Bumped after each action completes, so hover/focus changes the DOM doesn't report still invalidate frames
+        self.action_count += 1
+        self.last_used = time.time()
+        
+    async def get_cdp_session(self):
+        if self.cdp_session is None:
+            self.cdp_session = await self.context.new_cdp_session(self.page)
+        return self.cdp_session
+        
+    def info(self) -> dict:
+        return {
+            "session_id": self.session_id,
+            "url": self.page.url,
+            "input_profile": self.input_profile,
+            "busy": self.lock.locked(),
+            "created_at": self.created_at,
+            "last_used": self.last_used
+        }
+        
+    def detach(self):
+        for event, handler in self.listeners.items():
+            self.page.remove_listener(event, handler)
+            
+    async def close(self):
+        await self.context.close()
+
+def resolve_input_profile(session: Session, name: str = None) -> dict:
+    name = name or session.input_profile
+    if name not in INPUT_PROFILES:
+        raise HTTPException(status_code=400, detail=f"input profile must be one of {', '.join(INPUT_PROFILES)}")
+    return INPUT_PROFILES[name]
+
+def bezier_path(start_x: float, start_y: float, end_x: int, end_y: int, steps: int) -> list:
+    # The whole jittered cubic Bezier path, computed up front
     dx = end_x - start_x
     dy = end_y - start_y
-    dist = math.hypot(dx, dy)
-    
-    if dist < 5:
-        await target_page.mouse.move(end_x, end_y, steps=2)
-        current_mouse_x, current_mouse_y = end_x, end_y
-        return
-        
-    dev = max(10, dist * 0.15)
+    dev = max(10, math.hypot(dx, dy) * 0.15)
     cp1_x = start_x + dx * 0.33 + random.uniform(-dev, dev)
     cp1_y = start_y + dy * 0.33 + random.uniform(-dev, dev)
     cp2_x = start_x + dx * 0.66 + random.uniform(-dev, dev)
     cp2_y = start_y + dy * 0.66 + random.uniform(-dev, dev)
     
+    points = []
     for i in range(1, steps + 1):
         t = i / steps
         inv_t = 1.0 - t
         x = (inv_t**3 * start_x) + (3 * inv_t**2 * t * cp1_x) + (3 * inv_t * t**2 * cp2_x) + (t**3 * end_x)
         y = (inv_t**3 * start_y) + (3 * inv_t**2 * t * cp1_y) + (3 * inv_t * t**2 * cp2_y) + (t**3 * end_y)
+        points.append((x + random.uniform(-1, 1), y + random.uniform(-1, 1)))
+    return points
+
+async def move_mouse_humanly(session: Session, end_x: int, end_y: int, profile: dict = None):
+    profile = profile or resolve_input_profile(session)
+    target_page = session.page
+    start_x, start_y = session.mouse_x, session.mouse_y
+    
+    if math.hypot(end_x - start_x, end_y - start_y) < 5:
+        await target_page.mouse.move(end_x, end_y, steps=2)
+        session.mouse_x, session.mouse_y = end_x, end_y
+        return
         
-        await target_page.mouse.move(x + random.uniform(-1, 1), y + random.uniform(-1, 1))
-        await asyncio.sleep(random.uniform(0.005, 0.015))
+    points = bezier_path(start_x, start_y, end_x, end_y, random.randint(*profile["path_steps"]))
+    if profile["step_delay"][1] > 0:
+        for x, y in points:
+            await target_page.mouse.move(x, y)
+            await asyncio.sleep(random.uniform(*profile["step_delay"]))
+    else:
+        # Unpaced path: pipeline every move over CDP instead of awaiting a round-trip per point
+        cdp = await session.get_cdp_session()
+        await asyncio.gather(*[
+            cdp.send("Input.dispatchMouseEvent", {"type": "mouseMoved", "x": x, "y": y}) for x, y in points
+        ])
         
+    # Always finish through Playwright so its tracked cursor position (used by mouse.down/up) is the target
     await target_page.mouse.move(end_x, end_y)
-    current_mouse_x, current_mouse_y = end_x, end_y
-    await asyncio.sleep(random.uniform(0.05, 0.15))
+    session.mouse_x, session.mouse_y = end_x, end_y
+    await asyncio.sleep(random.uniform(*profile["settle"]))
+
+async def new_stealth_context():
+    # Fixed viewport matching our Xvfb screen; every context gets the same stealth patches and marks engine
+    context = await browser.new_context(viewport=VIEWPORT, device_scale_factor=1)
+    await context.add_init_script(STEALTH_PLUGINS_JS)
+    await context.add_init_script(MARKS_ENGINE_JS)
+    return context, await new_stealth_page(context)
+
+async def new_stealth_page(context: BrowserContext) -> Page:
+    page = await context.new_page()
+    await stealth_async(page)
+    return page
+
+async def refill_context_pool():
+    while True:
+        await pool_refill_event.wait()
+        pool_refill_event.clear()
+        while len(context_pool) < CONTEXT_POOL_SIZE:
+            try:
+                context_pool.append(await new_stealth_context())
+                pool_stats["created"] += 1
+            except Exception as e:
+                print(f"⚠️ Context pool refill failed: {e}")
+                await asyncio.sleep(1)
+                pool_refill_event.set()
+                break
+
+async def acquire_context():
+    # Pooled context when one is ready, otherwise a cold one; either way the pool refills in the background
+    start = time.perf_counter()
+    context, page = None, None
+    while context_pool and page is None:
+        context, page = context_pool.pop()
+        if page.is_closed():
+            context, page = None, None
+    if page is not None:
+        pool_stats["warm_handouts"] += 1
+    else:
+        context, page = await new_stealth_context()
+        pool_stats["created"] += 1
+        pool_stats["cold_handouts"] += 1
+    handout_latencies.append((time.perf_counter() - start) * 1000)
+    if pool_refill_event is not None:
+        pool_refill_event.set()
+    return context, page
+
+async def scrub_context(session: Session) -> Page:
+    # Leave nothing behind for the next session: pages (with their back/forward history), storage of visited
+    # origins, cookies, permissions, cache. Returns the fresh page the context goes back to the pool with.
+    page = await new_stealth_page(session.context)
+    for old in session.context.pages:
+        if old != page:
+            await old.close()
+    session.cdp_session = None
+    cdp = await session.context.new_cdp_session(page)
+    for origin in session.origins:
+        await cdp.send("Storage.clearDataForOrigin", {"origin": origin, "storageTypes": "all"})
+    await cdp.send("Network.clearBrowserCache")
+    await session.context.clear_cookies()
+    await session.context.clear_permissions()
+    await cdp.detach()
+
+async def release_context(session: Session):
+    session.detach()
+    if len(context_pool) < CONTEXT_POOL_SIZE:
+        try:
+            page = await scrub_context(session)
+            context_pool.append((session.context, page))
+            pool_stats["recycled"] += 1
+            return
+        except Exception as e:
+            print(f"⚠️ Failed to scrub context, discarding it: {e}")
+    pool_stats["discarded"] += 1
+    await session.close()
+
+def pool_report() -> dict:
+    samples = sorted(handout_latencies)
+    report = {"target_size": CONTEXT_POOL_SIZE, "ready": len(context_pool), **pool_stats}
+    if samples:
+        report["handout_p50_ms"] = round(samples[len(samples) // 2], 1)
+        report["handout_p95_ms"] = round(samples[min(len(samples) - 1, int(len(samples) * 0.95))], 1)
+    return report
+
+async def open_session(session_id: str = None) -> Session:
+    async with sessions_lock:
+        session_id = session_id or uuid.uuid4().hex[:12]
+        if session_id in sessions:
+            raise HTTPException(status_code=409, detail=f"Session {session_id} already exists")
+        if len(sessions) >= MAX_SESSIONS:
+            raise HTTPException(status_code=429, detail=f"Session limit reached ({MAX_SESSIONS})")
+        context, page = await acquire_context()
+        session = Session(session_id, context, page)
+        sessions[session_id] = session
+        return session
+
+async def close_session(session_id: str):
+    async with sessions_lock:
+        session = sessions.pop(session_id, None)
+    if session is None:
+        raise HTTPException(status_code=404, detail=f"Session {session_id} not found")
+    # Let an in-flight action on this session finish before recycling the context
+    async with session.lock:
+        await release_context(session)
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Startup: Launch Playwright browser
-    global playwright_instance, browser, page
+    global playwright_instance, browser, pool_refill_event, pool_refill_task
     playwright_instance = await async_playwright().start()
     
     # Launch Chromium in headed mode (we have a virtual display :99 via Xvfb)
@@ -65,38 +353,32 @@ async def lifespan(app: FastAPI):
         ]
     )
     
-    # Create a persistent context with a fixed viewport matching our Xvfb screen
-    context = await browser.new_context(
-        viewport={"width": 1920, "height": 1080},
-        device_scale_factor=1,
-    )
+    await open_session(DEFAULT_SESSION_ID)
     
-    # Inject custom stealth scripts that playwright-stealth might miss
-    await context.add_init_script("""
-        Object.defineProperty(navigator, 'plugins', {
-            get: () => [
-                {
-                    0: {type: "application/pdf", suffixes: "pdf", description: "Portable Document Format", enabledPlugin: Plugin},
-                    description: "Portable Document Format",
-                    filename: "internal-pdf-viewer",
-                    length: 1,
-                    name: "Chrome PDF Plugin"
-                }
-            ],
-        });
-    """)
-    
-    page = await context.new_page()
-    await stealth_async(page)
+    pool_refill_event = asyncio.Event()
+    pool_refill_task = asyncio.create_task(refill_context_pool())
+    pool_refill_event.set()
     
     yield
     
     # Shutdown: Clean up resources
+    pool_refill_task.cancel()
+    for context, _ in context_pool:
+        await context.close()
+    context_pool.clear()
+    if embedding_client is not None:
+        await embedding_client.aclose()
+    for session in list(sessions.values()):
+        await session.close()
+    sessions.clear()
     await browser.close()
     await playwright_instance.stop()
 
 app = FastAPI(title="IsoMind Agent API", lifespan=lifespan)
 
+# Session-scoped routes, mounted at /v1 (default session) and /v1/sessions/{session_id}
+router = APIRouter()
+
 # --- Schemas ---
 class NavigateRequest(BaseModel):
     url: str
@@ -104,137 +386,812 @@ class NavigateRequest(BaseModel):
 class Coordinates(BaseModel):
     x: int
     y: int
+    # stealth | balanced | fast; defaults to the session's input profile
+    profile: Optional[str] = None
 
 class TypeRequest(BaseModel):
     text: str
+    profile: Optional[str] = None
+    # Insert the whole text in one input event instead of per-key typing; defaults to the profile's setting
+    insert_text: Optional[bool] = None
 
 class EvaluateRequest(BaseModel):
     js_code: str
 
+class SessionCreateRequest(BaseModel):
+    # Caller-chosen id (e.g. a blueprint run id); generated when omitted
+    session_id: Optional[str] = None
+    # Default input profile for the session's actions
+    input_profile: Optional[str] = None
+
+class InputProfileRequest(BaseModel):
+    profile: str
+
+class WaitRequest(BaseModel):
+    # Hard upper bound; the call returns as soon as every enabled condition holds
+    timeout_ms: int = 5000
+    # No request started or finished for this long, and none in flight
+    network_idle_ms: int = 500
+    # No DOM mutations (outside the marks overlay) for this long
+    dom_quiet_ms: int = 300
+    animations: bool = True
+    fonts: bool = True
+    poll_ms: int = 50
+
+class CaptureOptions(BaseModel):
+    # png | jpeg | webp
+    format: str = "png"
+    # 1-100, ignored for png
+    quality: int = 80
+    # Output downscale factor (0.1-1.0); marks_mapping stays in CSS pixels
+    scale: float = 1.0
+    grayscale: bool = False
+    # Capture via CDP Page.captureScreenshot with optimizeForSpeed instead of page.screenshot()
+    fast: bool = False
+
+IMAGE_MEDIA_TYPES = {"png": "image/png", "jpeg": "image/jpeg", "webp": "image/webp"}
+
+class Rect(BaseModel):
+    x: float
+    y: float
+    width: float
+    height: float
+
+class RegionsRequest(BaseModel):
+    # Crop around these marks (sized to each element plus margin) and/or these raw CSS-pixel rectangles
+    mark_ids: Optional[list[str]] = None
+    rects: Optional[list[Rect]] = None
+    # Take mark geometry from this cached frame instead of re-extracting marks
+    screenshot_id: Optional[str] = None
+    margin: int = 8
+    # Keep the red mark labels visible in the crops
+    overlay: bool = False
+    format: str = "png"
+    quality: int = 80
+    transport: str = "json"
+    compress: bool = False
+
+class MarkEmbeddingsRequest(BaseModel):
+    # Embed marks of a previously captured frame, or capture a fresh marked frame when omitted
+    screenshot_id: Optional[str] = None
+    # Restrict embedding to these marks (defaults to every mark of the frame)
+    marks_mapping: Optional[dict] = None
+    # "fixed": crop_size box centered on the mark (how anchors are taught); "element": element box plus margin
+    crop: str = "fixed"
+    crop_size: int = 100
+    margin: int = 8
+
+class FingerprintRequest(BaseModel):
+    mark_ids: list[str]
+
+class LocateRequest(BaseModel):
+    # A fingerprint from /perception/fingerprint (tag, role, name, text, attrs, path)
+    fingerprint: dict
+    # The best candidate only counts if it scores at least min_score and leads the runner-up by min_margin
+    min_score: float = 0.8
+    min_margin: float = 0.1
+
+class BatchAction(BaseModel):
+    # navigate | click | type | key | scroll | wait | evaluate | screenshot
+    action: str
+    url: Optional[str] = None
+    # click target (or scroll cursor position); mark_id resolves through the page's mark registry,
+    # fingerprint through an in-page DOM match (fails when unresolved or ambiguous, see LocateRequest)
+    x: Optional[int] = None
+    y: Optional[int] = None
+    mark_id: Optional[str] = None
+    fingerprint: Optional[dict] = None
+    min_score: float = 0.8
+    min_margin: float = 0.1
+    text: Optional[str] = None
+    # Playwright key name, e.g. "Enter" or "Control+A"
+    key: Optional[str] = None
+    delta_x: int = 0
+    delta_y: int = 0
+    # click/type/scroll input profile and type's bulk insert mode (see Coordinates/TypeRequest)
+    profile: Optional[str] = None
+    insert_text: Optional[bool] = None
+    js_code: Optional[str] = None
+    wait: Optional[WaitRequest] = None
+    # screenshot: marks overlay, capture options, whether to return the image, and skip-if-unchanged token
+    marks: bool = True
+    options: Optional[CaptureOptions] = None
+    image: bool = True
+    since_version: Optional[str] = None
+
+class BatchRequest(BaseModel):
+    actions: list[BatchAction]
+    # Skip the remaining actions after the first failure
+    stop_on_error: bool = True
+    transport: str = "json"
+    compress: bool = False
+
+def resolve_session(request: Request) -> Session:
+    session_id = request.path_params.get("session_id", DEFAULT_SESSION_ID)
+    session = sessions.get(session_id)
+    if session is None:
+        if session_id == DEFAULT_SESSION_ID:
+            raise HTTPException(status_code=503, detail="Browser not initialized")
+        raise HTTPException(status_code=404, detail=f"Session {session_id} not found")
+    session.last_used = time.time()
+    return session
+
 # --- Endpoints ---
 @app.get("/v1/health/status")
 async def health_check():
-    if not page:
+    if DEFAULT_SESSION_ID not in sessions:
         raise HTTPException(status_code=503, detail="Browser not initialized")
-    return {"status": "ok", "environment": "sandbox"}
+    return {"status": "ok", "environment": "sandbox", "sessions": len(sessions), "max_sessions": MAX_SESSIONS, "pool": pool_report()}
 
-@app.get("/v1/perception/screenshot")
-async def capture_screenshot(marks: bool = True):
-    if not page:
+@app.post("/v1/sessions")
+async def create_session(req: Optional[SessionCreateRequest] = None):
+    if not browser:
         raise HTTPException(status_code=503, detail="Browser not initialized")
+    if req and req.input_profile and req.input_profile not in INPUT_PROFILES:
+        raise HTTPException(status_code=400, detail=f"input profile must be one of {', '.join(INPUT_PROFILES)}")
+    start = time.perf_counter()
+    session = await open_session(req.session_id if req else None)
+    if req and req.input_profile:
+        session.input_profile = req.input_profile
+    return {**session.info(), "startup_ms": round((time.perf_counter() - start) * 1000, 1)}
+
+@app.get("/v1/sessions")
+async def list_sessions():
+    return {"sessions": [session.info() for session in sessions.values()], "max_sessions": MAX_SESSIONS, "pool": pool_report()}
+
+@app.delete("/v1/sessions/{session_id}")
+async def destroy_session(session_id: str):
+    if session_id == DEFAULT_SESSION_ID:
+        raise HTTPException(status_code=400, detail="The default session can't be destroyed")
+    await close_session(session_id)
+    return {"status": "closed", "session_id": session_id}
+
+async def render_screenshot(session: Session, options: CaptureOptions) -> bytes:
+    if options.format not in IMAGE_MEDIA_TYPES:
+        raise HTTPException(status_code=400, detail=f"format must be one of {', '.join(IMAGE_MEDIA_TYPES)}")
+    scale = min(max(options.scale, 0.1), 1.0)
+    page = session.page
+    
+    if options.fast or options.format == "webp" or scale != 1.0:
+        # CDP encodes straight from the compositor and can downscale via the clip, skipping a full-size encode
+        viewport = page.viewport_size or VIEWPORT
+        params = {
+            "format": options.format,
+            "optimizeForSpeed": options.fast,
+            "clip": {"x": 0, "y": 0, "width": viewport["width"], "height": viewport["height"], "scale": scale}
+        }
+        if options.format != "png":
+            params["quality"] = options.quality
+        cdp = await session.get_cdp_session()
+        result = await cdp.send("Page.captureScreenshot", params)
+        image_bytes = base64.b64decode(result["data"])
+    elif options.format == "jpeg":
+        image_bytes = await page.screenshot(type="jpeg", quality=options.quality)
+    else:
+        image_bytes = await page.screenshot()
+        
+    if options.grayscale:
+        img = Image.open(BytesIO(image_bytes)).convert("L")
+        buffered = BytesIO()
+        save_args = {} if options.format == "png" else {"quality": options.quality}
+        img.save(buffered, format=options.format.upper(), **save_args)
+        image_bytes = buffered.getvalue()
+    return image_bytes
+
+async def call_marks_engine(session: Session, method: str, arg=None):
+    invoke = f"arg => {MARKS_ENGINE} ? {MARKS_ENGINE}.{method}(arg) : null"
+    result = await session.page.evaluate(invoke, arg)
+    if result is None:
+        # Documents that predate the init script (e.g. the initial about:blank) get the engine injected once
+        await session.page.evaluate(MARKS_ENGINE_JS)
+        result = await session.page.evaluate(invoke, arg)
+    return result
+
+async def extract_marks(session: Session, overlay: bool = True) -> dict:
+    # {marks, epoch, version, timing}. Mark ids are stable for the lifetime of the document (epoch);
+    # the engine waits for the overlay to paint before resolving.
+    return await call_marks_engine(session, "extract", {"overlay": overlay})
+
+async def page_state(session: Session) -> dict:
+    # Current page version. "version" is an opaque token: equal tokens mean no navigation, action,
+    # DOM mutation, scroll or viewport change happened in between.
+    state = await call_marks_engine(session, "state")
+    state["navigation"] = session.navigation_count
+    state["actions"] = session.action_count
+    state["version"] = f"{session.navigation_count}.{session.action_count}.{state['epoch']}.{state['page_version']}"
+    return state
+
+async def frame_hash(session: Session) -> str:
+    # 64-bit difference hash of a tiny CDP capture: a perceptual check for changes the DOM doesn't reflect
+    viewport = session.page.viewport_size or VIEWPORT
+    cdp = await session.get_cdp_session()
+    result = await cdp.send("Page.captureScreenshot", {
+        "format": "jpeg",
+        "quality": 50,
+        "optimizeForSpeed": True,
+        "clip": {"x": 0, "y": 0, "width": viewport["width"], "height": viewport["height"], "scale": 0.05}
+    })
+    img = Image.open(BytesIO(base64.b64decode(result["data"]))).convert("L").resize((9, 8), Image.BILINEAR)
+    pixels = list(img.getdata())
+    bits = 0
+    for row in range(8):
+        for col in range(8):
+            bits = (bits << 1) | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+    return f"{bits:016x}"
+
+async def wait_for_quiescence(session: Session, req: WaitRequest) -> dict:
+    # Polls network, DOM, animation and font state until all enabled conditions hold or the timeout hits.
+    # "condition" names the one that settled last, i.e. what the wait was actually blocked on.
+    start = time.monotonic()
+    deadline = start + req.timeout_ms / 1000
+    settled_at = {}
+    while True:
+        now = time.monotonic()
+        background_cutoff = now - LONG_REQUEST_MS / 1000
+        active = sum(1 for started in session.inflight_requests.values() if started >= background_cutoff)
+        try:
+            quiet = await call_marks_engine(session, "quiet")
+        except Exception:
+            # Execution context destroyed mid-navigation: clearly not settled yet
+            quiet = None
+            
+        conditions = {
+            "network_idle": active == 0 and (now - session.last_network_at) * 1000 >= req.network_idle_ms,
+            "dom_quiet": quiet is not None and quiet["since_mutation_ms"] >= req.dom_quiet_ms
+        }
+        if req.animations:
+            conditions["animations_done"] = quiet is not None and quiet["animations"] == 0
+        if req.fonts:
+            conditions["fonts_ready"] = quiet is not None and quiet["fonts_ready"]
+            
+        elapsed_ms = round((now - start) * 1000, 1)
+        for name, met in conditions.items():
+            if met:
+                settled_at.setdefault(name, elapsed_ms)
+            else:
+                settled_at.pop(name, None)
+                
+        if all(conditions.values()):
+            return {
+                "settled": True,
+                "condition": max(settled_at, key=settled_at.get),
+                "elapsed_ms": elapsed_ms,
+                "settled_at_ms": settled_at,
+                "inflight_requests": active
+            }
+        if now >= deadline:
+            return {
+                "settled": False,
+                "condition": "timeout",
+                "elapsed_ms": elapsed_ms,
+                "pending": [name for name, met in conditions.items() if not met],
+                "settled_at_ms": settled_at,
+                "inflight_requests": active
+            }
+        await asyncio.sleep(req.poll_ms / 1000)
+
+async def clear_marks(session: Session):
+    # Cleanup marks after screenshot so they don't break functionality
+    await session.page.evaluate(f"() => {MARKS_ENGINE} && {MARKS_ENGINE}.clear()")
+
+def crop_box(mark: dict, crop: str = "fixed", crop_size: int = 100, margin: int = 8) -> list:
+    # [left, top, right, bottom] in CSS pixels
+    if crop == "element":
+        return [
+            mark["left"] - margin,
+            mark["top"] - margin,
+            mark["left"] + mark["width"] + margin,
+            mark["top"] + mark["height"] + margin
+        ]
+    half = crop_size // 2
+    return [mark["x"] - half, mark["y"] - half, mark["x"] + half, mark["y"] + half]
+
+def clamp_box(session: Session, box: list) -> list:
+    viewport = session.page.viewport_size or VIEWPORT
+    left, top, right, bottom = box
+    return [max(0, left), max(0, top), min(viewport["width"], right), min(viewport["height"], bottom)]
+
+async def capture_regions(session: Session, boxes: list, options: CaptureOptions = None) -> list:
+    # One lossless render of the viewport, every box cropped from it in-process: a single Chrome capture
+    # per call however many regions, and all crops show the same instant of the page
+    options = options or CaptureOptions()
+    boxes = [clamp_box(session, box) for box in boxes]
+    if options.format not in IMAGE_MEDIA_TYPES:
+        raise HTTPException(status_code=400, detail=f"format must be one of {', '.join(IMAGE_MEDIA_TYPES)}")
+    if not boxes:
+        return []
+        
+    # Decode, crop and encode are CPU-bound, so they run off the event loop other sessions share
+    png = await render_screenshot(session, CaptureOptions(format="png", fast=True))
+    return await asyncio.to_thread(crop_regions, png, boxes, options.format, options.quality)
+
+def crop_regions(png: bytes, boxes: list, format: str, quality: int) -> list:
+    frame = Image.open(BytesIO(png))
+    save_args = {}
+    if format != "png":
+        frame = frame.convert("RGB")
+        save_args["quality"] = quality
+    crops = []
+    for left, top, right, bottom in boxes:
+        buffered = BytesIO()
+        region = frame.crop((round(left), round(top), max(round(left) + 1, round(right)), max(round(top) + 1, round(bottom))))
+        region.save(buffered, format=format.upper(), **save_args)
+        crops.append(buffered.getvalue())
+    return crops
+
+async def post_embedding_api(path: str, payload: dict) -> dict:
+    global embedding_client
+    if embedding_client is None:
+        embedding_client = httpx.AsyncClient(timeout=60)
+    res = await embedding_client.post(f"{EMBEDDING_API_URL}{path}", json=payload)
+    if res.status_code != 200:
+        raise HTTPException(status_code=502, detail=f"Embedding API error: {res.text}")
+    return res.json()
+
+async def capture_frame(session: Session, marks: bool = True, options: CaptureOptions = None):
+    options = options or CaptureOptions()
+    state = await page_state(session)
+    # The mark labels are painted into the page before the capture, so a marked and an unmarked frame of
+    # the same version are different images (and mark crops are embedded from the marked one): only
+    # requests with the same marks flag and capture options share an entry
+    cache_key = (state["version"], marks, options.model_dump_json())
+    cached_id = session.perception_cache.get(cache_key)
+    if cached_id in session.screenshot_cache:
+        cached = session.screenshot_cache[cached_id]
+        if time.monotonic() - cached["captured_at"] <= PERCEPTION_CACHE_TTL:
+            session.screenshot_cache.move_to_end(cached_id)
+            return {**cached, "cached": True}
+            
+    extracted = await extract_marks(session) if marks else {"marks": {}, "epoch": None, "version": None, "timing": None}
+    
+    # Capture the viewport directly from the DOM state
+    screenshot_bytes = await render_screenshot(session, options)
+    
+    if marks:
+        await clear_marks(session)
+        
+    frame = {
+        "screenshot_id": uuid.uuid4().hex,
+        "image": screenshot_bytes,
+        "marks_mapping": extracted["marks"],
+        "marks_epoch": extracted["epoch"],
+        "marks_version": extracted["version"],
+        "marks_timing": extracted["timing"],
+        "media_type": IMAGE_MEDIA_TYPES[options.format],
+        "scale": min(max(options.scale, 0.1), 1.0),
+        "page_version": state["version"],
+        "captured_at": time.monotonic(),
+        "cached": False
+    }
+    session.screenshot_cache[frame["screenshot_id"]] = frame
+    while len(session.screenshot_cache) > SCREENSHOT_CACHE_SIZE:
+        session.screenshot_cache.popitem(last=False)
+        
+    # Only reusable if nothing changed while we were capturing
+    if (await page_state(session))["version"] == state["version"]:
+        session.perception_cache[cache_key] = frame["screenshot_id"]
+        while len(session.perception_cache) > SCREENSHOT_CACHE_SIZE:
+            session.perception_cache.popitem(last=False)
+    return frame
+
+def multipart_response(meta: dict, images: list, media_type: str, compress: bool = False) -> Response:
+    # multipart/mixed body: a JSON metadata part followed by one part per raw image.
+    # Each part carries Content-Length so clients can slice parts without scanning the image for the boundary.
+    boundary = uuid.uuid4().hex
+    meta_bytes = json.dumps(meta, separators=(",", ":")).encode("utf-8")
+    meta_headers = "Content-Type: application/json"
+    if compress:
+        meta_bytes = gzip.compress(meta_bytes, compresslevel=5)
+        meta_headers += "\r\nContent-Encoding: gzip"
+        
+    chunks = [
+        f"--{boundary}\r\n{meta_headers}\r\nContent-Length: {len(meta_bytes)}\r\n\r\n".encode("ascii"),
+        meta_bytes
+    ]
+    for image_bytes in images:
+        chunks.append(f"\r\n--{boundary}\r\nContent-Type: {media_type}\r\nContent-Length: {len(image_bytes)}\r\n\r\n".encode("ascii"))
+        chunks.append(image_bytes)
+    chunks.append(f"\r\n--{boundary}--\r\n".encode("ascii"))
+    return Response(content=b"".join(chunks), media_type=f"multipart/mixed; boundary={boundary}")
+
+def frame_meta(frame: dict) -> dict:
+    return {
+        "screenshot_id": frame["screenshot_id"],
+        "marks_mapping": frame["marks_mapping"],
+        "marks_epoch": frame["marks_epoch"],
+        "marks_version": frame["marks_version"],
+        "marks_timing": frame["marks_timing"],
+        "scale": frame["scale"],
+        "page_version": frame["page_version"],
+        "cached": frame["cached"]
+    }
+
+def frame_response(image_bytes: bytes, media_type: str, meta: dict, compress: bool = False) -> Response:
+    return multipart_response(meta, [image_bytes], media_type, compress)
+
+@router.get("/perception/screenshot")
+async def capture_screenshot(marks: bool = True, image: bool = True, transport: str = "json", compress: bool = False,
+                             options: CaptureOptions = Depends(), session: Session = Depends(resolve_session)):
+    if transport not in ("json", "binary"):
+        raise HTTPException(status_code=400, detail="transport must be 'json' or 'binary'")
+    try:
+        async with session.lock:
+            frame = await capture_frame(session, marks, options)
+        meta = frame_meta(frame)
+        if transport == "binary" and image:
+            return frame_response(frame["image"], frame["media_type"], meta, compress)
+            
+        # image=false keeps the frame server-side only; callers reference it via screenshot_id
+        meta["image_base64"] = base64.b64encode(frame["image"]).decode('utf-8') if image else None
+        meta["media_type"] = frame["media_type"]
+        return meta
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@router.get("/perception/version")
+async def get_page_version(hash: bool = False, session: Session = Depends(resolve_session)):
+    # Lightweight "has the page changed?" probe: no marks, no full screenshot
+    try:
+        state = await page_state(session)
+        state["frame_hash"] = await frame_hash(session) if hash else None
+        return state
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@router.post("/perception/wait")
+async def wait_for_settle(req: Optional[WaitRequest] = None, session: Session = Depends(resolve_session)):
+    try:
+        return await wait_for_quiescence(session, req or WaitRequest())
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@router.get("/perception/marks")
+async def get_marks(since: Optional[int] = None, epoch: Optional[str] = None, session: Session = Depends(resolve_session)):
+    # Marks added/moved and ids removed since registry version `since`, without drawing or screenshotting.
+    # A different epoch (new document) or a version the registry no longer covers returns a full snapshot.
     try:
-        marks_mapping = {}
-        if marks:
-            js_payload = """
-            () => {
-                // Remove existing marks
-                document.querySelectorAll('.isomind-mark').forEach(e => e.remove());
+        result = await call_marks_engine(session, "diff", since)
+        if epoch is not None and epoch != result["epoch"] and not result["full"]:
+            result = await call_marks_engine(session, "diff", None)
+        return result
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+async def locate_element(session: Session, fingerprint: dict, min_score: float, min_margin: float) -> dict:
+    # One evaluate: score the page's visible marks against the fingerprint, then accept or reject the best one
+    result = await call_marks_engine(session, "locate", fingerprint)
+    candidates = result["candidates"]
+    best = candidates[0] if candidates else None
+    runner_up = candidates[1]["score"] if len(candidates) > 1 else 0.0
+    margin = best["score"] - runner_up if best else 0.0
+    reason = None
+    if best is None:
+        reason = f"no visible <{fingerprint.get('tag')}> candidates"
+    elif best["score"] < min_score:
+        reason = f"best score {best['score']:.2f} below {min_score:.2f}"
+    elif margin < min_margin:
+        reason = f"ambiguous: margin {margin:.2f} below {min_margin:.2f}"
+    return {
+        "resolved": reason is None,
+        "reason": reason,
+        "mark_id": best["id"] if best else None,
+        "score": best["score"] if best else 0.0,
+        "margin": margin,
+        "mark": best["mark"] if best else None,
+        "considered": result["considered"],
+        "elapsed_ms": round(result["elapsed_ms"], 1)
+    }
+
+@router.post("/perception/fingerprint")
+async def get_fingerprints(req: FingerprintRequest, session: Session = Depends(resolve_session)):
+    # DOM fingerprints of marks (ids from any frame of the current document) for later DOM-first resolution
+    try:
+        return {"fingerprints": await call_marks_engine(session, "fingerprint", req.mark_ids)}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@router.post("/perception/locate")
+async def locate_fingerprint(req: LocateRequest, session: Session = Depends(resolve_session)):
+    try:
+        return await locate_element(session, req.fingerprint, req.min_score, req.min_margin)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@router.post("/perception/regions")
+async def capture_mark_regions(req: RegionsRequest, session: Session = Depends(resolve_session)):
+    if req.transport not in ("json", "binary"):
+        raise HTTPException(status_code=400, detail="transport must be 'json' or 'binary'")
+    try:
+        async with session.lock:
+            regions = []
+            drew_overlay = False
+            if req.mark_ids:
+                if req.screenshot_id:
+                    if req.screenshot_id not in session.screenshot_cache:
+                        raise HTTPException(status_code=404, detail=f"Screenshot {req.screenshot_id} expired or unknown")
+                    marks_mapping = session.screenshot_cache[req.screenshot_id]["marks_mapping"]
+                    if req.overlay:
+                        await extract_marks(session)
+                        drew_overlay = True
+                else:
+                    marks_mapping = (await extract_marks(session, overlay=req.overlay))["marks"]
+                    drew_overlay = req.overlay
+                for mark_id in req.mark_ids:
+                    if str(mark_id) not in marks_mapping:
+                        raise HTTPException(status_code=404, detail=f"Mark {mark_id} not found")
+                    regions.append({"id": str(mark_id), "box": crop_box(marks_mapping[str(mark_id)], "element", margin=req.margin)})
+            for i, rect in enumerate(req.rects or []):
+                regions.append({
+                    "id": f"rect_{i}",
+                    "box": [rect.x - req.margin, rect.y - req.margin, rect.x + rect.width + req.margin, rect.y + rect.height + req.margin]
+                })
+            if not regions:
+                raise HTTPException(status_code=400, detail="Provide mark_ids and/or rects")
                 
-                let interactives = document.querySelectorAll('a, button, input, textarea, select, details, [tabindex]:not([tabindex="-1"]), [role="button"], [role="link"], [role="checkbox"], [role="menuitem"], [role="tab"]');
-                let marks = {};
-                let counter = 1;
+            try:
+                crops = await capture_regions(session, [r["box"] for r in regions], CaptureOptions(format=req.format, quality=req.quality))
+            finally:
+                if drew_overlay:
+                    await clear_marks(session)
+                    
+        for region in regions:
+            left, top, right, bottom = clamp_box(session, region.pop("box"))
+            region["rect"] = {"x": left, "y": top, "width": right - left, "height": bottom - top}
+            
+        media_type = IMAGE_MEDIA_TYPES[req.format]
+        if req.transport == "binary":
+            # Image parts follow the metadata part in the same order as "regions"
+            return multipart_response({"regions": regions}, crops, media_type, req.compress)
+        for region, crop in zip(regions, crops):
+            region["image_base64"] = base64.b64encode(crop).decode('utf-8')
+        return {"regions": regions, "media_type": media_type}
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@router.post("/perception/embeddings")
+async def embed_marks(req: MarkEmbeddingsRequest, session: Session = Depends(resolve_session)):
+    if req.crop not in ("fixed", "element"):
+        raise HTTPException(status_code=400, detail="crop must be 'fixed' or 'element'")
+    try:
+        if req.screenshot_id:
+            if req.screenshot_id not in session.screenshot_cache:
+                raise HTTPException(status_code=404, detail=f"Screenshot {req.screenshot_id} expired or unknown")
+            frame = session.screenshot_cache[req.screenshot_id]
+            marks_mapping = req.marks_mapping if req.marks_mapping is not None else frame["marks_mapping"]
+            if not marks_mapping:
+                return {"screenshot_id": req.screenshot_id, "marks_mapping": {}, "embeddings": {}}
                 
-                interactives.forEach(el => {
-                    let rect = el.getBoundingClientRect();
-                    // Check if visible
-                    if (rect.width > 5 && rect.height > 5 && rect.top >= 0 && rect.left >= 0 && 
-                        rect.bottom <= (window.innerHeight || document.documentElement.clientHeight) && 
-                        rect.right <= (window.innerWidth || document.documentElement.clientWidth)) {
-                        
-                        let style = window.getComputedStyle(el);
-                        if (style.display !== 'none' && style.visibility !== 'hidden' && style.opacity !== '0') {
-                            let id = counter++;
-                            let mark = document.createElement('div');
-                            mark.className = 'isomind-mark';
-                            mark.innerText = id;
-                            mark.style.position = 'fixed';
-                            mark.style.top = Math.max(0, rect.top - 10) + 'px';
-                            mark.style.left = Math.max(0, rect.left - 10) + 'px';
-                            mark.style.backgroundColor = 'red';
-                            mark.style.color = 'white';
-                            mark.style.border = '1px solid black';
-                            mark.style.borderRadius = '3px';
-                            mark.style.padding = '1px 3px';
-                            mark.style.fontSize = '12px';
-                            mark.style.fontWeight = 'bold';
-                            mark.style.zIndex = '999999';
-                            mark.style.pointerEvents = 'none';
-                            document.body.appendChild(mark);
-                            
-                            marks[id] = {
-                                x: Math.round(rect.left + (rect.width / 2)),
-                                y: Math.round(rect.top + (rect.height / 2)),
-                                width: Math.round(rect.width),
-                                height: Math.round(rect.height),
-                                top: Math.round(rect.top),
-                                left: Math.round(rect.left)
-                            };
-                        }
-                    }
-                });
-                return marks;
+            # Crop every mark out of the cached frame inside embedding_api.
+            # Marks are in CSS pixels, so boxes follow the frame's downscale factor.
+            scale = frame["scale"]
+            regions = {
+                str(mark_id): [round(v * scale) for v in crop_box(m, req.crop, req.crop_size, req.margin)]
+                for mark_id, m in marks_mapping.items()
             }
-            """
-            marks_mapping = await page.evaluate(js_payload)
-            # Small sleep to ensure render
-            await asyncio.sleep(0.1)
-
-        # Capture a 1920x1080 screenshot directly from the DOM state
-        screenshot_bytes = await page.screenshot()
-        encoded = base64.b64encode(screenshot_bytes).decode('utf-8')
-        
-        # Cleanup marks after screenshot so they don't break functionality
-        if marks:
-            await page.evaluate("() => { document.querySelectorAll('.isomind-mark').forEach(e => e.remove()); }")
+            data = await post_embedding_api("/v1/embed/regions", {
+                "image_base64": base64.b64encode(frame["image"]).decode('utf-8'),
+                "regions": regions
+            })
+            return {"screenshot_id": req.screenshot_id, "marks_mapping": marks_mapping, "embeddings": data["embeddings"]}
             
-        return {
-            "image_base64": encoded,
-            "marks_mapping": marks_mapping
-        }
+        # Live page: clip just the mark regions from one render, with labels drawn the way anchors were taught
+        async with session.lock:
+            fresh_marks = (await extract_marks(session))["marks"]
+            try:
+                marks_mapping = req.marks_mapping if req.marks_mapping is not None else fresh_marks
+                mark_ids = [str(mark_id) for mark_id in marks_mapping.keys()]
+                crops = await capture_regions(session, [crop_box(marks_mapping[m], req.crop, req.crop_size, req.margin) for m in mark_ids]) if mark_ids else []
+            finally:
+                await clear_marks(session)
+        if not mark_ids:
+            return {"screenshot_id": None, "marks_mapping": {}, "embeddings": {}}
+            
+        data = await post_embedding_api("/v1/embed/images", {
+            "images_base64": [base64.b64encode(crop).decode('utf-8') for crop in crops]
+        })
+        return {"screenshot_id": None, "marks_mapping": marks_mapping, "embeddings": dict(zip(mark_ids, data["embeddings"]))}
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.post("/v1/action/browser/navigate")
-async def browser_navigate(req: NavigateRequest):
-    if not page:
-        raise HTTPException(status_code=503, detail="Browser not initialized")
+async def perform_navigate(session: Session, url: str) -> dict:
+    await session.page.goto(url, wait_until="domcontentloaded")
+    session.record_action()
+    return {"status": "simulated_navigation", "url": url}
+
+async def perform_evaluate(session: Session, js_code: str) -> dict:
+    result = await session.page.evaluate(js_code)
+    session.record_action()
+    return {"status": "evaluated", "result": result}
+
+# Input actions report input_ms: time spent generating input events, including humanized pauses
+async def perform_click(session: Session, x: int, y: int, profile: str = None) -> dict:
+    params = resolve_input_profile(session, profile)
+    start = time.perf_counter()
+    await move_mouse_humanly(session, x, y, params)
+    await asyncio.sleep(random.uniform(*params["pre_click"]))
+    await session.page.mouse.down()
+    await asyncio.sleep(random.uniform(*params["press"]))
+    await session.page.mouse.up()
+    session.record_action()
+    return {"status": "simulated_human_click", "x": x, "y": y, "input_ms": round((time.perf_counter() - start) * 1000, 1)}
+
+async def perform_type(session: Session, text: str, profile: str = None, insert_text: bool = None) -> dict:
+    params = resolve_input_profile(session, profile)
+    start = time.perf_counter()
+    if params["insert_text"] if insert_text is None else insert_text:
+        # One Input.insertText event: no per-key events, for long inputs on sites that don't inspect keystrokes
+        await session.page.keyboard.insert_text(text)
+    else:
+        await session.page.keyboard.type(text, delay=random.randint(*params["key_delay_ms"]))
+    session.record_action()
+    return {"status": "simulated_human_type", "text": text, "input_ms": round((time.perf_counter() - start) * 1000, 1)}
+
+async def perform_key(session: Session, key: str) -> dict:
+    start = time.perf_counter()
+    await session.page.keyboard.press(key)
+    session.record_action()
+    return {"status": "pressed", "key": key, "input_ms": round((time.perf_counter() - start) * 1000, 1)}
+
+async def perform_scroll(session: Session, delta_x: int, delta_y: int, x: int = None, y: int = None, profile: str = None) -> dict:
+    params = resolve_input_profile(session, profile)
+    start = time.perf_counter()
+    # Wheel events go to the element under the cursor, so move there first when a position is given
+    if x is not None and y is not None:
+        await move_mouse_humanly(session, x, y, params)
+    await session.page.mouse.wheel(delta_x, delta_y)
+    session.record_action()
+    return {"status": "scrolled", "delta_x": delta_x, "delta_y": delta_y, "input_ms": round((time.perf_counter() - start) * 1000, 1)}
+
+@router.put("/input/profile")
+async def set_input_profile(req: InputProfileRequest, session: Session = Depends(resolve_session)):
+    resolve_input_profile(session, req.profile)
+    session.input_profile = req.profile
+    return {"session_id": session.session_id, "input_profile": session.input_profile, **INPUT_PROFILES[req.profile]}
+
+@router.post("/action/browser/navigate")
+async def browser_navigate(req: NavigateRequest, session: Session = Depends(resolve_session)):
     try:
-        await page.goto(req.url, wait_until="domcontentloaded")
-        return {"status": "simulated_navigation", "url": req.url}
+        async with session.lock:
+            return await perform_navigate(session, req.url)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.post("/v1/action/browser/evaluate")
-async def browser_evaluate(req: EvaluateRequest):
-    if not page:
-        raise HTTPException(status_code=503, detail="Browser not initialized")
+@router.post("/action/browser/evaluate")
+async def browser_evaluate(req: EvaluateRequest, session: Session = Depends(resolve_session)):
     try:
-        result = await page.evaluate(req.js_code)
-        return {"status": "evaluated", "result": result}
+        async with session.lock:
+            return await perform_evaluate(session, req.js_code)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.post("/v1/action/mouse/click")
-async def mouse_click(coords: Coordinates):
-    global current_mouse_x, current_mouse_y
-    if not page:
-        raise HTTPException(status_code=503, detail="Browser not initialized")
+@router.post("/action/mouse/click")
+async def mouse_click(coords: Coordinates, session: Session = Depends(resolve_session)):
     try:
-        await move_mouse_humanly(page, current_mouse_x, current_mouse_y, coords.x, coords.y)
-        await asyncio.sleep(random.uniform(0.1, 0.3))
-        await page.mouse.down()
-        await asyncio.sleep(random.uniform(0.05, 0.15))
-        await page.mouse.up()
-        return {"status": "simulated_human_click", "x": coords.x, "y": coords.y}
+        async with session.lock:
+            return await perform_click(session, coords.x, coords.y, coords.profile)
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.post("/v1/action/keyboard/type")
-async def keyboard_type(req: TypeRequest):
-    if not page:
-        raise HTTPException(status_code=503, detail="Browser not initialized")
+@router.post("/action/keyboard/type")
+async def keyboard_type(req: TypeRequest, session: Session = Depends(resolve_session)):
     try:
-        await page.keyboard.type(req.text, delay=random.randint(50, 150))
-        return {"status": "simulated_human_type", "text": req.text}
+        async with session.lock:
+            return await perform_type(session, req.text, req.profile, req.insert_text)
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+
+async def run_batch_action(session: Session, action: BatchAction, images: list) -> dict:
+    if action.action == "navigate":
+        if not action.url:
+            raise ValueError("navigate requires url")
+        return await perform_navigate(session, action.url)
+    if action.action == "click":
+        x, y = action.x, action.y
+        if action.fingerprint is not None:
+            match = await locate_element(session, action.fingerprint, action.min_score, action.min_margin)
+            if not match["resolved"]:
+                raise ValueError(f"Fingerprint not resolved ({match['reason']})")
+            result = await perform_click(session, match["mark"]["x"], match["mark"]["y"], action.profile)
+            result["match"] = {key: match[key] for key in ("mark_id", "score", "margin", "considered", "elapsed_ms")}
+            return result
+        if action.mark_id is not None:
+            # Mark ids are stable per document, so ids from an earlier frame still resolve here
+            marks = (await call_marks_engine(session, "diff", None))["changed"]
+            if str(action.mark_id) not in marks:
+                raise ValueError(f"Mark {action.mark_id} not found")
+            x, y = marks[str(action.mark_id)]["x"], marks[str(action.mark_id)]["y"]
+        if x is None or y is None:
+            raise ValueError("click requires x/y or mark_id")
+        return await perform_click(session, x, y, action.profile)
+    if action.action == "type":
+        if action.text is None:
+            raise ValueError("type requires text")
+        return await perform_type(session, action.text, action.profile, action.insert_text)
+    if action.action == "key":
+        if not action.key:
+            raise ValueError("key requires key")
+        return await perform_key(session, action.key)
+    if action.action == "scroll":
+        return await perform_scroll(session, action.delta_x, action.delta_y, action.x, action.y, action.profile)
+    if action.action == "wait":
+        return await wait_for_quiescence(session, action.wait or WaitRequest())
+    if action.action == "evaluate":
+        if not action.js_code:
+            raise ValueError("evaluate requires js_code")
+        return await perform_evaluate(session, action.js_code)
+    if action.action == "screenshot":
+        if action.since_version is not None:
+            state = await page_state(session)
+            if state["version"] == action.since_version:
+                return {"unchanged": True, "page_version": state["version"]}
+        frame = await capture_frame(session, action.marks, action.options or CaptureOptions())
+        meta = frame_meta(frame)
+        if action.image:
+            # Binary transport appends the image as a part; JSON inlines it
+            images.append(frame["image"])
+            meta["image_index"] = len(images) - 1
+        meta["media_type"] = frame["media_type"]
+        return meta
+    raise ValueError(f"Unknown action '{action.action}'")
+
+@router.post("/action/batch")
+async def action_batch(req: BatchRequest, session: Session = Depends(resolve_session)):
+    # Runs the actions in order under one session lock: one tunnel round-trip for a whole step
+    if req.transport not in ("json", "binary"):
+        raise HTTPException(status_code=400, detail="transport must be 'json' or 'binary'")
+    if req.transport == "binary":
+        # Checked before anything runs, so a batch is never performed only to be rejected afterwards
+        formats = {(a.options or CaptureOptions()).format for a in req.actions if a.action == "screenshot" and a.image}
+        if len(formats) > 1:
+            raise HTTPException(status_code=400, detail="Binary batches need one image format across screenshots")
+    results = []
+    images = []
+    batch_start = time.perf_counter()
+    failed = False
+    async with session.lock:
+        for index, action in enumerate(req.actions):
+            if failed and req.stop_on_error:
+                results.append({"index": index, "action": action.action, "status": "skipped"})
+                continue
+            start = time.perf_counter()
+            entry = {"index": index, "action": action.action}
+            try:
+                entry["result"] = await run_batch_action(session, action, images)
+                entry["status"] = "ok"
+            except HTTPException as e:
+                entry["status"] = "error"
+                entry["error"] = e.detail
+                failed = True
+            except Exception as e:
+                entry["status"] = "error"
+                entry["error"] = str(e)
+                failed = True
+            entry["elapsed_ms"] = round((time.perf_counter() - start) * 1000, 1)
+            results.append(entry)
+            
+    meta = {
+        "results": results,
+        "completed": sum(1 for r in results if r["status"] == "ok"),
+        "failed": failed,
+        "elapsed_ms": round((time.perf_counter() - batch_start) * 1000, 1)
+    }
+    if req.transport == "binary" and images:
+        media_type = next(r["result"]["media_type"] for r in results if r["status"] == "ok" and "image_index" in r["result"])
+        return multipart_response(meta, images, media_type, req.compress)
+    for r in results:
+        if r["status"] == "ok" and "image_index" in r["result"]:
+            r["result"]["image_base64"] = base64.b64encode(images[r["result"]["image_index"]]).decode('utf-8')
+    return meta
+
+app.include_router(router, prefix="/v1")
+app.include_router(router, prefix="/v1/sessions/{session_id}")
@@ -0,0 +1,480 @@
+// IsoMind Set-of-Marks engine.
+// Registered once per browser context as an init script, so perception calls only send a short invocation
+// instead of the whole source. The engine hangs off window under a non-enumerable Symbol whose description
+// is a random per-process token substituted by the Agent API: no string property a page
+// script could probe for ('__isomind' in window), and the symbol can't be rebuilt without the token.
+//
+// Interactive elements live in a persistent registry: each element keeps the same mark id for the
+// lifetime of the document, MutationObserver/ResizeObserver flag what changed, and a refresh re-reads
+// every rect (cheap) but recomputes styles only for flagged elements. Every change to the visible mark set bumps `version`, which diff()
+// uses to return only the marks added, moved or removed since a given version.
+// Separately, `pageVersion` counts every page change (non-overlay mutations, scroll, viewport and document
+// resizes, finished transitions/animations, late-loading resources, marks found moved by a refresh)
+// so the Agent API can tell whether a cached frame still matches the page.
+// fingerprint()/locate() describe an element by its DOM identity (tag, role, accessible name, text,
+// stable attributes, relative path) and find it again on a later page load without any pixels.
+(() => {
+    const KEY = Symbol.for('__ISOMIND_KEY__');
+    if (window[KEY]) return;
+
+    const SELECTOR = 'a, button, input, textarea, select, details, [tabindex]:not([tabindex="-1"]), [role="button"], [role="link"], [role="checkbox"], [role="menuitem"], [role="tab"]';
+    const OVERLAY_ID = '__isomind_overlay';
+    const LABEL_CSS = 'position:fixed;background-color:red;color:white;border:1px solid black;border-radius:3px;' +
+        'padding:1px 3px;font-size:12px;font-weight:bold;pointer-events:none;';
+    const MAX_TOMBSTONES = 2000;
+    const STABLE_ATTRS = ['id', 'name', 'type', 'placeholder', 'aria-label', 'title', 'alt', 'href', 'for', 'data-testid', 'data-test', 'data-qa'];
+    // Attributes that identify an element on their own count double in locate()
+    const KEY_ATTRS = ['id', 'name', 'data-testid', 'data-test', 'data-qa'];
+    // Generated ids (React useId, numeric counters, hashes) change between page loads
+    const GENERATED_ID = /^:r|\d{3,}|(?=[0-9a-f]*\d)[0-9a-f]{8,}/i;
+
+    // Random per-document token: ids and versions are only comparable within one epoch
+    const epoch = Math.random().toString(36).slice(2);
+    const ids = new WeakMap();      // element -> id
+    const entries = new Map();      // id -> {el, mark, visible, changedAt}
+    const tombstones = new Map();   // id -> version at which it left the registry
+    const dirty = new Set();        // ids needing a style re-read on top of the rect
+    let nextId = 1;
+    let version = 0;
+    let pageVersion = 0;
+    let lastMutationAt = performance.now();
+    let oldestDiffVersion = 0;      // diff() below this version can't be answered incrementally
+    let initialized = false;
+    let documentObserved = false;
+    let mutationObserver = null;
+    let resizeObserver = null;
+
+    function isOverlayNode(node) {
+        if (!node) return false;
+        if (node.id === OVERLAY_ID) return true;
+        const overlay = document.getElementById(OVERLAY_ID);
+        return !!overlay && overlay.contains(node);
+    }
+
+    function register(el) {
+        if (ids.has(el) || isOverlayNode(el)) return;
+        const id = String(nextId++);
+        ids.set(el, id);
+        entries.set(id, { el: el, mark: null, visible: false, changedAt: version });
+        dirty.add(id);
+        if (resizeObserver) resizeObserver.observe(el);
+    }
+
+    function unregister(id) {
+        const entry = entries.get(id);
+        if (!entry) return;
+        entries.delete(id);
+        dirty.delete(id);
+        ids.delete(entry.el);
+        if (resizeObserver) resizeObserver.unobserve(entry.el);
+        if (entry.mark) {
+            version++;
+            tombstones.set(id, version);
+            while (tombstones.size > MAX_TOMBSTONES) {
+                const [oldId, oldVersion] = tombstones.entries().next().value;
+                tombstones.delete(oldId);
+                oldestDiffVersion = Math.max(oldestDiffVersion, oldVersion);
+            }
+        }
+    }
+
+    function registerSubtree(root) {
+        if (root.nodeType !== 1 || isOverlayNode(root)) return;
+        if (root.matches(SELECTOR)) register(root);
+        root.querySelectorAll(SELECTOR).forEach(register);
+    }
+
+    function markSubtreeDirty(root) {
+        if (root.nodeType !== 1) return;
+        const id = ids.get(root);
+        if (id) dirty.add(id);
+        root.querySelectorAll(SELECTOR).forEach(el => {
+            const childId = ids.get(el);
+            if (childId) dirty.add(childId);
+        });
+    }
+
+    function onMutations(records) {
+        observeDocument();
+        let pageChanged = false;
+        for (const record of records) {
+            if (isOverlayNode(record.target)) continue;
+            if (record.type === 'childList') {
+                const onlyOverlay = [...record.addedNodes, ...record.removedNodes].every(isOverlayNode);
+                if (onlyOverlay) continue;
+                record.addedNodes.forEach(registerSubtree);
+                record.removedNodes.forEach(node => {
+                    if (node.nodeType !== 1) return;
+                    const removed = node.matches(SELECTOR) ? [node] : [];
+                    removed.push(...node.querySelectorAll(SELECTOR));
+                    removed.forEach(el => {
+                        const id = ids.get(el);
+                        if (id && !el.isConnected) unregister(id);
+                    });
+                });
+            } else if (record.type === 'attributes') {
+                const el = record.target;
+                // tabindex/role changes can move an element in or out of the candidate set
+                if (el.matches(SELECTOR)) register(el);
+                else if (ids.has(el)) unregister(ids.get(el));
+                markSubtreeDirty(el);
+            } else if (record.target.parentElement) {
+                markSubtreeDirty(record.target.parentElement);
+            }
+            pageChanged = true;
+        }
+        if (pageChanged) {
+            pageVersion++;
+            lastMutationAt = performance.now();
+        }
+    }
+
+    function observeDocument() {
+        // The document's own box grows or shrinks when unregistered content (images, banners) shifts layout.
+        // The init script can run before <html> exists, so this is retried until it does.
+        if (documentObserved || !document.documentElement) return;
+        resizeObserver.observe(document.documentElement);
+        documentObserved = true;
+    }
+
+    function init() {
+        if (initialized) return;
+        initialized = true;
+        resizeObserver = new ResizeObserver(observed => {
+            for (const item of observed) {
+                const id = ids.get(item.target);
+                if (id) dirty.add(id);
+            }
+            pageVersion++;
+        });
+        mutationObserver = new MutationObserver(onMutations);
+        // Observe the document itself: the init script can run before <html> exists
+        mutationObserver.observe(document, {
+            childList: true, subtree: true, attributes: true, characterData: true
+        });
+        const markStale = () => {
+            pageVersion++;
+        };
+        window.addEventListener('scroll', markStale, { capture: true, passive: true });
+        window.addEventListener('resize', markStale, { passive: true });
+        // Layout moves no mutation reports: CSS transitions/animations settling and images or frames loading
+        for (const type of ['transitionend', 'animationend', 'load']) {
+            window.addEventListener(type, markStale, { capture: true, passive: true });
+        }
+        observeDocument();
+        document.querySelectorAll(SELECTOR).forEach(register);
+    }
+
+    function sameMark(a, b) {
+        return !!a && !!b && a.x === b.x && a.y === b.y && a.width === b.width && a.height === b.height;
+    }
+
+    function refresh() {
+        // Read pass only: every rect is re-read (layout can shift without any observer firing), computed
+        // style only for flagged or previously hidden elements
+        init();
+        const t0 = performance.now();
+        if (mutationObserver) onMutations(mutationObserver.takeRecords());
+        const vw = window.innerWidth || document.documentElement.clientWidth;
+        const vh = window.innerHeight || document.documentElement.clientHeight;
+        let measured = 0;
+        let styled = 0;
+        let moved = false;
+
+        for (const [id, entry] of entries) {
+            const fullMeasure = dirty.has(id);
+            if (!entry.el.isConnected) {
+                unregister(id);
+                continue;
+            }
+            measured++;
+            const rect = entry.el.getBoundingClientRect();
+            let mark = null;
+            if (rect.width > 5 && rect.height > 5 && rect.top >= 0 && rect.left >= 0 &&
+                rect.bottom <= vh && rect.right <= vw) {
+                let visible = entry.visible;
+                if (fullMeasure || entry.mark === null) {
+                    const style = window.getComputedStyle(entry.el);
+                    visible = style.display !== 'none' && style.visibility !== 'hidden' && style.opacity !== '0';
+                    entry.visible = visible;
+                    styled++;
+                }
+                if (visible) {
+                    mark = {
+                        x: Math.round(rect.left + (rect.width / 2)),
+                        y: Math.round(rect.top + (rect.height / 2)),
+                        width: Math.round(rect.width),
+                        height: Math.round(rect.height),
+                        top: Math.round(rect.top),
+                        left: Math.round(rect.left)
+                    };
+                }
+            }
+            if (!sameMark(mark, entry.mark) && (mark || entry.mark)) {
+                version++;
+                entry.changedAt = version;
+                // Moved without anything flagging it: frames cached for the current page version are stale
+                if (!fullMeasure) moved = true;
+            }
+            entry.mark = mark;
+        }
+        dirty.clear();
+        if (moved) pageVersion++;
+        return { measure_ms: performance.now() - t0, measured: measured, styled: styled, registered: entries.size };
+    }
+
+    function currentMarks() {
+        const marks = {};
+        for (const [id, entry] of entries) {
+            if (entry.mark) marks[id] = entry.mark;
+        }
+        return marks;
+    }
+
+    function clear() {
+        const overlay = document.getElementById(OVERLAY_ID);
+        if (overlay) overlay.remove();
+    }
+
+    function nextPaint() {
+        // Resolve once the overlay has been painted (double rAF), with a timer fallback for throttled tabs
+        return new Promise(resolve => {
+            const timer = setTimeout(resolve, 50);
+            requestAnimationFrame(() => requestAnimationFrame(() => {
+                clearTimeout(timer);
+                resolve();
+            }));
+        });
+    }
+
+    async function extract(opts) {
+        opts = opts || {};
+        const drawOverlay = opts.overlay !== false;
+        const t0 = performance.now();
+        clear();
+
+        const stats = refresh();
+        const marks = currentMarks();
+        const t1 = performance.now();
+
+        // Write pass: all labels go into one fixed overlay layer that is attached to the DOM once
+        const markIds = Object.keys(marks);
+        if (drawOverlay && markIds.length) {
+            const fragment = document.createDocumentFragment();
+            for (const id of markIds) {
+                const mark = marks[id];
+                const label = document.createElement('div');
+                label.className = 'isomind-mark';
+                label.textContent = id;
+                // cssText goes through CSSOM, which page CSPs do not block (unlike style attributes)
+                label.style.cssText = LABEL_CSS + 'top:' + Math.max(0, mark.top - 10) + 'px;left:' + Math.max(0, mark.left - 10) + 'px;';
+                fragment.appendChild(label);
+            }
+            const overlay = document.createElement('div');
+            overlay.id = OVERLAY_ID;
+            overlay.style.cssText = 'position:fixed;top:0;left:0;width:0;height:0;z-index:2147483647;pointer-events:none;';
+            overlay.appendChild(fragment);
+            (document.body || document.documentElement).appendChild(overlay);
+        }
+        const t2 = performance.now();
+
+        if (drawOverlay && markIds.length) await nextPaint();
+        const t3 = performance.now();
+
+        return {
+            marks: marks,
+            epoch: epoch,
+            version: version,
+            timing: {
+                measure_ms: stats.measure_ms,
+                render_ms: t2 - t1,
+                paint_ms: t3 - t2,
+                total_ms: t3 - t0,
+                registered: stats.registered,
+                measured: stats.measured,
+                styled: stats.styled,
+                visible: markIds.length
+            }
+        };
+    }
+
+    function diff(since) {
+        // Marks added/moved/resized and ids removed or hidden after `since`; full snapshot if it's too old
+        refresh();
+        if (since === null || since === undefined || since < oldestDiffVersion || since > version) {
+            return { epoch: epoch, version: version, full: true, changed: currentMarks(), removed: [] };
+        }
+        const changed = {};
+        const removed = [];
+        for (const [id, entry] of entries) {
+            if (entry.changedAt <= since) continue;
+            if (entry.mark) changed[id] = entry.mark;
+            else removed.push(id);
+        }
+        for (const [id, removedAt] of tombstones) {
+            if (removedAt > since) removed.push(id);
+        }
+        return { epoch: epoch, version: version, full: false, changed: changed, removed: removed };
+    }
+
+    function state() {
+        // Cheap change check: no layout reads, just pending mutation records and counters
+        init();
+        if (mutationObserver) onMutations(mutationObserver.takeRecords());
+        return {
+            epoch: epoch,
+            page_version: pageVersion,
+            scroll_x: Math.round(window.scrollX),
+            scroll_y: Math.round(window.scrollY)
+        };
+    }
+
+    function quiet() {
+        // Inputs for the Agent API's quiescence wait. Infinite animations (spinners, marquees) never finish, so they don't count.
+        init();
+        if (mutationObserver) onMutations(mutationObserver.takeRecords());
+        const animations = document.getAnimations ? document.getAnimations().filter(a =>
+            a.playState === 'running' && a.effect && a.effect.getComputedTiming().endTime !== Infinity
+        ).length : 0;
+        return {
+            since_mutation_ms: performance.now() - lastMutationAt,
+            animations: animations,
+            fonts_ready: !document.fonts || document.fonts.status === 'loaded',
+            ready_state: document.readyState
+        };
+    }
+
+    function cleanText(text, max) {
+        return (text || '').replace(/\s+/g, ' ').trim().slice(0, max || 80);
+    }
+
+    function accessibleName(el) {
+        // Simplified accessible-name computation: aria-labelledby, aria-label, <label>, alt/title/placeholder, text
+        const labelledBy = el.getAttribute('aria-labelledby');
+        if (labelledBy) {
+            const text = cleanText(labelledBy.split(/\s+/).map(id => {
+                const node = document.getElementById(id);
+                return node ? node.textContent : '';
+            }).join(' '));
+            if (text) return text;
+        }
+        const ariaLabel = cleanText(el.getAttribute('aria-label'));
+        if (ariaLabel) return ariaLabel;
+        if (el.labels && el.labels.length) return cleanText(el.labels[0].textContent);
+        for (const attr of ['alt', 'title', 'placeholder']) {
+            const value = cleanText(el.getAttribute(attr));
+            if (value) return value;
+        }
+        if (el.tagName === 'INPUT' && ['submit', 'button', 'reset'].includes(el.type)) return cleanText(el.value);
+        return cleanText(el.innerText);
+    }
+
+    function stableAttributes(el) {
+        const attrs = {};
+        for (const name of STABLE_ATTRS) {
+            let value = el.getAttribute(name);
+            if (!value) continue;
+            if (name === 'id' && GENERATED_ID.test(value)) continue;
+            // Query strings and fragments often carry session tokens
+            if (name === 'href') value = value.split(/[?#]/)[0];
+            attrs[name] = value.slice(0, 200);
+        }
+        return attrs;
+    }
+
+    function relativePath(el) {
+        // tag:nth-of-type steps up to the nearest ancestor with a stable id (or <body>)
+        const steps = [];
+        let node = el;
+        while (node && node !== document.body && node !== document.documentElement && steps.length < 12) {
+            if (node !== el && node.id && !GENERATED_ID.test(node.id)) {
+                steps.unshift('#' + node.id);
+                break;
+            }
+            let index = 1;
+            for (let sibling = node.previousElementSibling; sibling; sibling = sibling.previousElementSibling) {
+                if (sibling.tagName === node.tagName) index++;
+            }
+            steps.unshift(node.tagName.toLowerCase() + ':' + index);
+            node = node.parentElement;
+        }
+        return steps.join('>');
+    }
+
+    function fingerprintOf(el) {
+        return {
+            tag: el.tagName.toLowerCase(),
+            role: el.getAttribute('role') || '',
+            name: accessibleName(el),
+            text: cleanText(el.innerText),
+            attrs: stableAttributes(el),
+            path: relativePath(el)
+        };
+    }
+
+    function fingerprint(markIds) {
+        // Fingerprints of registered elements by mark id (ids from any frame of this epoch)
+        init();
+        const result = {};
+        for (const id of markIds || []) {
+            const entry = entries.get(String(id));
+            if (entry && entry.el.isConnected) result[id] = fingerprintOf(entry.el);
+        }
+        return result;
+    }
+
+    function similarity(taught, candidate) {
+        // Weighted share of the taught fingerprint's features the candidate reproduces exactly
+        let total = 0;
+        let matched = 0;
+        const check = (weight, a, b) => {
+            total += weight;
+            if (a === b) matched += weight;
+        };
+        if (taught.role) check(1, taught.role, candidate.role);
+        if (taught.name) check(3, taught.name, candidate.name);
+        if (taught.text) check(2, taught.text, candidate.text);
+        if (taught.path) check(1, taught.path, candidate.path);
+        for (const [name, value] of Object.entries(taught.attrs || {})) {
+            check(KEY_ATTRS.includes(name) ? 2 : 1, value, candidate.attrs[name]);
+        }
+        return total ? matched / total : 0;
+    }
+
+    function locate(taught) {
+        // Scores every visible mark with the taught tag against the fingerprint, best first
+        const t0 = performance.now();
+        refresh();
+        const candidates = [];
+        for (const [id, entry] of entries) {
+            if (!entry.mark || entry.el.tagName.toLowerCase() !== taught.tag) continue;
+            candidates.push({ id: id, score: similarity(taught, fingerprintOf(entry.el)), mark: entry.mark });
+        }
+        candidates.sort((a, b) => b.score - a.score);
+        return {
+            epoch: epoch,
+            version: version,
+            candidates: candidates.slice(0, 5),
+            considered: candidates.length,
+            elapsed_ms: performance.now() - t0
+        };
+    }
+
+    function elementFor(id) {
+        const entry = entries.get(String(id));
+        return entry ? entry.el : null;
+    }
+
+    Object.defineProperty(window, KEY, {
+        value: {
+            extract: extract, clear: clear, diff: diff, state: state, quiet: quiet, elementFor: elementFor,
+            fingerprint: fingerprint, locate: locate
+        },
+        enumerable: false,
+        configurable: false,
+        writable: false
+    });
+
+    // Start observing right away so page changes before the first perception call are counted
+    init();
+})();
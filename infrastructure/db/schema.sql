@@ -17,6 +17,7 @@ CREATE TABLE blueprints (
     id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
     name TEXT NOT NULL,
     state_graph_json JSONB NOT NULL DEFAULT '{}'::jsonb,
+    version INTEGER NOT NULL DEFAULT 1, -- bumped on every edit; executors cache compiled plans per version
     created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
 );
 
@@ -26,13 +27,112 @@ CREATE TABLE visual_anchors (
     blueprint_id UUID REFERENCES blueprints(id) ON DELETE CASCADE,
     semantic_label TEXT NOT NULL, -- e.g., 'Login Button', 'Search Bar'
     embedding vector(512), -- 512 dimensions for CLIP/BGE-M3 models
-    bounding_box_relative JSONB, -- {width_pct: float, height_pct: float}
+    bounding_box_relative JSONB, -- {width_pct, height_pct, x_pct, y_pct}: size and center as viewport fractions
+    dom_fingerprint JSONB, -- {tag, role, name, text, attrs, path} of the taught element, for DOM-first resolution
     created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
 );
 
 -- 5. Create an index for faster vector similarity search (Optional but recommended for large datasets)
 CREATE INDEX ON visual_anchors USING hnsw (embedding vector_cosine_ops);
 
+-- 6. Upgrade path for databases created before DOM fingerprints
+ALTER TABLE visual_anchors ADD COLUMN IF NOT EXISTS dom_fingerprint JSONB;
+
+-- 7. Upgrade path for databases created before blueprint versions
+ALTER TABLE blueprints ADD COLUMN IF NOT EXISTS version INTEGER NOT NULL DEFAULT 1;
+
+-- 8. Nearest-neighbour search over the anchor library.
+-- Library-wide: the inner ORDER BY distance + LIMIT is what lets the planner use the HNSW index;
+-- the similarity threshold is applied to that candidate set afterwards.
+-- Within one blueprint: an exact scan of that blueprint's anchors (few, found via the blueprint_id index).
+-- Filtering an HNSW scan afterwards could return nothing even when a near-identical anchor exists.
+-- The return type gained dom_fingerprint, which CREATE OR REPLACE can't change, hence the DROP.
+CREATE INDEX IF NOT EXISTS visual_anchors_blueprint_id_idx ON visual_anchors (blueprint_id);
+
+DROP FUNCTION IF EXISTS match_visual_anchors(vector, FLOAT, INT, UUID);
+CREATE OR REPLACE FUNCTION match_visual_anchors(
+    query_embedding vector(512),
+    match_threshold FLOAT DEFAULT 0.9,
+    match_count INT DEFAULT 5,
+    filter_blueprint_id UUID DEFAULT NULL
+)
+RETURNS TABLE (
+    id UUID,
+    blueprint_id UUID,
+    semantic_label TEXT,
+    bounding_box_relative JSONB,
+    dom_fingerprint JSONB,
+    similarity FLOAT
+)
+LANGUAGE sql STABLE
+AS $$
+    WITH scoped AS MATERIALIZED (
+        SELECT
+            va.id,
+            va.blueprint_id,
+            va.semantic_label,
+            va.bounding_box_relative,
+            va.dom_fingerprint,
+            1 - (va.embedding <=> query_embedding) AS similarity
+        FROM visual_anchors va
+        WHERE filter_blueprint_id IS NOT NULL AND va.blueprint_id = filter_blueprint_id
+    ), nearest AS (
+        SELECT
+            va.id,
+            va.blueprint_id,
+            va.semantic_label,
+            va.bounding_box_relative,
+            va.dom_fingerprint,
+            1 - (va.embedding <=> query_embedding) AS similarity
+        FROM visual_anchors va
+        WHERE filter_blueprint_id IS NULL
+        ORDER BY va.embedding <=> query_embedding
+        LIMIT match_count
+    )
+    SELECT matches.id, matches.blueprint_id, matches.semantic_label, matches.bounding_box_relative, matches.dom_fingerprint, matches.similarity
+    FROM (SELECT * FROM scoped UNION ALL SELECT * FROM nearest) matches
+    WHERE matches.similarity >= match_threshold
+    ORDER BY matches.similarity DESC
+    LIMIT match_count;
+$$;
+
+-- 9. Blueprint edits. Each is a single UPDATE, so concurrent teachers can neither lose a step nor reuse a version
+-- (the row is re-read under its lock before the new graph and version are computed).
+CREATE OR REPLACE FUNCTION append_blueprint_step(
+    target_blueprint_id UUID,
+    new_step JSONB
+)
+RETURNS TABLE (
+    step JSONB,
+    version INTEGER
+)
+LANGUAGE sql VOLATILE
+AS $$
+    UPDATE blueprints b
+    SET state_graph_json = jsonb_set(
+            b.state_graph_json,
+            '{steps}',
+            COALESCE(b.state_graph_json->'steps', '[]'::jsonb)
+                || jsonb_build_array(new_step || jsonb_build_object('step', jsonb_array_length(COALESCE(b.state_graph_json->'steps', '[]'::jsonb)) + 1))
+        ),
+        version = b.version + 1
+    WHERE b.id = target_blueprint_id
+    RETURNING b.state_graph_json->'steps'->-1, b.version;
+$$;
+
+CREATE OR REPLACE FUNCTION save_blueprint_graph(
+    target_blueprint_id UUID,
+    graph JSONB
+)
+RETURNS INTEGER
+LANGUAGE sql VOLATILE
+AS $$
+    UPDATE blueprints b
+    SET state_graph_json = graph, version = b.version + 1
+    WHERE b.id = target_blueprint_id
+    RETURNING b.version;
+$$;
+
 -- RLS (Row Level Security) - Optional setup for future
 -- ALTER TABLE agents ENABLE ROW LEVEL SECURITY;
 -- ALTER TABLE blueprints ENABLE ROW LEVEL SECURITY;
@@ -5,43 +5,186 @@ from transformers import CLIPProcessor, CLIPModel
 from PIL import Image
 import base64
 import io
+import os
+import hashlib
+from collections import OrderedDict
 
 app = FastAPI(title="IsoMind Visual Embedding API")
 
 DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
 MODEL_ID = "openai/clip-vit-base-patch32"
+# Upper bound on images per CLIP forward pass; larger requests are split into chunks
+MAX_BATCH_SIZE = int(os.getenv("EMBED_MAX_BATCH_SIZE", "64"))
+# Bounds for the content-addressed embedding cache
+CACHE_MAX_ENTRIES = int(os.getenv("EMBED_CACHE_MAX_ENTRIES", "50000"))
+CACHE_MAX_MB = float(os.getenv("EMBED_CACHE_MAX_MB", "256"))
 
 print(f"Loading CLIP model {MODEL_ID} on {DEVICE}...")
 model = CLIPModel.from_pretrained(MODEL_ID).to(DEVICE)
 processor = CLIPProcessor.from_pretrained(MODEL_ID)
 print("Model loaded successfully.")
 
+class EmbeddingCache:
+    # LRU cache of normalized image embeddings keyed by a hash of the decoded pixels,
+    # so identical crops (headers, nav links, repeated list items) skip the GPU entirely
+    def __init__(self, max_entries: int, max_bytes: int):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.bytes_used = 0
+        self.hits = 0
+        self.misses = 0
+        self.batch_duplicates = 0
+        self.evictions = 0
+
+    @staticmethod
+    def key_for(image: Image.Image) -> str:
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(f"{image.width}x{image.height}".encode())
+        digest.update(image.tobytes())
+        return digest.hexdigest()
+
+    def get(self, key: str):
+        tensor = self.entries.get(key)
+        if tensor is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return tensor
+
+    def put(self, key: str, tensor: torch.Tensor):
+        if key in self.entries:
+            return
+        self.entries[key] = tensor
+        self.bytes_used += tensor.element_size() * tensor.nelement()
+        while self.entries and (len(self.entries) > self.max_entries or self.bytes_used > self.max_bytes):
+            _, evicted = self.entries.popitem(last=False)
+            self.bytes_used -= evicted.element_size() * evicted.nelement()
+            self.evictions += 1
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "bytes_used": self.bytes_used,
+            "max_entries": self.max_entries,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "batch_duplicates": self.batch_duplicates,
+            "evictions": self.evictions
+        }
+
+embedding_cache = EmbeddingCache(CACHE_MAX_ENTRIES, int(CACHE_MAX_MB * 1024 * 1024))
+
 class EmbedRequest(BaseModel):
     image_base64: str
+
+class BatchEmbedRequest(BaseModel):
+    images_base64: list[str]
+
+class RegionEmbedRequest(BaseModel):
+    image_base64: str
+    # region id -> [left, top, right, bottom] in image pixels, clamped to the image bounds
+    regions: dict[str, list[int]]
     
 class TextEmbedRequest(BaseModel):
     text: str
 
-@app.post("/v1/embed/image")
-async def embed_image(req: EmbedRequest):
-    try:
-        # Decode base64 image
-        image_bytes = base64.b64decode(req.image_base64)
-        image = Image.open(io.BytesIO(image_bytes)).convert("RGB")
-        
-        # Process and generate embedding
-        inputs = processor(images=image, return_tensors="pt").to(DEVICE)
+def decode_image(image_base64: str) -> Image.Image:
+    image_bytes = base64.b64decode(image_base64)
+    return Image.open(io.BytesIO(image_bytes)).convert("RGB")
+
+def embed_images(images: list) -> list:
+    keys = [EmbeddingCache.key_for(image) for image in images]
+    
+    # Resolve cache hits and collapse identical crops so each unique miss is embedded once
+    results = {}
+    pending = OrderedDict()
+    for key, image in zip(keys, images):
+        if key in results:
+            continue
+        if key in pending:
+            embedding_cache.batch_duplicates += 1
+            continue
+        cached = embedding_cache.get(key)
+        if cached is not None:
+            results[key] = cached
+        else:
+            pending[key] = image
+            
+    # Run CLIP over the misses in chunks of MAX_BATCH_SIZE, one forward pass per chunk
+    pending_keys = list(pending.keys())
+    for start in range(0, len(pending_keys), MAX_BATCH_SIZE):
+        chunk_keys = pending_keys[start:start + MAX_BATCH_SIZE]
+        inputs = processor(images=[pending[k] for k in chunk_keys], return_tensors="pt").to(DEVICE)
         with torch.no_grad():
             image_features = model.get_image_features(**inputs)
             
-        # Normalize vector (cosine similarity standard)
+        # Normalize vectors (cosine similarity standard)
         image_features = image_features / image_features.norm(p=2, dim=-1, keepdim=True)
-        embedding = image_features.squeeze(0).cpu().tolist()
-        
+        for key, features in zip(chunk_keys, image_features.cpu()):
+            # Clone so each cached row owns its storage instead of pinning the whole batch tensor
+            features = features.clone()
+            embedding_cache.put(key, features)
+            results[key] = features
+            
+    return [results[key].tolist() for key in keys]
+
+@app.post("/v1/embed/image")
+async def embed_image(req: EmbedRequest):
+    try:
+        embedding = embed_images([decode_image(req.image_base64)])[0]
         return {"status": "success", "embedding": embedding, "dimensions": len(embedding)}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/v1/embed/images")
+async def embed_images_batch(req: BatchEmbedRequest):
+    if not req.images_base64:
+        raise HTTPException(status_code=400, detail="images_base64 must not be empty")
+    try:
+        images = [decode_image(b64) for b64 in req.images_base64]
+        embeddings = embed_images(images)
+        return {
+            "status": "success",
+            "embeddings": embeddings,
+            "count": len(embeddings),
+            "dimensions": len(embeddings[0])
+        }
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/v1/embed/regions")
+async def embed_regions(req: RegionEmbedRequest):
+    if not req.regions:
+        raise HTTPException(status_code=400, detail="regions must not be empty")
+    try:
+        # Decode the full frame once and crop every region from it in-process
+        image = decode_image(req.image_base64)
+        region_ids = list(req.regions.keys())
+        crops = []
+        for region_id in region_ids:
+            left, top, right, bottom = req.regions[region_id]
+            crops.append(image.crop((
+                max(0, left),
+                max(0, top),
+                min(image.width, right),
+                min(image.height, bottom)
+            )))
+            
+        embeddings = embed_images(crops)
+        return {
+            "status": "success",
+            "embeddings": dict(zip(region_ids, embeddings)),
+            "count": len(embeddings),
+            "dimensions": len(embeddings[0])
+        }
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
 @app.post("/v1/embed/text")
 async def embed_text(req: TextEmbedRequest):
     try:
@@ -59,7 +202,13 @@ async def embed_text(req: TextEmbedRequest):
 
 @app.get("/v1/health")
 async def health_check():
-    return {"status": "ok", "device": DEVICE, "model": MODEL_ID}
+    return {
+        "status": "ok",
+        "device": DEVICE,
+        "model": MODEL_ID,
+        "max_batch_size": MAX_BATCH_SIZE,
+        "cache": embedding_cache.stats()
+    }
 
 if __name__ == "__main__":
     import uvicorn